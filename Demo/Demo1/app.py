@@ -1,43 +1,28 @@
 from flask import Flask, request
 import json
+import os
+from persistence import Journal
+from response import success_response, failure_response
+from sqlstore import SqliteStore
+from store import Store
 
 app = Flask(__name__)
 
-posts = {
-    0:{
-        'id':0, 
-        'upvotes':1, 
-        'title':"My cat is the cutest!", 
-        'link':"https://i.imgur.com/jseZqNK.jpg", 
-        'username':"alicia98"
-    }, 
-    1:{
-        'id':1, 
-        'upvotes':3, 
-        'title':"Cat loaf", 
-        'link':"https://i.imgur.com/TJ46wX4.jpg", 
-        'username':"alicia98"
-        }
-}
-
-comments = {
-    0:{
-      "id": 0,
-      "upvotes": 8,
-      "text": "Wow, my first Reddit gold!",
-      "username": "alicia98",
-    }
-}
-
-posts_comments = {
-    0:{
-        "post_id":0,
-        "comment_id":0
-    }
-}
-
-post_current_id = 1
-comment_current_id = 0
+# With STORE_DB set, posts and comments are kept in that sqlite database,
+# which any number of worker processes can share. Otherwise they are kept in
+# memory, and with STORE_DIR set they survive restarts of a single process
+recovered = False
+if os.environ.get("STORE_DB"):
+    store = SqliteStore(os.environ["STORE_DB"])
+    recovered = store.recovered
+else:
+    store = Store()
+    if os.environ.get("STORE_DIR"):
+        recovered = Journal(store, os.environ["STORE_DIR"]).recovered
+if not recovered:
+    cat = store.create_post("My cat is the cutest!", "https://i.imgur.com/jseZqNK.jpg", "alicia98")
+    store.create_post("Cat loaf", "https://i.imgur.com/TJ46wX4.jpg", "alicia98", upvotes=3)
+    store.create_comment(cat["id"], "Wow, my first Reddit gold!", "alicia98", upvotes=8)
 
 @app.route('/')
 @app.route('/api/posts/')
@@ -45,8 +30,8 @@ def get_posts():
     """
     Gets all posts
     """
-    res = {"posts": list(posts.values())}
-    return json.dumps(res), 200
+    res = {"posts": store.get_posts()}
+    return success_response(res)
 
 @app.route("/api/posts/", methods=["POST"])
 def create_post():
@@ -57,79 +42,64 @@ def create_post():
     link: post image URL
     username: poster username
     """
-    global post_current_id
     body = json.loads(request.data)
     title = body.get("title")
     link = body.get("link")
     username = body.get("username")
-    post_current_id+=1
-    post = {'id':post_current_id, 'upvotes':1, 'title':title, 'link':link, 'username':username}
-    posts[post_current_id] = post
-    return json.dumps(post), 201
+    post = store.create_post(title, link, username)
+    return success_response(post, 201)
 
 @app.route("/api/posts/<int:post_id>/")
 def retrieve_post(post_id):
     """
     Returns specific post using post's id.
     """
-    post = posts.get(post_id)
+    post = store.get_post(post_id)
     if post is None:
-        return json.dumps({"error":"Post not found"}), 404
-    return json.dumps(post), 200
+        return failure_response("Post not found")
+    return success_response(post)
 
 @app.route("/api/posts/<int:post_id>/", methods=["DELETE"])
 def delete_post(post_id):
     """
     Deletes a post.
     """
-    post = posts.get(post_id)
+    post = store.delete_post(post_id)
     if post is None:
-        return json.dumps({"error":"Post not found"}), 404
-    del posts[post_id]
-    return json.dumps(post), 200
+        return failure_response("Post not found")
+    return success_response(post)
 
 @app.route("/api/posts/<int:post_id>/comments/")
 def retrieve_comments(post_id):
     """
     Retrieves a post's comments.
     """
-    post = posts.get(post_id)
-    if post is None:
-        return json.dumps({"error":"Post not found"}), 404
-    comments_res = {}
-    comments_number = -1
-    for x in posts_comments:
-        pair = posts_comments.get(x)
-        if pair["post_id"] == post_id:
-            comment = comments.get(pair["comment_id"])
-            comments_number+=1
-            comments_res[comments_number] = comment
-    res = {"comments": list(comments_res.values())}
-    return json.dumps(res), 200
+    comments = store.get_comments(post_id)
+    if comments is None:
+        return failure_response("Post not found")
+    res = {"comments": comments}
+    return success_response(res)
 
 @app.route("/api/posts/<int:post_id>/comments/", methods=["POST"])
 def create_comment(post_id):
     """
     Creates a new comment.
     """
-    global comment_current_id
     body = json.loads(request.data)
     text = body.get("text")
     username = body.get("username")
-    comment_current_id+=1
-    comment = {'id':comment_current_id, 'upvotes':1, 'text':text, 'username':username}
-    comments[comment_current_id] = comment
-    posts_comments[comment_current_id] = {'post_id':post_id, 'comment_id':comment_current_id}
-    return json.dumps(comment), 201
+    comment = store.create_comment(post_id, text, username)
+    return success_response(comment, 201)
 
 @app.route("/api/posts/<int:post_id>/comments/<int:comment_id>/", methods=["PUT"])
 def update_comment(post_id, comment_id):
-    comment = comments.get(comment_id)
-    if comment is None:
-        return json.dumps({"error":"Comment not found"}), 404
+    if store.get_comment(comment_id) is None:
+        return failure_response("Comment not found")
     body = json.loads(request.data)
-    comment["text"]=body.get("text")
-    return json.dumps(comment), 200
+    comment = store.update_comment(comment_id, text=body.get("text"))
+    if comment is None:
+        return failure_response("Comment not found")
+    return success_response(comment)
 
 # Tier 1 Challenges
 
@@ -142,79 +112,89 @@ def create_post_t1():
     link: post image URL
     username: poster username
     """
-    global post_current_id
     body = json.loads(request.data)
     title = body.get("title")
     link = body.get("link")
     username = body.get("username")
     if type(title) != str or type(link) != str or type(username) != str:
-        return json.dumps({"error":"Bad request"}), 400
-    post_current_id+=1
-    post = {'id':post_current_id, 'upvotes':1, 'title':title, 'link':link, 'username':username}
-    posts[post_current_id] = post
-    return json.dumps(post), 201
+        return failure_response("Bad request", 400)
+    post = store.create_post(title, link, username)
+    return success_response(post, 201)
 
 @app.route("/api/extra/posts/<int:post_id>/comments/", methods=["POST"])
 def create_comment_t1(post_id):
     """
     Creates a new comment.
     """
-    post = posts.get(post_id)
+    post = store.get_post(post_id)
     if post is None:
-        return json.dumps({"error":"Post not found"}), 404
-    global comment_current_id
+        return failure_response("Post not found")
     body = json.loads(request.data)
     text = body.get("text")
     username = body.get("username")
     if type(text) != str or type(username) != str:
-        return json.dumps({"error":"Bad request"}), 400
-    comment_current_id+=1
-    comment = {'id':comment_current_id, 'upvotes':1, 'text':text, 'username':username}
-    comments[comment_current_id] = comment
-    posts_comments[comment_current_id] = {'post_id':post_id, 'comment_id':comment_current_id}
-    return json.dumps(comment), 201
+        return failure_response("Bad request", 400)
+    comment = store.create_comment(post_id, text, username)
+    return success_response(comment, 201)
 
 @app.route("/api/extra/posts/<int:post_id>/comments/<int:comment_id>/", methods=["PUT"])
 def update_comment_t1(post_id, comment_id):
-    post = posts.get(post_id)
+    post = store.get_post(post_id)
     if post is None:
-        return json.dumps({"error":"Post not found"}), 404
-    comment = comments.get(comment_id)
-    if comment is None:
-        return json.dumps({"error":"Comment not found"}), 404
+        return failure_response("Post not found")
+    if store.get_comment(comment_id) is None:
+        return failure_response("Comment not found")
     body = json.loads(request.data)
     if type(body.get("text")) != str:
-        return json.dumps({"error":"Bad request"}), 400
-    comment["text"]=body.get("text")
-    return json.dumps(comment), 200
+        return failure_response("Bad request", 400)
+    comment = store.update_comment(comment_id, text=body.get("text"))
+    if comment is None:
+        return failure_response("Comment not found")
+    return success_response(comment)
 
 # Tier 2 Challenges
 @app.route("/api/extra/posts/<int:post_id>/", methods=["POST"])
 def update_upvotes(post_id):
-    post = posts.get(post_id)
+    post = store.get_post(post_id)
     if post is None:
-        return json.dumps({"error":"Post not found"}), 404
+        return failure_response("Post not found")
     try:
         body = json.loads(request.data)
     except:
-        post["upvotes"] = str(int(post["upvotes"])+1)
-        return json.dumps(post), 200
-    post["upvotes"] = str(int(post["upvotes"])+int(body["upvotes"]))
-    return json.dumps(post), 200
+        upvotes = 1
+    else:
+        upvotes = int(body["upvotes"])
+    post = store.add_upvotes(post_id, upvotes)
+    if post is None:
+        return failure_response("Post not found")
+    return success_response(post)
 
 @app.route("/api/extra/posts/", methods=["GET"])
 def get_posts_sorted():
     """
-    Gets all posts
+    Gets posts ordered by upvotes
+
+    sort: increasing or decreasing
+    offset: number of posts to skip, 0 by default
+    limit: most posts to return, all of them by default
     """
     args = request.args
-    posts_list = posts.values()
-    if args["sort"] == "increasing":
-        list_res = sorted(posts_list, key=lambda x: x['upvotes'])
-    if args["sort"] == "decreasing":
-        list_res = sorted(posts_list, key=lambda x: x['upvotes'], reverse=True)
+    sort = args.get("sort")
+    offset = args.get("offset", 0, type=int)
+    limit = args.get("limit", type=int)
+    if sort not in ("increasing", "decreasing"):
+        return failure_response("Bad request", 400)
+    if offset < 0 or (limit is not None and limit < 0):
+        return failure_response("Bad request", 400)
+    list_res = store.get_ranked_posts(sort == "decreasing", offset, limit)
     res = {"posts": list_res}
-    return json.dumps(res), 200
+    return success_response(res)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    # the reloader would run a second copy of the app on the same STORE_DIR
+    app.run(
+        host="0.0.0.0",
+        port=8000,
+        debug=True,
+        use_reloader=not os.environ.get("STORE_DIR"),
+    )
@@ -0,0 +1,460 @@
+"""
+Benchmarks for the posts app.
+
+Run from this directory, e.g. `python bench.py recovery --ops 10000 100000`.
+Every benchmark works on its own store, and journals to a temporary
+directory, so the app's own STORE_DIR is never touched.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import app
+from persistence import Journal
+from store import Store
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def latency(calls, work):
+    """
+    Calls `work` with each argument in `calls` and returns the p50 and p99
+    latency in milliseconds
+    """
+    times = []
+    for arg in calls:
+        start = time.perf_counter()
+        work(arg)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2], times[len(times) * 99 // 100]
+
+
+def run_threads(workers, seconds, work):
+    """
+    Runs `work` in a loop on `workers` threads for `seconds` and returns the
+    number of calls completed per second. Timing starts once every thread
+    is running and ends once every thread has stopped
+    """
+    counts = [0] * workers
+    ready = threading.Barrier(workers + 1)
+    stop = threading.Event()
+
+    def loop(i):
+        ready.wait()
+        while not stop.is_set():
+            work()
+            counts[i] += 1
+
+    threads = [threading.Thread(target=loop, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    ready.wait()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def locked_upvote(store, post_id):
+    """
+    Upvotes a post the way the store used to, under its shard's lock
+    """
+    shard = store.shard(post_id)
+    with shard.lock:
+        post = shard.posts[post_id]
+        with store.ranking_lock:
+            store.ranking.remove((post["upvotes"], post_id))
+            post["upvotes"] += 1
+            store.ranking.add((post["upvotes"], post_id))
+        return dict(post)
+
+
+def churn(store, ops):
+    """
+    Makes `ops` random changes to `store`: new posts and comments, upvotes,
+    comment edits and deleted posts
+    """
+    posts = [store.create_post("title", "link", "user")["id"]]
+    comments = []
+    for i in range(ops):
+        roll = random.random()
+        if roll < 0.3 or not posts:
+            posts.append(store.create_post("post %d" % i, "link", "user")["id"])
+        elif roll < 0.6:
+            store.add_upvotes(random.choice(posts), random.randint(-1, 3))
+        elif roll < 0.85:
+            comment = store.create_comment(random.choice(posts), "text", "user")
+            comments.append(comment["id"])
+        elif roll < 0.95 and comments:
+            store.update_comment(random.choice(comments), text="edit %d" % i)
+        else:
+            store.delete_post(posts.pop(random.randrange(len(posts))))
+
+
+def state(store):
+    """
+    Returns everything a client can read from `store`, and its next ids
+    """
+    posts = store.get_posts()
+    comments = {post["id"]: store.get_comments(post["id"]) for post in posts}
+    return posts, comments, store.next_ids
+
+
+def size(directory):
+    """
+    Returns the size of the files in `directory` in MB
+    """
+    return (
+        sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+        / 10**6
+    )
+
+
+def free_port():
+    """
+    Returns a TCP port nothing is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, workers, threads, database):
+    """
+    Starts the app under gunicorn, with `workers` processes of `threads`
+    threads sharing the sqlite `database`, and waits until it accepts
+    connections
+    """
+    env = dict(
+        os.environ,
+        STORE_DB=database,
+        PORT=str(port),
+        WORKERS=str(workers),
+        THREADS=str(threads),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app"],
+        cwd=HERE,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit("server exited with %d" % server.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("server didn't start")
+
+
+def send(conn, method, path, body=None):
+    """
+    Sends a request on a keep-alive connection and returns the response's
+    status and decoded body
+    """
+    data = None if body is None else json.dumps(body)
+    conn.request(method, path, data, {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def load(port, post_ids, seconds):
+    """
+    Sends requests to the app on `port` for `seconds`: upvotes of the first
+    of `post_ids`, reads of the others, ranked pages and new posts. Returns
+    the number of requests answered, of upvotes that succeeded and of errors
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    hot = "/api/extra/posts/%d/" % post_ids[0]
+    requests = upvotes = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        roll = random.random()
+        if roll < 0.5:
+            method, path, body = "POST", hot, {"upvotes": 1}
+        elif roll < 0.8:
+            method, body = "GET", None
+            path = "/api/posts/%d/" % random.choice(post_ids)
+        elif roll < 0.9:
+            method, body = "GET", None
+            path = "/api/extra/posts/?sort=decreasing&limit=10"
+        else:
+            method, path = "POST", "/api/posts/"
+            body = {"title": "load", "link": "link", "username": "user"}
+        try:
+            status, _ = send(conn, method, path, body)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            errors += 1
+            continue
+        requests += 1
+        if status >= 300:
+            errors += 1
+        elif path == hot:
+            upvotes += 1
+    conn.close()
+    return requests, upvotes, errors
+
+
+def bench_recovery(args):
+    """
+    Startup recovery time against log size, replaying the whole log and
+    then from a compacted snapshot. Exits with an error if a recovered
+    store differs from the one that was journaled
+    """
+    failed = False
+    print("     ops  log MB  replay s  snapshot MB  load s")
+    for ops in args.ops:
+        directory = tempfile.mkdtemp()
+        store = Store()
+        Journal(store, directory, snapshot_every=float("inf"))
+        churn(store, ops)
+        expected = state(store)
+        store.journal.close(snapshot=False)
+        log_size = size(directory)
+
+        start = time.perf_counter()
+        store = Store()
+        Journal(store, directory, snapshot_every=float("inf"))
+        replay = time.perf_counter() - start
+        failed |= state(store) != expected
+        store.journal.close()
+        snapshot_size = size(directory)
+
+        start = time.perf_counter()
+        store = Store()
+        Journal(store, directory)
+        load = time.perf_counter() - start
+        failed |= state(store) != expected
+        store.journal.close(snapshot=False)
+        print(
+            "%8d  %6.1f  %8.3f  %11.1f  %6.3f"
+            % (ops, log_size, replay, snapshot_size, load)
+        )
+    if failed:
+        print("a recovered store differs from the journaled one")
+    sys.exit(1 if failed else 0)
+
+
+def bench_latency(args):
+    """
+    Request latency through the app with persistence off and on, over a mix
+    of new posts, upvotes, new comments and comment listings
+    """
+    client = app.app.test_client()
+    requests = [
+        lambda i: client.post(
+            "/api/posts/",
+            data=json.dumps({"title": "t%d" % i, "link": "l", "username": "u"}),
+        ),
+        lambda i: client.post(
+            "/api/extra/posts/%d/" % random.randrange(i + 1),
+            data=json.dumps({"upvotes": 1}),
+        ),
+        lambda i: client.post(
+            "/api/posts/%d/comments/" % random.randrange(i + 1),
+            data=json.dumps({"text": "c%d" % i, "username": "u"}),
+        ),
+        lambda i: client.get("/api/posts/%d/comments/" % random.randrange(i + 1)),
+    ]
+
+    print("persistence  p50 ms  p99 ms")
+    for persistence in (False, True):
+        app.store = Store()
+        if persistence:
+            Journal(app.store, tempfile.mkdtemp())
+        calls = range(args.requests)
+        p50, p99 = latency(calls, lambda i: requests[i % len(requests)](i))
+        print("%-11s  %6.3f  %6.3f" % ("on" if persistence else "off", p50, p99))
+        if persistence:
+            app.store.journal.close(snapshot=False)
+
+
+def bench_upvotes(args):
+    """
+    Upvotes/sec on a single hot post with each number of threads, under the
+    post's shard lock as before and through the striped counter
+    """
+    print("threads  locked/sec  striped/sec")
+    for workers in args.workers:
+        store = Store()
+        post_id = store.create_post("hot", "link", "user")["id"]
+        locked = run_threads(
+            workers, args.seconds, lambda: locked_upvote(store, post_id)
+        )
+        striped = run_threads(
+            workers, args.seconds, lambda: store.add_upvotes(post_id, 1)
+        )
+        print("%7d  %10.0f  %11.0f" % (workers, locked, striped))
+
+
+def stress(writers, upvotes):
+    """
+    `writers` threads upvote one post through the app `upvotes` times each
+    while a reader polls it. Returns the seconds it took and a list of
+    errors: upvotes lost or counted twice, and reads of the count going down
+    """
+    app.store = Store()
+    post_id = app.store.create_post("hot", "link", "user")["id"]
+    expected = 1 + writers * upvotes
+    errors = []
+    done = threading.Event()
+
+    def writer():
+        client = app.app.test_client()
+        for _ in range(upvotes):
+            response = client.post(
+                "/api/extra/posts/%d/" % post_id, data=json.dumps({"upvotes": 1})
+            )
+            if response.status_code != 200:
+                errors.append("upvote answered %d" % response.status_code)
+
+    def reader():
+        last = 0
+        while not done.is_set():
+            upvotes = app.store.get_post(post_id)["upvotes"]
+            if upvotes < last or upvotes > expected:
+                errors.append("read %d after %d" % (upvotes, last))
+            last = upvotes
+            if random.random() < 0.01:
+                app.store.get_ranked_posts(True, 0, 1)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    polling = threading.Thread(target=reader)
+    start = time.perf_counter()
+    polling.start()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    polling.join()
+
+    read = app.store.get_post(post_id)["upvotes"]
+    app.store.merge_upvotes()
+    merged = app.store.get_post(post_id)["upvotes"]
+    ranked = app.store.get_ranked_posts(True, 0, 1)[0]["upvotes"]
+    if not read == merged == ranked == expected:
+        errors.append(
+            "expected %d upvotes, read %d, merged %d, ranked %d"
+            % (expected, read, merged, ranked)
+        )
+    return elapsed, errors
+
+
+def bench_stress(args):
+    """
+    Time for --writers threads to upvote one post through the app --upvotes
+    times each while a reader polls it, and any upvote lost or counted twice
+    or read going down. test_app.py checks that there are none
+    """
+    elapsed, errors = stress(args.writers, args.upvotes)
+    print(
+        "%d writers, %d upvotes in %.1fs, %d errors"
+        % (args.writers, args.writers * args.upvotes, elapsed, len(errors))
+    )
+    for error in errors[:10]:
+        print(error)
+
+
+def bench_workers(args):
+    """
+    Requests/sec through gunicorn with each number of worker processes
+    sharing a sqlite store (STORE_DB), from --clients client processes.
+    Half the requests upvote one post, so every worker writes it at once.
+    Exits with an error if that post's upvotes aren't exactly the number of
+    upvotes that succeeded
+    """
+    failed = False
+    print("workers       req/s  upvotes  counted  errors")
+    for workers in args.workers:
+        port = free_port()
+        database = os.path.join(tempfile.mkdtemp(), "posts.db")
+        server = start_server(port, workers, args.threads, database)
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            post_ids = []
+            for i in range(args.posts):
+                body = {"title": "post %d" % i, "link": "link", "username": "user"}
+                post_ids.append(send(conn, "POST", "/api/posts/", body)[1]["id"])
+            _, hot = send(conn, "GET", "/api/posts/%d/" % post_ids[0])
+            conn.close()
+            start = time.perf_counter()
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.starmap(
+                    load, [(port, post_ids, args.seconds)] * args.clients
+                )
+            elapsed = time.perf_counter() - start
+            requests, upvotes, errors = [sum(column) for column in zip(*results)]
+            # gunicorn drops connections idle for long, so open a new one
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            _, post = send(conn, "GET", "/api/posts/%d/" % post_ids[0])
+            counted = post["upvotes"] - hot["upvotes"]
+            conn.close()
+        finally:
+            server.terminate()
+            server.wait()
+        failed |= counted != upvotes
+        print(
+            "%7d  %10.1f  %7d  %7d  %6d"
+            % (workers, requests / elapsed, upvotes, counted, errors)
+        )
+    if failed:
+        print("upvotes were lost or counted twice")
+    sys.exit(1 if failed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    recovery = sub.add_parser("recovery", help=bench_recovery.__doc__.strip())
+    recovery.add_argument("--ops", type=int, nargs="+", default=[10**4, 10**5, 10**6])
+    recovery.set_defaults(func=bench_recovery)
+
+    timing = sub.add_parser("latency", help=bench_latency.__doc__.strip())
+    timing.add_argument("--requests", type=int, default=20000)
+    timing.set_defaults(func=bench_latency)
+
+    upvotes = sub.add_parser("upvotes", help=bench_upvotes.__doc__.strip())
+    upvotes.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16, 64])
+    upvotes.add_argument("--seconds", type=float, default=2.0)
+    upvotes.set_defaults(func=bench_upvotes)
+
+    stress = sub.add_parser("stress", help=bench_stress.__doc__.strip())
+    stress.add_argument("--writers", type=int, default=64)
+    stress.add_argument("--upvotes", type=int, default=200)
+    stress.set_defaults(func=bench_stress)
+
+    scaling = sub.add_parser("workers", help=bench_workers.__doc__.strip())
+    scaling.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    scaling.add_argument("--threads", type=int, default=4)
+    scaling.add_argument("--clients", type=int, default=8)
+    scaling.add_argument("--posts", type=int, default=100)
+    scaling.add_argument("--seconds", type=float, default=5.0)
+    scaling.set_defaults(func=bench_workers)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Counters that many threads can add to at once.
+
+A StripedCounter keeps STRIPES dicts of pending deltas by key, each with its
+own lock, and each thread always adds to the same one. Threads adding to a
+hot key therefore mostly take different locks, instead of all queueing on
+one. A key's total is whatever was last folded in with drain(), plus what
+pending() finds.
+"""
+import itertools
+import threading
+
+STRIPES = 16
+
+
+class StripedCounter(object):
+    """
+    Pending deltas by key, spread over stripes by adding thread
+    """
+
+    def __init__(self, stripes=STRIPES):
+        """
+        Creates a counter with nothing pending
+        """
+        self.stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+        self.assigned = itertools.count()
+        self.local = threading.local()
+
+    def stripe(self):
+        """
+        Returns the (lock, deltas) stripe of the calling thread
+        """
+        index = getattr(self.local, "index", None)
+        if index is None:
+            index = self.local.index = next(self.assigned) % len(self.stripes)
+        return self.stripes[index]
+
+    def add(self, key, delta):
+        """
+        Adds `delta` to what is pending for `key`
+        """
+        lock, deltas = self.stripe()
+        with lock:
+            deltas[key] = deltas.get(key, 0) + delta
+
+    def pending(self, key):
+        """
+        Returns the sum of what is pending for `key`. Doesn't lock, since a
+        dict lookup is atomic under the GIL; an add that finishes meanwhile
+        may or may not be counted
+        """
+        total = 0
+        for _, deltas in self.stripes:
+            if key in deltas:
+                total += deltas.get(key, 0)
+        return total
+
+    def keys(self):
+        """
+        Returns the keys with deltas pending
+        """
+        keys = set()
+        for lock, deltas in self.stripes:
+            with lock:
+                keys.update(deltas)
+        return keys
+
+    def drain(self, key):
+        """
+        Removes what is pending for `key` and returns its sum
+        """
+        total = 0
+        for lock, deltas in self.stripes:
+            with lock:
+                total += deltas.pop(key, 0)
+        return total
@@ -0,0 +1,24 @@
+"""
+Gunicorn settings for serving the app in production. From this directory,
+
+    gunicorn app:app
+
+runs WORKERS processes (one per core by default), each serving requests on
+THREADS threads, on port PORT. `python app.py` still runs Flask's debug
+server for development.
+
+Posts are kept in memory, which only one process can serve, unless STORE_DB
+names a sqlite database for the workers to share. So WORKERS defaults to 1
+without STORE_DB, and can't be set any higher.
+"""
+import multiprocessing
+import os
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", 8000)
+
+# Without STORE_DB every worker would have its own, different posts
+shared = bool(os.environ.get("STORE_DB"))
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count() if shared else 1))
+threads = int(os.environ.get("THREADS", 4))
+if workers > 1 and not shared:
+    raise ValueError("More than one worker needs STORE_DB")
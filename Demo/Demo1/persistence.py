@@ -0,0 +1,237 @@
+"""
+Write-behind persistence for the in-memory store.
+
+A Journal takes every operation the store reports and appends it to a log
+file from a background thread. Every FLUSH_INTERVAL the thread merges the
+store's pending upvotes, so they are reported too, then writes and fsyncs
+whatever queued up at once. Requests never wait on the disk, and a crash
+loses at most the last interval of changes.
+
+Every SNAPSHOT_EVERY operations, and on a clean shutdown, the log is
+compacted: the journal moves on to a new log file, writes the whole store
+to a snapshot that names that file as the first one to replay, and deletes
+the older logs. Opening a journal on a directory rebuilds the store from
+its snapshot and the logs from then on. Only one process at a time may
+journal to a directory.
+
+If writing fails, the journal says so on stderr and stops: nothing is
+persisted from then on, and operations are no longer queued.
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+# Logged operations are written and fsynced at most this many seconds after
+# they happen
+FLUSH_INTERVAL = 0.01
+
+# The log is compacted into a snapshot after this many operations
+SNAPSHOT_EVERY = 100000
+
+SNAPSHOT = "snapshot.json"
+
+
+def log_name(generation):
+    """
+    Returns the file name of the log of a generation
+    """
+    return "log.%d.jsonl" % generation
+
+
+class Journal(object):
+    """
+    Logs the changes made to a store, and rebuilds stores from those logs
+    """
+
+    def __init__(
+        self,
+        store,
+        directory,
+        flush_interval=FLUSH_INTERVAL,
+        snapshot_every=SNAPSHOT_EVERY,
+    ):
+        """
+        Rebuilds `store`, which must be empty, from the snapshot and logs in
+        `directory` if there are any, then starts journaling every change
+        made to it. `recovered` is whether there was anything to rebuild it
+        from, and `replayed` the number of operations that took
+        """
+        self.store = store
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.queue = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        self.generation, self.replayed = self.recover()
+        # a crash before the first flush leaves only empty logs behind,
+        # which is a fresh store rather than a recovered one
+        self.recovered = os.path.exists(self.path(SNAPSHOT)) or self.replayed > 0
+        # the last log may end in a torn write, so never append to it
+        self.generation += 1
+        self.log = open(self.path(log_name(self.generation)), "ab")
+        self.logged = 0
+        self.compact = True
+        self.failed = False
+        store.journal = self
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def path(self, name):
+        """
+        Returns the path of a file in the journal's directory
+        """
+        return os.path.join(self.directory, name)
+
+    def generations(self):
+        """
+        Returns the generations of the logs in the directory, in order
+        """
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith("log.") and name.endswith(".jsonl"):
+                generations.append(int(name[len("log.") : -len(".jsonl")]))
+        return sorted(generations)
+
+    def recover(self):
+        """
+        Applies the snapshot, and then the logs from the generation it names
+        on, to the store. Returns the last generation found and the number
+        of operations applied
+        """
+        first = 0
+        count = 0
+        try:
+            with open(self.path(SNAPSHOT), "rb") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            pass
+        else:
+            first = snapshot["generation"]
+            for kind, next_id in snapshot["next_ids"].items():
+                self.store.skip_ids(kind, next_id - 1)
+            for op in snapshot["ops"]:
+                self.store.apply(op)
+            count += len(snapshot["ops"])
+        generations = [g for g in self.generations() if g >= first]
+        for generation in generations:
+            count += self.replay(self.path(log_name(generation)))
+        return max(generations + [first]), count
+
+    def replay(self, path):
+        """
+        Applies the operations in a log to the store, stopping at a torn
+        last line, and returns how many there were
+        """
+        count = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    break
+                self.store.apply(op)
+                count += 1
+        return count
+
+    def append(self, op):
+        """
+        Queues an operation to be logged, unless the writer has failed
+        """
+        if not self.failed:
+            self.queue.put(op)
+
+    def run(self):
+        """
+        Logs queued operations until closed, or reports why it had to stop
+        """
+        try:
+            self.write()
+        except Exception:
+            self.failed = True
+            traceback.print_exc()
+            print(
+                "Journal in %s stopped; changes are no longer persisted"
+                % self.directory,
+                file=sys.stderr,
+            )
+
+    def write(self):
+        """
+        Logs queued operations a batch at a time until closed
+        """
+        while True:
+            time.sleep(self.flush_interval)
+            self.store.merge_upvotes()
+            batch = []
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                continue
+            closing = None in batch
+            ops = [op for op in batch if op is not None]
+            self.log.write(
+                b"".join(
+                    json.dumps(op, separators=(",", ":")).encode("utf-8") + b"\n"
+                    for op in ops
+                )
+            )
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.logged += len(ops)
+            if self.logged >= self.snapshot_every or (closing and self.compact):
+                self.snapshot()
+            if closing:
+                self.log.close()
+                return
+
+    def snapshot(self):
+        """
+        Moves on to a new log, writes the store to a snapshot that starts
+        from it, and deletes the logs before it. Operations that were still
+        queued are logged after the snapshot, which may already include
+        them; replaying them again changes nothing
+        """
+        self.log.close()
+        self.generation += 1
+        self.log = open(self.path(log_name(self.generation)), "ab")
+        next_ids, ops = self.store.dump()
+        temporary = self.path(SNAPSHOT + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump(
+                {"generation": self.generation, "next_ids": next_ids, "ops": ops},
+                f,
+                separators=(",", ":"),
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path(SNAPSHOT))
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        for generation in self.generations():
+            if generation < self.generation:
+                os.remove(self.path(log_name(generation)))
+        self.logged = 0
+
+    def close(self, snapshot=True):
+        """
+        Stops journaling, once every queued operation is logged and, if
+        `snapshot`, the log is compacted
+        """
+        if self.writer.is_alive():
+            self.store.merge_upvotes()
+            self.store.journal = None
+            self.compact = snapshot
+            self.queue.put(None)
+            self.writer.join()
@@ -0,0 +1,278 @@
+"""
+Posts and comments kept in a sqlite database, for serving the app from more
+than one process.
+
+A SqliteStore answers the same calls as a Store, but every call is a
+statement against the database, so each worker process sees the writes of
+the others as soon as they commit. Upvotes are added by one UPDATE, which
+sqlite serializes, so none is lost however many processes upvote a post.
+Posts by upvotes are read from an index on (upvotes, id) rather than sorted.
+
+Each thread has its own connection, and the database runs in WAL mode so
+reads never wait on writes. Ids start from 1 rather than 0, since sqlite
+never hands out a lower AUTOINCREMENT id.
+"""
+import sqlite3
+import threading
+
+from rows import RowMap
+
+# Columns of the post and comment tables, as the app returns them
+POST = RowMap("id", "upvotes", "title", "link", "username")
+COMMENT = RowMap("id", "upvotes", "text", "username")
+
+# Comment fields update_comment may set
+COMMENT_FIELDS = ("upvotes", "text", "username")
+
+# The schema, as the methods that create it, in the order they were added.
+# A database's PRAGMA user_version counts the ones it has had run, so new
+# ones go at the end
+MIGRATIONS = ("create_post_table", "create_comment_table", "create_indexes")
+
+# Every fixed statement the store runs, by name, so each is only prepared
+# once per connection
+STATEMENTS = {
+    "posts": "SELECT id, upvotes, title, link, username FROM post ORDER BY id;",
+    "post": "SELECT id, upvotes, title, link, username FROM post WHERE id = ?;",
+    "ranked": "SELECT id, upvotes, title, link, username FROM post ORDER BY upvotes, id LIMIT ? OFFSET ?;",
+    "ranked_reverse": "SELECT id, upvotes, title, link, username FROM post ORDER BY upvotes DESC, id DESC LIMIT ? OFFSET ?;",
+    "insert_post": "INSERT INTO post(upvotes, title, link, username) VALUES (?, ?, ?, ?);",
+    "add_upvotes": "UPDATE post SET upvotes = upvotes + ? WHERE id = ?;",
+    "delete_post": "DELETE FROM post WHERE id = ?;",
+    "comments": "SELECT id, upvotes, text, username FROM comment WHERE post_id = ? ORDER BY id;",
+    "comment": "SELECT id, upvotes, text, username FROM comment WHERE id = ?;",
+    "insert_comment": "INSERT INTO comment(post_id, upvotes, text, username) VALUES (?, ?, ?, ?);",
+    "delete_comments": "DELETE FROM comment WHERE post_id = ?;",
+}
+
+# Room for the statements above, the comment updates built from
+# COMMENT_FIELDS, and a few for BEGIN and PRAGMA
+STATEMENT_CACHE_SIZE = len(STATEMENTS) + 2 ** len(COMMENT_FIELDS) + 8
+
+
+class SqliteStore(object):
+    """
+    Posts and comments in a sqlite database, safe to share between threads
+    and processes
+    """
+
+    def __init__(self, path):
+        """
+        Opens the database at `path`, creating its tables if it has none.
+        `recovered` is whether it already had them
+        """
+        self.path = path
+        self.local = threading.local()
+        self.recovered = self.migrate() > 0
+
+    @property
+    def conn(self):
+        """
+        Returns the calling thread's connection with the database, opening
+        it on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+            self.local.conn = conn
+        return conn
+
+    def schema_version(self):
+        """
+        Using SQL, returns how many of MIGRATIONS the database has had run
+        """
+        return self.conn.execute("PRAGMA user_version;").fetchone()[0]
+
+    def migrate(self):
+        """
+        Using SQL, runs the MIGRATIONS the database hasn't had yet in one
+        transaction, switching a new database file to WAL mode first.
+        Returns how many it had had, as read under the write lock, so of the
+        processes opening a new database at once only one sees 0
+        """
+        version = self.schema_version()
+        if version >= len(MIGRATIONS):
+            return version
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            # another process may have migrated it while we waited for the lock
+            version = self.schema_version()
+            for name in MIGRATIONS[version:]:
+                getattr(self, name)()
+            if version < len(MIGRATIONS):
+                self.conn.execute("PRAGMA user_version = %d;" % len(MIGRATIONS))
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return version
+
+    def create_post_table(self):
+        """
+        Using SQL, creates the post table
+        """
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS post(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            upvotes INTEGER NOT NULL,
+            title TEXT,
+            link TEXT,
+            username TEXT
+            );"""
+        )
+
+    def create_comment_table(self):
+        """
+        Using SQL, creates the comment table
+        """
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS comment(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            upvotes INTEGER NOT NULL,
+            text TEXT,
+            username TEXT
+            );"""
+        )
+
+    def create_indexes(self):
+        """
+        Using SQL, creates the indexes for ranking posts by upvotes and for
+        listing a post's comments
+        """
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS post_ranking ON post(upvotes, id);"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS comment_post ON comment(post_id, id);"
+        )
+
+    def get_posts(self):
+        """
+        Using SQL, returns every post, ordered by id
+        """
+        return POST.many(self.conn.execute(STATEMENTS["posts"]).fetchall())
+
+    def get_ranked_posts(self, reverse=False, offset=0, limit=None):
+        """
+        Using SQL, returns `limit` posts (or all of them) from `offset` on,
+        ordered by upvotes and then id, or the other way around with
+        `reverse`
+        """
+        cursor = self.conn.execute(
+            STATEMENTS["ranked_reverse" if reverse else "ranked"],
+            (-1 if limit is None else limit, offset),
+        )
+        return POST.many(cursor.fetchall())
+
+    def get_post(self, post_id):
+        """
+        Using SQL, returns a post by id, or None if there is none
+        """
+        return POST.one(self.conn.execute(STATEMENTS["post"], (post_id,)).fetchone())
+
+    def create_post(self, title, link, username, upvotes=1):
+        """
+        Using SQL, adds a post and returns it
+        """
+        cursor = self.conn.execute(
+            STATEMENTS["insert_post"], (upvotes, title, link, username)
+        )
+        self.conn.commit()
+        return {
+            "id": cursor.lastrowid,
+            "upvotes": upvotes,
+            "title": title,
+            "link": link,
+            "username": username,
+        }
+
+    def add_upvotes(self, post_id, upvotes):
+        """
+        Using SQL, adds `upvotes` to a post's upvotes and returns it, or None
+        if there is none
+        """
+        cursor = self.conn.execute(STATEMENTS["add_upvotes"], (upvotes, post_id))
+        if cursor.rowcount == 0:
+            self.conn.rollback()
+            return None
+        # read in the same transaction, so it is this upvote's total
+        post = self.get_post(post_id)
+        self.conn.commit()
+        return post
+
+    def delete_post(self, post_id):
+        """
+        Using SQL, removes a post along with its comments and returns it, or
+        None if there is none
+        """
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            post = self.get_post(post_id)
+            if post is not None:
+                self.conn.execute(STATEMENTS["delete_comments"], (post_id,))
+                self.conn.execute(STATEMENTS["delete_post"], (post_id,))
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return post
+
+    def get_comments(self, post_id):
+        """
+        Using SQL, returns the comments on a post, oldest first, or None if
+        there is no such post
+        """
+        self.conn.execute("BEGIN;")
+        try:
+            if self.get_post(post_id) is None:
+                return None
+            cursor = self.conn.execute(STATEMENTS["comments"], (post_id,))
+            return COMMENT.many(cursor.fetchall())
+        finally:
+            self.conn.rollback()
+
+    def get_comment(self, comment_id):
+        """
+        Using SQL, returns a comment by id, or None if there is none
+        """
+        cursor = self.conn.execute(STATEMENTS["comment"], (comment_id,))
+        return COMMENT.one(cursor.fetchone())
+
+    def create_comment(self, post_id, text, username, upvotes=1):
+        """
+        Using SQL, adds a comment on a post and returns it. The post isn't
+        checked, so callers that need it to exist look it up first
+        """
+        cursor = self.conn.execute(
+            STATEMENTS["insert_comment"], (post_id, upvotes, text, username)
+        )
+        self.conn.commit()
+        return {
+            "id": cursor.lastrowid,
+            "upvotes": upvotes,
+            "text": text,
+            "username": username,
+        }
+
+    def update_comment(self, comment_id, **fields):
+        """
+        Using SQL, sets fields of a comment and returns it, or None if there
+        is none
+        """
+        for name in fields:
+            if name not in COMMENT_FIELDS:
+                raise ValueError("Unknown comment field %r" % (name,))
+        names = sorted(fields)
+        cursor = self.conn.execute(
+            "UPDATE comment SET %s WHERE id = ?;"
+            % ", ".join("%s = ?" % name for name in names),
+            [fields[name] for name in names] + [comment_id],
+        )
+        if cursor.rowcount == 0:
+            self.conn.rollback()
+            return None
+        comment = self.get_comment(comment_id)
+        self.conn.commit()
+        return comment
@@ -0,0 +1,384 @@
+"""
+In-memory storage for the app's posts and comments.
+
+Posts and comments are spread over NUM_SHARDS shards by id, each with its
+own lock, so requests on different posts don't wait on each other. A post's
+shard also keeps the ids of its comments, so listing them only touches that
+post's comments. Everything handed out is a copy, which callers can encode
+or change without holding a lock.
+
+Posts are also ranked by (upvotes, id) in a sorted list that every write
+keeps up to date, so a page of posts by upvotes is found in O(log n + k)
+instead of sorting every post.
+
+Upvotes are added to a StripedCounter rather than to the post, so that
+requests upvoting the same post don't all wait on its shard's lock. A post
+is read as its stored upvotes plus those pending in the counter. Pending
+upvotes are merged into their posts, and the ranking, before anything that
+needs the ranking or every post, and whenever the journal flushes.
+
+A store given a journal (see persistence.py) reports each change to it as
+an operation that sets what changed to its new state. Operations are
+reported under the lock the change was made under, so those on any one
+post or comment reach the journal in the order they happened, and apply()
+redoes them.
+"""
+import threading
+
+from sortedcontainers import SortedList
+
+from counters import StripedCounter
+
+NUM_SHARDS = 16
+
+
+class Shard(object):
+    """
+    The posts and comments whose id falls in one shard, the comment ids of
+    each of those posts, and the lock guarding all three
+    """
+
+    def __init__(self):
+        """
+        Creates an empty shard
+        """
+        self.lock = threading.Lock()
+        self.posts = {}
+        self.comments = {}
+        # post id -> ids of its comments (as dict keys), oldest first
+        self.post_comments = {}
+        # odd while pending upvotes are being merged into the shard's posts
+        self.merges = 0
+
+
+class Store(object):
+    """
+    Thread-safe posts and comments, with ids handed out in increasing order
+    """
+
+    def __init__(self):
+        """
+        Creates an empty store
+        """
+        self.shards = [Shard() for _ in range(NUM_SHARDS)]
+        self.ids_lock = threading.Lock()
+        self.next_ids = {"post": 0, "comment": 0}
+        # (upvotes, id) of every post. Taken inside a shard's lock, never
+        # the other way around
+        self.ranking_lock = threading.Lock()
+        self.ranking = SortedList()
+        self.upvotes = StripedCounter()
+        self.journal = None
+
+    def shard(self, id):
+        """
+        Returns the shard holding the post or comment with `id`
+        """
+        return self.shards[id % NUM_SHARDS]
+
+    def next_id(self, kind):
+        """
+        Returns a new id for a "post" or "comment"
+        """
+        with self.ids_lock:
+            id = self.next_ids[kind]
+            self.next_ids[kind] = id + 1
+            return id
+
+    def skip_ids(self, kind, id):
+        """
+        Makes sure no id up to `id` is handed out again for a "post" or
+        "comment"
+        """
+        with self.ids_lock:
+            self.next_ids[kind] = max(self.next_ids[kind], id + 1)
+
+    def record(self, *op):
+        """
+        Passes an operation to the journal, if there is one. Called with the
+        lock of what the operation changed held
+        """
+        if self.journal is not None:
+            self.journal.append(op)
+
+    def get_posts(self):
+        """
+        Returns every post, ordered by id
+        """
+        self.merge_upvotes()
+        posts = []
+        for shard in self.shards:
+            with shard.lock:
+                posts.extend(dict(post) for post in shard.posts.values())
+        posts.sort(key=lambda post: post["id"])
+        return posts
+
+    def get_ranked_posts(self, reverse=False, offset=0, limit=None):
+        """
+        Returns `limit` posts (or all of them) from `offset` on, ordered by
+        upvotes and then id, or the other way around with `reverse`. A post
+        written after the page was read from the ranking is returned as it
+        is now, and one deleted since is left out
+        """
+        self.merge_upvotes()
+        with self.ranking_lock:
+            total = len(self.ranking)
+            offset = min(offset, total)
+            stop = total if limit is None else min(total, offset + limit)
+            if reverse:
+                start, stop = total - stop, total - offset
+            else:
+                start = offset
+            keys = list(self.ranking.islice(start, stop, reverse=reverse))
+        posts = []
+        for _, post_id in keys:
+            post = self.get_post(post_id)
+            if post is not None:
+                posts.append(post)
+        return posts
+
+    def get_post(self, post_id):
+        """
+        Returns a post by id, or None if there is none. The shard isn't
+        locked unless upvotes are merged into it during the read, which
+        could count them twice or not at all
+        """
+        shard = self.shard(post_id)
+        merges = shard.merges
+        post = self.read_post(shard, post_id)
+        if merges % 2 == 0 and shard.merges == merges:
+            return post
+        with shard.lock:
+            return self.read_post(shard, post_id)
+
+    def read_post(self, shard, post_id):
+        """
+        Returns a copy of a post in `shard` with its pending upvotes added,
+        or None if there is none
+        """
+        post = shard.posts.get(post_id)
+        if post is None:
+            return None
+        post = dict(post)
+        post["upvotes"] += self.upvotes.pending(post_id)
+        return post
+
+    def create_post(self, title, link, username, upvotes=1):
+        """
+        Adds a post and returns it
+        """
+        post = {
+            "id": self.next_id("post"),
+            "upvotes": upvotes,
+            "title": title,
+            "link": link,
+            "username": username,
+        }
+        return self.put_post(post)
+
+    def put_post(self, post):
+        """
+        Stores `post` in place of any post with its id, and returns it
+        """
+        post_id = post["id"]
+        shard = self.shard(post_id)
+        with shard.lock:
+            old = shard.posts.get(post_id)
+            with self.ranking_lock:
+                if old is not None:
+                    self.ranking.remove((old["upvotes"], post_id))
+                self.ranking.add((post["upvotes"], post_id))
+            shard.posts[post_id] = post
+            self.record("post", dict(post))
+            return dict(post)
+
+    def add_upvotes(self, post_id, upvotes):
+        """
+        Adds `upvotes` to a post's upvotes and returns it, or None if there
+        is none. The post's shard isn't locked
+        """
+        if post_id not in self.shard(post_id).posts:
+            return None
+        self.upvotes.add(post_id, upvotes)
+        return self.get_post(post_id)
+
+    def merge_upvotes(self):
+        """
+        Adds the pending upvotes of every post to it, and moves it in the
+        ranking. Upvotes for deleted posts are dropped
+        """
+        by_shard = {}
+        for post_id in self.upvotes.keys():
+            by_shard.setdefault(post_id % NUM_SHARDS, []).append(post_id)
+        for index, post_ids in by_shard.items():
+            shard = self.shards[index]
+            with shard.lock:
+                shard.merges += 1
+                for post_id in post_ids:
+                    upvotes = self.upvotes.drain(post_id)
+                    post = shard.posts.get(post_id)
+                    if post is None or upvotes == 0:
+                        continue
+                    with self.ranking_lock:
+                        self.ranking.remove((post["upvotes"], post_id))
+                        post["upvotes"] += upvotes
+                        self.ranking.add((post["upvotes"], post_id))
+                    self.record("post", dict(post))
+                shard.merges += 1
+
+    def delete_post(self, post_id):
+        """
+        Removes a post along with its comments and returns it, or None if
+        there is none
+        """
+        shard = self.shard(post_id)
+        with shard.lock:
+            post = shard.posts.pop(post_id, None)
+            if post is None:
+                return None
+            with self.ranking_lock:
+                self.ranking.remove((post["upvotes"], post_id))
+            self.upvotes.drain(post_id)
+            comment_ids = shard.post_comments.pop(post_id, ())
+            self.record("delete_post", post_id)
+        for comment_id in comment_ids:
+            self.delete_comment(comment_id)
+        return post
+
+    def get_comments(self, post_id):
+        """
+        Returns the comments on a post, oldest first, or None if there is no
+        such post
+        """
+        shard = self.shard(post_id)
+        with shard.lock:
+            if post_id not in shard.posts:
+                return None
+            comment_ids = list(shard.post_comments.get(post_id, ()))
+        comments = []
+        for comment_id in comment_ids:
+            comment = self.get_comment(comment_id)
+            if comment is not None:
+                comments.append(comment)
+        return comments
+
+    def get_comment(self, comment_id):
+        """
+        Returns a comment by id, or None if there is none
+        """
+        shard = self.shard(comment_id)
+        with shard.lock:
+            comment = shard.comments.get(comment_id)
+            return None if comment is None else dict(comment)
+
+    def create_comment(self, post_id, text, username, upvotes=1):
+        """
+        Adds a comment on a post and returns it. The post isn't checked, so
+        callers that need it to exist look it up first
+        """
+        comment = {
+            "id": self.next_id("comment"),
+            "upvotes": upvotes,
+            "text": text,
+            "username": username,
+        }
+        return self.add_comment(post_id, comment)
+
+    def add_comment(self, post_id, comment):
+        """
+        Stores `comment` on a post and returns it. A comment already stored
+        under its id is kept as it is, and only indexed
+        """
+        comment_id = comment["id"]
+        shard = self.shard(comment_id)
+        with shard.lock:
+            comment = shard.comments.setdefault(comment_id, comment)
+            comment = dict(comment)
+        # indexed only once stored, so every indexed id can be looked up
+        shard = self.shard(post_id)
+        with shard.lock:
+            shard.post_comments.setdefault(post_id, {})[comment_id] = None
+            self.record("comment", post_id, comment)
+        return comment
+
+    def put_comment(self, comment):
+        """
+        Stores `comment` in place of any comment with its id, without
+        indexing it, and returns it
+        """
+        shard = self.shard(comment["id"])
+        with shard.lock:
+            shard.comments[comment["id"]] = comment
+            self.record("edit_comment", dict(comment))
+            return dict(comment)
+
+    def update_comment(self, comment_id, **fields):
+        """
+        Sets fields of a comment and returns it, or None if there is none
+        """
+        shard = self.shard(comment_id)
+        with shard.lock:
+            comment = shard.comments.get(comment_id)
+            if comment is None:
+                return None
+            comment.update(fields)
+            self.record("edit_comment", dict(comment))
+            return dict(comment)
+
+    def delete_comment(self, comment_id):
+        """
+        Removes a comment, leaving it in its post's index
+        """
+        shard = self.shard(comment_id)
+        with shard.lock:
+            if shard.comments.pop(comment_id, None) is not None:
+                self.record("delete_comment", comment_id)
+
+    def apply(self, op):
+        """
+        Redoes an operation passed to the journal. Redoing operations whose
+        changes are already in the store leaves it as it was, as long as
+        they are redone in order
+        """
+        kind = op[0]
+        if kind == "post":
+            self.skip_ids("post", op[1]["id"])
+            self.put_post(op[1])
+        elif kind == "delete_post":
+            self.delete_post(op[1])
+        elif kind == "comment":
+            self.skip_ids("comment", op[2]["id"])
+            self.add_comment(op[1], op[2])
+        elif kind == "edit_comment":
+            self.skip_ids("comment", op[1]["id"])
+            self.put_comment(op[1])
+        elif kind == "delete_comment":
+            self.delete_comment(op[1])
+        else:
+            raise ValueError("Unknown operation %r" % (kind,))
+
+    def dump(self):
+        """
+        Returns the ids to continue from, and operations that rebuild the
+        whole store when applied to an empty one. Each shard is read under
+        its lock, so a write made meanwhile may or may not be included
+        """
+        self.merge_upvotes()
+        with self.ids_lock:
+            next_ids = dict(self.next_ids)
+        ops = []
+        comments = []
+        for shard in self.shards:
+            with shard.lock:
+                ops.extend(("post", dict(post)) for post in shard.posts.values())
+                comments.extend(
+                    (comment_id, post_id)
+                    for post_id, comment_ids in shard.post_comments.items()
+                    for comment_id in comment_ids
+                )
+        comments.sort()
+        for comment_id, post_id in comments:
+            comment = self.get_comment(comment_id)
+            if comment is not None:
+                ops.append(("comment", post_id, comment))
+        return next_ids, ops
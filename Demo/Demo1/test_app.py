@@ -0,0 +1,14 @@
+"""
+Tests for the posts app.
+
+Run from this directory with `python -m pytest`.
+"""
+import app
+from bench import stress
+
+
+def test_concurrent_upvotes_are_each_counted_once(monkeypatch):
+    # stress puts a new store in the app, so put the seeded one back after
+    monkeypatch.setattr(app, "store", app.store)
+    _, errors = stress(writers=64, upvotes=50)
+    assert errors == []
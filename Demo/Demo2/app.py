@@ -1,6 +1,8 @@
 import json
 from flask import Flask, request
 import db
+from response import success_response, failure_response, stream_response
+from response import make_etag
 
 app = Flask(__name__)
 
@@ -9,8 +11,9 @@ DB = db.DatabaseDriver()
 @app.route("/")
 @app.route("/tasks/")
 def get_tasks():
-    """Endpoint for getting all tasks"""
-    return json.dumps({"tasks": DB.get_all_tasks()}), 200
+    """Endpoint for getting all tasks, or a 304 if the client has them"""
+    etag = make_etag(db.TASK_LIST, DB.get_version(db.TASK_LIST))
+    return stream_response("tasks", DB.iter_all_tasks(), etag=etag)
 
 
 @app.route("/tasks/", methods=["POST"])
@@ -21,8 +24,8 @@ def create_task():
     task_id = DB.insert_task_table(description, False)
     task = DB.get_task_by_id(task_id)
     if task is None:
-        return json.dumps({"error":"Creating this task did not work!"}), 400
-    return json.dumps(task), 200
+        return failure_response("Creating this task did not work!", 400)
+    return success_response(task)
 
 
 @app.route("/tasks/<int:task_id>/")
@@ -30,8 +33,8 @@ def get_task(task_id):
     """Endpoint for getting a task by ID"""
     task = DB.get_task_by_id(task_id)
     if task is None:
-        return json.dumps({"error":"Task not found!"}), 404
-    return json.dumps(task), 200
+        return failure_response("Task not found!")
+    return success_response(task)
 
 
 @app.route("/tasks/<int:task_id>/", methods=["POST"])
@@ -43,8 +46,8 @@ def update_task(task_id):
     DB.update_task_by_id(description, done, task_id)
     task = DB.get_task_by_id(task_id)
     if task is None:
-        return json.dumps({"error":"Updating this task did not work!"}), 404
-    return json.dumps(task), 200
+        return failure_response("Updating this task did not work!")
+    return success_response(task)
 
 
 @app.route("/tasks/<int:task_id>/", methods=["DELETE"])
@@ -52,9 +55,15 @@ def delete_task(task_id):
     """Endpoint for deleting a task"""
     task = DB.get_task_by_id(task_id)
     if task is None:
-        return json.dumps({"error":"Task not found"}), 404
+        return failure_response("Task not found")
     DB.delete_task_by_id(task_id)
-    return json.dumps(task), 200
+    return success_response(task)
+
+
+@app.route("/cache/")
+def get_task_cache_stats():
+    """Endpoint for getting the task cache counters"""
+    return success_response(DB.task_cache.stats())
 
 
 if __name__ == "__main__":
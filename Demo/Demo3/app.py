@@ -1,28 +1,22 @@
 import json
 from flask import Flask, request
 import db
+from response import success_response, failure_response, stream_response
+from response import make_etag
 
 DB = db.DatabaseDriver()
 
 app = Flask(__name__)
 
 
-# generalized response formats
-def success_response(body, code=200):
-    return json.dumps(body), code
-
-
-def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
-
-
 @app.route("/")
 @app.route("/tasks/")
 def get_tasks():
     """
-    Endpoint for getting all tasks
+    Endpoint for getting all tasks, or a 304 if the client has them
     """
-    return success_response({"tasks": DB.get_all_tasks()})
+    etag = make_etag(db.TASK_LIST, DB.get_version(db.TASK_LIST))
+    return stream_response("tasks", DB.iter_all_tasks(), etag=etag)
 
 
 @app.route("/tasks/", methods=["POST"])
@@ -108,7 +102,15 @@ def get_subtasks_of_task(task_id):
 @app.route("/subtasks/")
 def get_subtasks():
     """Endpoint for getting all the subtasks."""
-    return success_response({"subtasks": DB.get_all_subtasks()})
+    return stream_response("subtasks", DB.iter_all_subtasks())
+
+
+@app.route("/cache/")
+def get_cache_stats():
+    """Endpoint for getting the task and subtask cache counters"""
+    return success_response(
+        {"tasks": DB.task_cache.stats(), "subtasks": DB.subtask_cache.stats()}
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping with a size bound.
+    Once full, storing a new key evicts the least recently used one. With a
+    ttl, entries are also forgotten that many seconds after being stored.
+    """
+
+    # Marks a lookup that found nothing, since None can be a cached value
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl=None):
+        """
+        Creates an empty cache of at most `maxsize` entries
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # key -> [loads in flight, invalidations seen], see get_or_load
+        self.loading = {}
+
+    def get(self, key, default=None, valid=None):
+        """
+        Returns the value stored for `key`, or `default` if there is none.
+        With `valid`, a stored value that valid(value) rejects is treated as
+        missing, and counted as a miss rather than a hit
+        """
+        with self.lock:
+            return self.lookup(key, default, valid)
+
+    def lookup(self, key, default, valid=None):
+        """
+        Does the work of get; the caller must hold the lock
+        """
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and entry[1] < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is None or (valid is not None and not valid(entry[0])):
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def get_or_load(self, key, load):
+        """
+        Returns the value stored for `key`, calling load() and storing what
+        it returns on a miss. None is returned but never stored. A value
+        whose key was invalidated while it was being loaded isn't stored
+        either, since it may predate the write that invalidated it
+        """
+        with self.lock:
+            value = self.lookup(key, self.MISSING)
+            if value is not self.MISSING:
+                return value
+            loading = self.loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            seen = loading[1]
+        value = None
+        try:
+            value = load()
+        finally:
+            with self.lock:
+                loading[0] -= 1
+                if loading[0] == 0:
+                    del self.loading[key]
+                if value is not None and loading[1] == seen:
+                    self.store(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores `value` for `key`, evicting the least recently used entry if
+        the cache is full
+        """
+        with self.lock:
+            self.store(key, value)
+
+    def store(self, key, value):
+        """
+        Does the work of put; the caller must hold the lock
+        """
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Forgets the value stored for `key`, if any
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            if key in self.loading:
+                self.loading[key][1] += 1
+
+    def stats(self):
+        """
+        Returns the size and hit/miss/eviction counters of the cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
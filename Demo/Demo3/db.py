@@ -1,4 +1,51 @@
+import os
 import sqlite3
+import threading
+
+from cache import LRUCache
+from rows import RowMap
+
+# Listings are read from the database this many rows at a time
+FETCH_SIZE = 1000
+
+# At most this many tasks, and subtask lists, are cached. Writes only drop the
+# entries of the process that made them, so with more than one worker process
+# TASK_CACHE_SIZE=0 turns caching off, as gunicorn.conf.py does
+TASK_CACHE_SIZE = int(os.environ.get("TASK_CACHE_SIZE", 10000))
+
+# The task listing's version in the versions table, bumped by every task write
+TASK_LIST = "tasks"
+
+# Columns of the tasks and subtasks tables
+TASK = RowMap("id", "description", ("done", bool))
+SUBTASK = RowMap("id", "description", ("done", bool), "task_id")
+
+# The schema, as the driver methods that create it, in the order they were
+# added. A database's PRAGMA user_version counts the ones it has had run, so
+# new ones go at the end
+MIGRATIONS = ("create_task_table", "create_subtask_table", "create_versions_table")
+
+# Every statement the driver runs, by name. sqlite3 caches prepared
+# statements per connection, keyed by their SQL, so each of these is only
+# prepared once per connection
+STATEMENTS = {
+    "tasks": "SELECT * FROM tasks;",
+    "task": "SELECT * FROM tasks WHERE id = ?;",
+    "insert_task": "INSERT INTO tasks (description, done) VALUES (?, ?);",
+    "update_task": "UPDATE tasks SET description = ?, done = ? WHERE id = ?;",
+    "delete_task": "DELETE FROM tasks WHERE id = ?;",
+    "version": "SELECT version FROM versions WHERE resource = ?;",
+    "bump_version": """INSERT INTO versions(resource, version) VALUES (?, 1)
+        ON CONFLICT(resource) DO UPDATE SET version = version + 1;""",
+    "subtasks": "SELECT * FROM subtasks;",
+    "subtask": "SELECT * FROM subtasks WHERE id = ?;",
+    "subtasks_of_task": "SELECT * FROM subtasks WHERE task_id = ?;",
+    "insert_subtask": "INSERT INTO subtasks (description, done, task_id) VALUES (?, ?, ?);",
+}
+
+# Each connection's statement cache holds every statement above, plus a few
+# for BEGIN and PRAGMA, so none of them is ever evicted and prepared again
+STATEMENT_CACHE_SIZE = len(STATEMENTS) + 8
 
 
 # From: https://goo.gl/YzypOI
@@ -21,12 +68,54 @@ class DatabaseDriver(object):
 
     def __init__(self):
         """
-        Secures a connection with the database and stores it into the
-        instance variable `conn`
+        Sets up per-thread connections with the database and brings its
+        schema up to date
+        """
+        self.local = threading.local()
+        self.task_cache = LRUCache(TASK_CACHE_SIZE)
+        self.subtask_cache = LRUCache(TASK_CACHE_SIZE)
+        self.migrate()
+
+    @property
+    def conn(self):
+        """
+        Returns the calling thread's connection with the database, opening
+        it on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect("todo.db", cached_statements=STATEMENT_CACHE_SIZE)
+            self.local.conn = conn
+        return conn
+
+    def schema_version(self):
+        """
+        Using SQL, returns how many of MIGRATIONS the database has had run
         """
-        self.conn = sqlite3.connect("todo.db", check_same_thread=False)
-        self.create_task_table()
-        self.create_subtask_table()
+        return self.conn.execute("PRAGMA user_version;").fetchone()[0]
+
+    def migrate(self):
+        """
+        Using SQL, runs the MIGRATIONS the database hasn't had yet in one
+        transaction, and switches a new database file to WAL mode so readers
+        never wait on writers. On an up-to-date database this is a single
+        PRAGMA read, so starting a worker runs no DDL
+        """
+        if self.schema_version() >= len(MIGRATIONS):
+            return
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            # another worker may have migrated it while we waited for the lock
+            version = self.schema_version()
+            for name in MIGRATIONS[version:]:
+                getattr(self, name)()
+            if version < len(MIGRATIONS):
+                self.conn.execute("PRAGMA user_version = %d;" % len(MIGRATIONS))
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
 
     # -- TASKS -----------------------------------------------------------
 
@@ -57,58 +146,91 @@ class DatabaseDriver(object):
         """
         Using SQL, gets all tasks in the task table
         """
-        cursor = self.conn.execute("SELECT * FROM tasks;")
-        tasks = []
+        return list(self.iter_all_tasks())
 
-        for row in cursor:
-            tasks.append({"id": row[0], "description": row[1], "done": bool(row[2])})
-        return tasks
+    def iter_all_tasks(self):
+        """
+        Using SQL, yields every task in the task table, fetching FETCH_SIZE
+        rows at a time
+        """
+        cursor = self.conn.execute(STATEMENTS["tasks"])
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from TASK.many(rows)
 
     def insert_task_table(self, description, done):
         """
         Using SQL, adds a new task in the task table
         """
-        cursor = self.conn.execute(
-            "INSERT INTO tasks (description, done) VALUES (?, ?);", (description, done)
-        )
+        cursor = self.conn.execute(STATEMENTS["insert_task"], (description, done))
+        self.bump_versions([TASK_LIST])
         self.conn.commit()
         return cursor.lastrowid
 
     def get_task_by_id(self, id):
         """
-        Using SQL, gets a task by id
+        Gets a task by id. Tasks are cached until they are written to
+        """
+        task = self.task_cache.get_or_load(id, lambda: self.load_task_by_id(id))
+        return None if task is None else dict(task)
+
+    def load_task_by_id(self, id):
+        """
+        Using SQL, gets a task by id, bypassing the cache
         """
-        cursor = self.conn.execute("SELECT * FROM tasks WHERE id = ?", (id,))
-        for row in cursor:
-            return {"id": row[0], "description": row[1], "done": bool(row[2])}
-        return None
+        cursor = self.conn.execute(STATEMENTS["task"], (id,))
+        return TASK.one(cursor.fetchone())
 
     def update_task_by_id(self, id, description, done):
         """
         Using SQL, updates a task by id
         """
-        self.conn.execute(
-            """
-            UPDATE tasks
-            SET description = ?, done = ?
-            WHERE id = ?;
-        """,
-            (description, done, id),
-        )
+        self.conn.execute(STATEMENTS["update_task"], (description, done, id))
+        self.bump_versions([TASK_LIST])
         self.conn.commit()
+        self.task_cache.invalidate(id)
 
     def delete_task_by_id(self, id):
         """
         Using SQL, deletes a task by id
         """
+        self.conn.execute(STATEMENTS["delete_task"], (id,))
+        self.bump_versions([TASK_LIST])
+        self.conn.commit()
+        self.task_cache.invalidate(id)
+
+    # -- VERSIONS --------------------------------------------------------
+
+    def create_versions_table(self):
+        """
+        Using SQL, creates a table of version counters by resource name. A
+        write bumps the versions of what it changes in its own transaction
+        """
         self.conn.execute(
-            """
-            DELETE FROM tasks
-            WHERE id = ?;
-        """,
-            (id,),
+            """CREATE TABLE IF NOT EXISTS versions(
+            resource TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+            );"""
+        )
+
+    def get_version(self, resource):
+        """
+        Using SQL, returns the version of a resource, 0 if it was never written
+        """
+        cursor = self.conn.execute(STATEMENTS["version"], (resource,))
+        row = cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    def bump_versions(self, resources):
+        """
+        Using SQL, increments the version of each resource inside the current
+        transaction, so the new versions commit along with the write
+        """
+        self.conn.executemany(
+            STATEMENTS["bump_version"], [(resource,) for resource in resources]
         )
-        self.conn.commit()
 
     # -- SUBTASKS --------------------------------------------------------
 
@@ -138,63 +260,53 @@ class DatabaseDriver(object):
         """
         Using SQL, get all subtasks.
         """
-        cursor = self.conn.execute("SELECT * FROM subtasks")
-        subtasks = []
-        for row in cursor:
-            subtasks.append(
-                {
-                    "id": row[0],
-                    "description": row[1],
-                    "done": bool(row[2]),
-                    "task_id": row[3],
-                }
-            )
-        return subtasks
+        return list(self.iter_all_subtasks())
+
+    def iter_all_subtasks(self):
+        """
+        Using SQL, yields every subtask, fetching FETCH_SIZE rows at a time
+        """
+        cursor = self.conn.execute(STATEMENTS["subtasks"])
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from SUBTASK.many(rows)
 
     def insert_subtask(self, description, done, parent_id):
         """
         Using SQL, add a new subtask into the subtask table
         """
         cursor = self.conn.execute(
-            "INSERT INTO subtasks (description, done, task_id) VALUES (?, ?, ?);",
-            (description, done, parent_id),
+            STATEMENTS["insert_subtask"], (description, done, parent_id)
         )
         self.conn.commit()
+        self.subtask_cache.invalidate(parent_id)
         return cursor.lastrowid
 
     def get_subtask_by_id(self, id):
         """
         Using SQL, get a subtask by its id
         """
-        cursor = self.conn.execute("SELECT * FROM subtasks where ID = ?", (id,))
-        for row in cursor:
-            return {
-                "id": row[0],
-                "description": row[1],
-                "done": bool(row[2]),
-                "task_id": row[3],
-            }
-        return None
+        cursor = self.conn.execute(STATEMENTS["subtask"], (id,))
+        return SUBTASK.one(cursor.fetchone())
 
     def get_subtasks_of_task(self, parent_id):
         """
-        Using SQL, get all the subtasks given a task id.
+        Get all the subtasks given a task id. Each task's subtasks are cached
+        until one is added
         """
-        cursor = self.conn.execute(
-            "SELECT * FROM subtasks WHERE task_id = ?", (parent_id,)
+        subtasks = self.subtask_cache.get_or_load(
+            parent_id, lambda: self.load_subtasks_of_task(parent_id)
         )
-        subtasks = []
-
-        for row in cursor:
-            subtasks.append(
-                {
-                    "id": row[0],
-                    "description": row[1],
-                    "done": bool(row[2]),
-                    "task_id": row[3],
-                }
-            )
-        return subtasks
+        return [dict(subtask) for subtask in subtasks]
+
+    def load_subtasks_of_task(self, parent_id):
+        """
+        Using SQL, get all the subtasks given a task id, bypassing the cache
+        """
+        cursor = self.conn.execute(STATEMENTS["subtasks_of_task"], (parent_id,))
+        return SUBTASK.many(cursor.fetchall())
 
 
 # Only <=1 instance of the database driver
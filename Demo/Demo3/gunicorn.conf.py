@@ -0,0 +1,20 @@
+"""
+Gunicorn settings for serving the app in production. From this directory,
+
+    gunicorn app:app
+
+runs WORKERS processes (one per core by default), each serving requests on
+THREADS threads, on port PORT. `python app.py` still runs Flask's debug
+server for development.
+"""
+import multiprocessing
+import os
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", 8000)
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("THREADS", 4))
+
+# Writes only drop the cached tasks of the process that made them, so the
+# cache is off unless there is a single worker
+if workers > 1:
+    raw_env = ["TASK_CACHE_SIZE=0"]
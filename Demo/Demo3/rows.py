@@ -0,0 +1,56 @@
+"""
+Mapping of database rows to JSON-ready dicts.
+
+A RowMap names the columns of one kind of row once, and turns a whole fetch
+of rows into dicts with one list comprehension that zips those names with
+each row. Listings map FETCH_SIZE rows at a time and stream_json encodes
+each batch with one dumps call.
+"""
+from operator import itemgetter
+
+
+class RowMap(object):
+    """
+    Turns sqlite rows into dicts. Each field names the key for the column at
+    its position, as a key, a (key, converter) pair, or None for a column
+    that isn't returned
+    """
+
+    def __init__(self, *fields):
+        """
+        Sets up the mapping for rows with columns laid out like `fields`
+        """
+        columns = [column for column, field in enumerate(fields) if field is not None]
+        fields = [
+            field if isinstance(field, tuple) else (field, None) for field in fields
+        ]
+        self.keys = tuple(key for key, _ in fields if key is not None)
+        self.converters = [(key, convert) for key, convert in fields if convert]
+        if columns == list(range(len(columns))):
+            # zip stops at the last key, so trailing columns need no picking
+            self.select = None
+        elif len(columns) == 1:
+            self.select = lambda row: (row[columns[0]],)
+        else:
+            self.select = itemgetter(*columns)
+
+    def many(self, rows):
+        """
+        Returns the dicts of a list of rows
+        """
+        keys = self.keys
+        if self.select is None:
+            items = [dict(zip(keys, row)) for row in rows]
+        else:
+            select = self.select
+            items = [dict(zip(keys, select(row))) for row in rows]
+        for key, convert in self.converters:
+            for item in items:
+                item[key] = convert(item[key])
+        return items
+
+    def one(self, row):
+        """
+        Returns the dict of a row, or None if `row` is None
+        """
+        return None if row is None else self.many((row,))[0]
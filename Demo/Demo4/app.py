@@ -5,6 +5,10 @@ from flask import Flask, request
 from db import Task
 from db import Subtask
 from db import Category
+from db import TASK_LIST, bump_versions, get_version, task_resource
+from response import success_response, failure_response
+from response import fresh, make_etag, not_modified_response
+from cache import LRUCache
 
 # define db filename
 db_filename = "todo.db"
@@ -20,14 +24,66 @@ db.init_app(app)
 with app.app_context():
     db.create_all()
 
+# (version, serialized task) by id, dropped whenever a write changes what
+# they contain
+TASK_CACHE = LRUCache(10000)
 
-# generalized response formats
-def success_response(data, code=200):
-    return json.dumps(data), code
+
+def load_task(task_id):
+    """
+    Returns (version, serialized task) for the task with id task_id, or None
+    if there is none. The read is retried until the version is the same
+    before and after it, so the two always match
+    """
+    resource = task_resource(task_id)
+    while True:
+        version = get_version(resource)
+        task = Task.query.filter_by(id=task_id).first()
+        serialized = None if task is None else task.serialize()
+        if get_version(resource) == version:
+            return None if serialized is None else (version, serialized)
+        db.session.expire_all()
+
+
+def get_cached_task(task_id):
+    """
+    Returns (version, serialized task) for the task with id task_id from the
+    cache, or None if there is none. A cached task whose version is no longer
+    the database's was changed by another worker process, and is loaded
+    again
+    """
+    entry = TASK_CACHE.get_or_load(task_id, lambda: load_task(task_id))
+    if entry is not None and entry[0] != get_version(task_resource(task_id)):
+        TASK_CACHE.invalidate(task_id)
+        entry = TASK_CACHE.get_or_load(task_id, lambda: load_task(task_id))
+    return entry
+
+
+def related_task_ids(task):
+    """
+    Returns the ids of the task and of every task sharing a category with it,
+    since those serialize it as part of the category
+    """
+    ids = {task.id}
+    for category in task.categories:
+        ids.update(category_task.id for category_task in category.tasks)
+    return ids
+
+
+def tasks_changed(task_ids):
+    """
+    Bumps the versions of the given tasks and of the task listing in the
+    session's transaction; call before committing a write that changes them
+    """
+    bump_versions(TASK_LIST, *map(task_resource, task_ids))
 
 
-def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+def invalidate_tasks(task_ids):
+    """
+    Drops the given tasks from the cache; call after committing the write
+    """
+    for task_id in task_ids:
+        TASK_CACHE.invalidate(task_id)
 
 
 # -- TASK ROUTES ------------------------------------------------------
@@ -37,10 +93,13 @@ def failure_response(message, code=404):
 @app.route("/tasks/")
 def get_tasks():
     """
-    Endpoint for getting all tasks
+    Endpoint for getting all tasks, or a 304 if the client has them
     """
+    etag = make_etag(TASK_LIST, get_version(TASK_LIST))
+    if fresh(etag):
+        return not_modified_response(etag)
     tasks = [task.serialize() for task in Task.query.all()]
-    return success_response({"tasks": tasks})
+    return success_response({"tasks": tasks}, etag=etag)
 
 
 @app.route("/tasks/", methods=["POST"])
@@ -54,6 +113,7 @@ def create_task():
         done = body.get("done")
     )
     db.session.add(new_task)
+    bump_versions(TASK_LIST)
     db.session.commit()
     return success_response(new_task.serialize(), 201)
 
@@ -63,10 +123,10 @@ def get_task(task_id):
     """
     Endpoint for getting a task by id
     """
-    task = Task.query.filter_by(id=task_id).first()
-    if task is None:
+    entry = get_cached_task(task_id)
+    if entry is None:
         return failure_response("Task not found!")
-    return success_response(task.serialize())
+    return success_response(entry[1])
 
 
 @app.route("/tasks/<int:task_id>/", methods=["POST"])
@@ -80,7 +140,10 @@ def update_task(task_id):
         return failure_response("Task not found!")
     task.description = body.get("description", task.description)
     task.done = body.get("done", task.done)
+    related = related_task_ids(task)
+    tasks_changed(related)
     db.session.commit()
+    invalidate_tasks(related)
     return success_response(task.serialize())
 
 
@@ -92,8 +155,11 @@ def delete_task(task_id):
     task = Task.query.filter_by(id=task_id).first()
     if task is None:
         return failure_response("Task not found!")
+    related = related_task_ids(task)
     db.session.delete(task)
+    tasks_changed(related)
     db.session.commit()
+    invalidate_tasks(related)
     return success_response(task.serialize())
 
 
@@ -116,7 +182,10 @@ def create_subtask(task_id):
         task_id = task_id
     )
     db.session.add(new_subtask)
+    related = related_task_ids(task)
+    tasks_changed(related)
     db.session.commit()
+    invalidate_tasks(related)
     return success_response(new_subtask.serialize(), 201)
 
 
@@ -142,9 +211,20 @@ def assign_category(task_id):
     if category is None:
         category = Category(description=description, color=color)
     task.categories.append(category)
+    related = related_task_ids(task)
+    tasks_changed(related)
     db.session.commit()
+    invalidate_tasks(related)
     return success_response(task.serialize())
 
 
+@app.route("/cache/")
+def get_task_cache_stats():
+    """
+    Endpoint for getting the task cache counters
+    """
+    return success_response(TASK_CACHE.stats())
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
@@ -1,7 +1,17 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert
 
 db = SQLAlchemy()
 
+# The task listing's version in the versions table, bumped by every task write
+TASK_LIST = "tasks"
+
+def task_resource(task_id):
+  """
+  Returns the name a task's version is kept under in the versions table
+  """
+  return "task:%d" % task_id
+
 association_table = db.Table(
   "association",
   db.Model.metadata,
@@ -9,6 +19,36 @@ association_table = db.Table(
   db.Column("category_id", db.Integer, db.ForeignKey("category.id"))
 )
 
+class Version(db.Model):
+  """
+  Version counter of a resource, bumped in the same transaction as every
+  write that changes it
+  """
+  __tablename__ = "versions"
+  resource = db.Column(db.String, primary_key=True)
+  version = db.Column(db.Integer, nullable=False)
+
+def get_version(resource):
+  """
+  Returns the version of a resource, 0 if it was never written
+  """
+  version = db.session.query(Version.version).filter_by(resource=resource).scalar()
+  return version or 0
+
+def bump_versions(*resources):
+  """
+  Increments the version of each resource in the session's transaction, so
+  the new versions commit along with the write
+  """
+  for resource in resources:
+    db.session.execute(
+      insert(Version)
+      .values(resource=resource, version=1)
+      .on_conflict_do_update(
+        index_elements=["resource"], set_={"version": Version.version + 1}
+      )
+    )
+
 class Task(db.Model):
   """
   Task Model
@@ -1,7 +1,9 @@
 import json
 from flask import Flask, request
 import db
-import hashlib
+import hashing
+from response import success_response, failure_response, stream_response
+from response import make_etag
 import os
 from dotenv import load_dotenv
 
@@ -14,7 +16,7 @@ app = Flask(__name__)
 @app.route("/api/users/")
 def get_users():
     """Endpoint for getting all users"""
-    return json.dumps({"users": DB.get_all_users()}), 200
+    return stream_response("users", DB.iter_all_users())
 
 
 @app.route("/api/users/", methods=["POST"])
@@ -27,17 +29,19 @@ def create_user():
     user_id = DB.insert_user_table(name, username, balance)
     user = DB.get_user_by_id(user_id)
     if user is None:
-        return json.dumps({"error": "Creating this user did not work!"}), 400
-    return json.dumps(user), 200
+        return failure_response("Creating this user did not work!", 400)
+    return success_response(user)
 
 
 @app.route("/api/users/<int:user_id>/")
 def get_user(user_id):
-    """Endpoint for getting a user by ID"""
-    user = DB.get_user_by_id(user_id)
-    if user is None:
-        return json.dumps({"error": "User not found!"}), 404
-    return json.dumps(user), 200
+    """Endpoint for getting a user by ID, or a 304 if the client has it"""
+    entry = DB.get_versioned_user(user_id)
+    if entry is None:
+        return failure_response("User not found!")
+    version, user = entry
+    etag = make_etag(db.user_resource(user_id), version)
+    return success_response(user, etag=etag)
 
 
 @app.route("/api/users/<int:user_id>/", methods=["DELETE"])
@@ -45,9 +49,10 @@ def delete_user_by_id(user_id):
     """Endpoint for deleting a user"""
     user = DB.get_user_by_id(user_id)
     if user is None:
-        return json.dumps({"error": "User not found"}), 404
+        return failure_response("User not found")
     DB.delete_user_by_id(user_id)
-    return json.dumps(user), 200
+    CREDENTIALS.invalidate(user_id)
+    return success_response(user)
 
 
 @app.route("/api/send/", methods=["POST"])
@@ -57,19 +62,68 @@ def send_money():
     sender_id = body.get("sender_id")
     receiver_id = body.get("receiver_id")
     amount = body.get("amount")
-    DB.update_balances_by_id(sender_id, receiver_id, amount)
-    return (
-        json.dumps(
-            {"sender_id": sender_id, "receiver_id": receiver_id, "amount": amount}
-        ),
-        200,
+    if not db.valid_amount(amount):
+        return failure_response("Bad request", 400)
+    if not DB.update_balances_by_id(sender_id, receiver_id, amount):
+        return failure_response("Insufficient funds!", 403)
+    return success_response(
+        {"sender_id": sender_id, "receiver_id": receiver_id, "amount": amount}
     )
 
 
 # Extra Credit
 
-salt = os.environ.get("PASSWORD_SALT").encode("utf-8")
-iter = int(os.environ.get("NUMBER_OF_ITERATIONS"))
+# Every new hash gets its own salt and PASSWORD_ITERATIONS rounds; the
+# parameters are stored with it, so changing the policy only rehashes
+# users as they next log in. PASSWORD_SALT and NUMBER_OF_ITERATIONS are
+# only needed to verify hashes made before per-user salts
+legacy_salt = os.environ.get("PASSWORD_SALT")
+legacy_salt = legacy_salt.encode("utf-8") if legacy_salt is not None else None
+legacy_iter = os.environ.get("NUMBER_OF_ITERATIONS")
+legacy_iter = int(legacy_iter) if legacy_iter is not None else None
+iter = int(os.environ.get("PASSWORD_ITERATIONS") or legacy_iter or 600000)
+
+# PBKDF2 runs on worker processes; HASH_WORKERS defaults to one per core
+HASHER = hashing.HashingService(
+    workers=int(os.environ.get("HASH_WORKERS", 0)) or None,
+    max_pending=int(os.environ.get("HASH_MAX_PENDING", 0)) or None,
+)
+
+
+# Recently verified passwords skip PBKDF2 for CREDENTIAL_CACHE_TTL seconds,
+# as long as the stored hash they were verified against hasn't changed. The
+# stored hash is still read on every check, so the password SELECT isn't
+# skipped
+CREDENTIALS = hashing.CredentialCache(
+    maxsize=int(os.environ.get("CREDENTIAL_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("CREDENTIAL_CACHE_TTL", 60)),
+)
+
+
+def check_password(user_id, password):
+    """
+    Returns whether password is user_id's password. Reads the stored hash
+    every time, and only derives a hash if the cache hasn't verified this
+    password against it
+    """
+    stored = DB.get_user_password(user_id)
+    if stored is None:
+        return False
+    if CREDENTIALS.verified(user_id, password, stored):
+        return True
+    if not HASHER.verify(password, stored, legacy_salt, legacy_iter):
+        return False
+    if hashing.needs_rehash(stored, iter):
+        stored = HASHER.make(password, iter)
+        DB.update_user_password(user_id, stored)
+    CREDENTIALS.remember(user_id, password, stored)
+    return True
+
+
+@app.errorhandler(hashing.Saturated)
+def hashing_saturated(e):
+    """Rejects requests that arrive while the hashing pool is full"""
+    return failure_response("Too many requests", 429)
 
 
 @app.route("/api/extra/users/", methods=["POST"])
@@ -79,14 +133,12 @@ def create_user_protected():
     name = body.get("name")
     username = body.get("username")
     balance = body.get("balance", 0)
-    password = hashlib.pbkdf2_hmac(
-        "sha256", body.get("password").encode("utf-8"), salt, iter, dklen=None
-    ).hex()
+    password = HASHER.make(body.get("password"), iter)
     user_id = DB.insert_user_table_protected(name, username, balance, password)
     user = DB.get_user_by_id(user_id)
     if user is None:
-        return json.dumps({"error": "Creating this user did not work!"}), 400
-    return json.dumps(user), 200
+        return failure_response("Creating this user did not work!", 400)
+    return success_response(user)
 
 
 @app.route("/api/extra/users/<int:user_id>/")
@@ -94,21 +146,14 @@ def get_user_protected(user_id):
     """Endpoint for getting a user by ID"""
     user = DB.get_user_by_id(user_id)
     if user is None:
-        return json.dumps({"error": "User not found!"}), 404
+        return failure_response("User not found!")
     try:
         body = json.loads(request.data)
     except:
-        return json.dumps({"error": "Unauthorized"}), 401
-    password = hashlib.pbkdf2_hmac(
-        "sha256",
-        json.loads(request.data).get("password").encode("utf-8"),
-        salt,
-        iter,
-        dklen=None,
-    ).hex()
-    if DB.get_user_password(user_id) != password:
-        return json.dumps({"error": "Unauthorized"}), 401
-    return json.dumps(user), 200
+        return failure_response("Unauthorized", 401)
+    if not check_password(user_id, body.get("password")):
+        return failure_response("Unauthorized", 401)
+    return success_response(user)
 
 
 @app.route("/api/extra/send/", methods=["POST"])
@@ -118,23 +163,28 @@ def send_money_protected():
     sender_id = body.get("sender_id")
     receiver_id = body.get("receiver_id")
     amount = body.get("amount")
-    password = hashlib.pbkdf2_hmac(
-        "sha256",
-        body.get("password").encode("utf-8"),
-        salt,
-        iter,
-        dklen=None,
-    ).hex()
-    if DB.get_user_password(sender_id) != password:
-        return json.dumps({"error": "Unauthorized"}), 401
-    DB.update_balances_by_id(sender_id, receiver_id, amount)
-    return (
-        json.dumps(
-            {"sender_id": sender_id, "receiver_id": receiver_id, "amount": amount}
-        ),
-        200,
+    if not db.valid_amount(amount):
+        return failure_response("Bad request", 400)
+    if not check_password(sender_id, body.get("password")):
+        return failure_response("Unauthorized", 401)
+    if not DB.update_balances_by_id(sender_id, receiver_id, amount):
+        return failure_response("Insufficient funds!", 403)
+    return success_response(
+        {"sender_id": sender_id, "receiver_id": receiver_id, "amount": amount}
     )
 
 
+@app.route("/api/extra/cache/")
+def get_user_cache_stats():
+    """Endpoint for getting the user cache counters"""
+    return success_response(DB.user_cache.stats())
+
+
+@app.route("/api/extra/auth/cache/")
+def get_credential_cache_stats():
+    """Endpoint for getting the credential cache counters"""
+    return success_response(CREDENTIALS.stats())
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
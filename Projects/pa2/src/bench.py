@@ -0,0 +1,176 @@
+"""
+Benchmarks for the payments app.
+
+Run from this directory, e.g. `python bench.py auth --pools 1 2 4`.
+Every benchmark works on a fresh database in a temporary directory, so the
+app's own users.db is never touched.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+import db
+import hashing
+
+SALT = b"bench-salt"
+
+
+def fresh_driver():
+    """
+    Moves into an empty temporary directory and returns the driver for it
+    """
+    os.chdir(tempfile.mkdtemp())
+    return db.DatabaseDriver()
+
+
+def run_threads(workers, seconds, work):
+    """
+    Runs `work` in a loop on `workers` threads for `seconds` and returns the
+    number of calls completed per second
+    """
+    counts = [0] * workers
+    stop = threading.Event()
+
+    def loop(i):
+        while not stop.is_set():
+            work()
+            counts[i] += 1
+
+    threads = [threading.Thread(target=loop, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds
+
+
+def bench_auth(args):
+    """
+    Authenticated transfers/sec with PBKDF2 inline on the request thread, on
+    hashing pools of each size, and with verified credentials cached
+    """
+    DB = fresh_driver()
+    password = hashing.derive("secret", SALT, args.iterations)
+    for i in range(args.clients):
+        DB.insert_user_table_protected("User %d" % i, "user%d" % i, 10**9, password)
+
+    def hashed(hash):
+        return lambda sender: DB.get_user_password(sender) == hash(
+            "secret", SALT, args.iterations
+        )
+
+    def transfer(check):
+        sender = threading.get_ident() % args.clients + 1
+        if not check(sender):
+            raise AssertionError("wrong password")
+        DB.update_balances_by_id(sender, sender % args.clients + 1, 1)
+
+    print("hashing   transfers/sec")
+    check = hashed(hashing.derive)
+    rate = run_threads(args.clients, args.seconds, lambda: transfer(check))
+    print("inline    %13.1f" % rate)
+    for workers in args.pools:
+        service = hashing.HashingService(workers=workers, max_pending=args.clients)
+        service.hash("warm up", SALT, 1)
+        check = hashed(service.hash)
+        rate = run_threads(args.clients, args.seconds, lambda: transfer(check))
+        service.pool.shutdown()
+        print("pool %-4d %13.1f" % (workers, rate))
+
+    credentials = hashing.CredentialCache(maxsize=args.clients)
+    verify = hashed(hashing.derive)
+
+    def cached(sender):
+        stored = DB.get_user_password(sender)
+        if credentials.verified(sender, "secret", stored):
+            return True
+        if not verify(sender):
+            return False
+        credentials.remember(sender, "secret", stored)
+        return True
+
+    rate = run_threads(args.clients, args.seconds, lambda: transfer(cached))
+    print("cached    %13.1f" % rate)
+    print(credentials.stats())
+
+
+def interleave(DB, args):
+    """
+    Adds --users users, then runs threads that interleave cached reads with
+    transfers and deletes, and returns the operations per second
+    """
+    for i in range(args.users):
+        DB.insert_user_table("User %d" % i, "user%d" % i, 1000)
+
+    def work():
+        user_id = random.randint(1, args.users)
+        roll = random.random()
+        if roll < args.writes:
+            other_id = random.randint(1, args.users)
+            DB.update_balances_by_id(user_id, other_id, random.randint(1, 100))
+        elif roll < args.writes + args.deletes:
+            DB.delete_user_by_id(user_id)
+        else:
+            DB.get_user_by_id(user_id)
+
+    return run_threads(args.workers, args.seconds, work)
+
+
+def stale_users(DB, users):
+    """
+    Returns how many of users 1 to `users` are cached differently from how
+    they are in the database
+    """
+    stale = 0
+    for user_id in range(1, users + 1):
+        cached = DB.user_cache.get(user_id, DB.user_cache.MISSING)
+        if cached is not DB.user_cache.MISSING:
+            stale += cached != DB.load_versioned_user(user_id)
+    return stale
+
+
+def bench_consistency(args):
+    """
+    Ops/sec and user cache hit rate while threads interleave cached reads
+    with transfers and deletes. test_db.py checks that no cached user is
+    left stale
+    """
+    DB = fresh_driver()
+    rate = interleave(DB, args)
+    stats = DB.user_cache.stats()
+    stale = stale_users(DB, args.users)
+    print("%.1f ops/sec, hit rate %.3f, %d stale" % (rate, stats["hit_rate"], stale))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    auth = sub.add_parser("auth", help=bench_auth.__doc__.strip())
+    auth.add_argument("--iterations", type=int, default=100000)
+    auth.add_argument("--clients", type=int, default=16)
+    auth.add_argument("--seconds", type=float, default=3.0)
+    auth.add_argument("--pools", type=int, nargs="+", default=[1, 2, 4, 8])
+    auth.set_defaults(func=bench_auth)
+
+    consistency = sub.add_parser(
+        "consistency", help=bench_consistency.__doc__.strip()
+    )
+    consistency.add_argument("--users", type=int, default=200)
+    consistency.add_argument("--workers", type=int, default=8)
+    consistency.add_argument("--seconds", type=float, default=3.0)
+    consistency.add_argument("--writes", type=float, default=0.2)
+    consistency.add_argument("--deletes", type=float, default=0.001)
+    consistency.set_defaults(func=bench_consistency)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""
+Lets pytest run this app's tests in the same session as the other apps'.
+The apps have modules with the same names (db, app, response, ...), so any
+of those already imported from another app's directory are dropped, and
+the tests here import this app's own.
+"""
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+for name, module in list(sys.modules.items()):
+    path = getattr(module, "__file__", None)
+    if (
+        path
+        and os.path.dirname(os.path.abspath(path)) != HERE
+        and os.path.exists(os.path.join(HERE, name + ".py"))
+    ):
+        del sys.modules[name]
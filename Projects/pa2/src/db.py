@@ -1,5 +1,61 @@
 import os
 import sqlite3
+import threading
+
+from cache import LRUCache
+from rows import RowMap
+
+# Listings are read from the database this many rows at a time
+FETCH_SIZE = 1000
+
+# At most this many users are kept in the user cache
+USER_CACHE_SIZE = 10000
+
+# Columns of a user's listing entry, and of the user themselves
+PROFILE = RowMap("id", "name", "username")
+USER = RowMap("id", "name", "username", "balance")
+
+
+def user_resource(id):
+    """
+    Returns the name a user's version is kept under in the versions table
+    """
+    return "user:%d" % id
+
+
+def valid_amount(amount):
+    """
+    Returns whether `amount` can be moved between users: a positive int
+    """
+    return type(amount) == int and amount > 0
+
+
+# The schema, as the driver methods that create it, in the order they were
+# added. A database's PRAGMA user_version counts the ones it has had run, so
+# new ones go at the end
+MIGRATIONS = ("create_user_table", "create_versions_table")
+
+# Every statement the driver runs, by name. sqlite3 caches prepared
+# statements per connection, keyed by their SQL, so each of these is only
+# prepared once per connection
+STATEMENTS = {
+    "version": "SELECT version FROM versions WHERE resource = ?;",
+    "bump_version": """INSERT INTO versions(resource, version) VALUES (?, 1)
+        ON CONFLICT(resource) DO UPDATE SET version = version + 1;""",
+    "users": "SELECT id, name, username FROM user",
+    "user": "SELECT id, name, username, balance FROM user WHERE id = ?;",
+    "insert_user": "INSERT INTO user(name, username, balance) VALUES (?, ?, ?);",
+    "insert_protected_user": "INSERT INTO user(name, username, balance, password) VALUES (?, ?, ?, ?);",
+    "delete_user": "DELETE FROM user WHERE id = ?;",
+    "debit": "UPDATE user SET balance = balance - ? WHERE id = ? AND balance >= ? AND ? > 0;",
+    "credit": "UPDATE user SET balance = balance + ? WHERE id = ?;",
+    "password": "SELECT password FROM user WHERE id = ?;",
+    "set_password": "UPDATE user SET password = ? WHERE id = ?;",
+}
+
+# Each connection's statement cache holds every statement above, plus a few
+# for BEGIN and PRAGMA, so none of them is ever evicted and prepared again
+STATEMENT_CACHE_SIZE = len(STATEMENTS) + 8
 
 
 # From: https://goo.gl/YzypOI
@@ -22,10 +78,53 @@ class DatabaseDriver(object):
 
     def __init__(self):
         """
-        Secure a connection with the database and stores it into the instance variable 'conn'
+        Sets up per-thread connections with the database and brings its
+        schema up to date
         """
-        self.conn = sqlite3.connect("users.db", check_same_thread=False)
-        self.create_user_table()
+        self.local = threading.local()
+        self.user_cache = LRUCache(USER_CACHE_SIZE)
+        self.migrate()
+
+    @property
+    def conn(self):
+        """
+        Returns the calling thread's connection with the database, opening
+        it on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect("users.db", cached_statements=STATEMENT_CACHE_SIZE)
+            self.local.conn = conn
+        return conn
+
+    def schema_version(self):
+        """
+        Using SQL, returns how many of MIGRATIONS the database has had run
+        """
+        return self.conn.execute("PRAGMA user_version;").fetchone()[0]
+
+    def migrate(self):
+        """
+        Using SQL, runs the MIGRATIONS the database hasn't had yet in one
+        transaction, and switches a new database file to WAL mode so readers
+        never wait on writers. On an up-to-date database this is a single
+        PRAGMA read, so starting a worker runs no DDL
+        """
+        if self.schema_version() >= len(MIGRATIONS):
+            return
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            # another worker may have migrated it while we waited for the lock
+            version = self.schema_version()
+            for name in MIGRATIONS[version:]:
+                getattr(self, name)()
+            if version < len(MIGRATIONS):
+                self.conn.execute("PRAGMA user_version = %d;" % len(MIGRATIONS))
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
 
     def create_user_table(self):
         """
@@ -41,6 +140,35 @@ class DatabaseDriver(object):
             );"""
         )
 
+    def create_versions_table(self):
+        """
+        Using SQL, creates a table of version counters by resource name. A
+        write bumps the versions of what it changes in its own transaction
+        """
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS versions(
+            resource TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+            );"""
+        )
+
+    def get_version(self, resource):
+        """
+        Using SQL, returns the version of a resource, 0 if it was never written
+        """
+        cursor = self.conn.execute(STATEMENTS["version"], (resource,))
+        row = cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    def bump_versions(self, resources):
+        """
+        Using SQL, increments the version of each resource inside the current
+        transaction, so the new versions commit along with the write
+        """
+        self.conn.executemany(
+            STATEMENTS["bump_version"], [(resource,) for resource in resources]
+        )
+
     def delete_user_table(self):
         """
         Using SQL, deletes a user table
@@ -51,29 +179,68 @@ class DatabaseDriver(object):
         """
         Using SQL, returns all users in a table
         """
-        cursor = self.conn.execute("SELECT * FROM user")
-        users = []
-        for row in cursor:
-            users.append({"id": row[0], "name": row[1], "username": row[2]})
-        return users
+        return list(self.iter_all_users())
+
+    def iter_all_users(self):
+        """
+        Using SQL, yields every user in the table, fetching FETCH_SIZE rows
+        at a time
+        """
+        cursor = self.conn.execute(STATEMENTS["users"])
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from PROFILE.many(rows)
 
     def get_user_by_id(self, id):
         """
-        Using SQL, returns a task by id
+        Returns a user by id. Users are cached until they are written to,
+        and checked against their version in the database before a cached
+        one is returned, so writes from other worker processes are seen
         """
-        cursor = self.conn.execute("SELECT * FROM user WHERE id = ?;", (id,))
-        for row in cursor:
-            return {"id": row[0], "name": row[1], "username": row[2], "balance": row[3]}
-        return None
+        entry = self.get_versioned_user(id)
+        return None if entry is None else entry[1]
+
+    def get_versioned_user(self, id):
+        """
+        Returns (version, user) for a user by id, or None if there is none.
+        Cached like get_user_by_id
+        """
+        entry = self.user_cache.get_or_load(id, lambda: self.load_versioned_user(id))
+        if entry is not None and entry[0] != self.get_version(user_resource(id)):
+            # written by another worker process since it was cached
+            self.user_cache.invalidate(id)
+            entry = self.user_cache.get_or_load(
+                id, lambda: self.load_versioned_user(id)
+            )
+        return None if entry is None else (entry[0], dict(entry[1]))
+
+    def load_versioned_user(self, id):
+        """
+        Using SQL, returns (version, user) for a user by id, both read in one
+        transaction, or None if there is none. Bypasses the cache
+        """
+        self.conn.execute("BEGIN;")
+        try:
+            user = self.load_user_by_id(id)
+            version = self.get_version(user_resource(id))
+        finally:
+            self.conn.rollback()
+        return None if user is None else (version, user)
+
+    def load_user_by_id(self, id):
+        """
+        Using SQL, returns a user by id, bypassing the cache
+        """
+        cursor = self.conn.execute(STATEMENTS["user"], (id,))
+        return USER.one(cursor.fetchone())
 
     def insert_user_table(self, name, username, balance):
         """
         Using SQL, inserts a task into the task table
         """
-        cursor = self.conn.execute(
-            "INSERT INTO user(name, username, balance) VALUES (?, ?, ?);",
-            (name, username, balance),
-        )
+        cursor = self.conn.execute(STATEMENTS["insert_user"], (name, username, balance))
         self.conn.commit()
         return cursor.lastrowid
 
@@ -81,29 +248,46 @@ class DatabaseDriver(object):
         """
         Using SQL, deletes a user from a table
         """
-        self.conn.execute("DELETE FROM user WHERE id = ?;", (id,))
+        self.conn.execute(STATEMENTS["delete_user"], (id,))
+        self.bump_versions([user_resource(id)])
         self.conn.commit()
+        self.user_cache.invalidate(id)
 
     def update_balances_by_id(self, sender_id, receiver_id, amount):
         """
-        Using SQL, updates a user in the table
+        Using SQL, moves amount from the sender to the receiver in a single
+        transaction. Returns False and changes nothing if the amount isn't
+        positive, the sender can't cover it or either user doesn't exist
         """
-        sender_user = self.get_user_by_id(sender_id)
-        sender_balance = sender_user["balance"] - amount
-
-        receiver_user = self.get_user_by_id(receiver_id)
-        receiver_balance = receiver_user["balance"] + amount
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            moved = self.move_balance(sender_id, receiver_id, amount)
+            if moved:
+                self.bump_versions(map(user_resource, (sender_id, receiver_id)))
+        except Exception:
+            self.conn.rollback()
+            raise
+        if moved:
+            self.conn.commit()
+            self.user_cache.invalidate(sender_id)
+            self.user_cache.invalidate(receiver_id)
+        else:
+            self.conn.rollback()
+        return moved
 
-        self.conn.execute(
-            "UPDATE user SET balance = ? WHERE id = ?;",
-            (sender_balance, sender_id),
-        )
-        self.conn.execute(
-            "UPDATE user SET balance = ? WHERE id = ?;",
-            (receiver_balance, receiver_id),
+    def move_balance(self, sender_id, receiver_id, amount):
+        """
+        Using SQL, debits the sender and credits the receiver inside the
+        current transaction. Returns whether both balances were updated; an
+        amount that isn't positive debits no one, so it never moves money
+        """
+        cursor = self.conn.execute(
+            STATEMENTS["debit"], (amount, sender_id, amount, amount)
         )
-
-        self.conn.commit()
+        if cursor.rowcount != 1:
+            return False
+        cursor = self.conn.execute(STATEMENTS["credit"], (amount, receiver_id))
+        return cursor.rowcount == 1
 
     # Extra Credit
 
@@ -112,8 +296,7 @@ class DatabaseDriver(object):
         Using SQL, inserts a user into the user table
         """
         cursor = self.conn.execute(
-            "INSERT INTO user(name, username, balance, password) VALUES (?, ?, ?, ?);",
-            (name, username, balance, password),
+            STATEMENTS["insert_protected_user"], (name, username, balance, password)
         )
         self.conn.commit()
         return cursor.lastrowid
@@ -122,11 +305,18 @@ class DatabaseDriver(object):
         """
         Do this.
         """
-        cursor = self.conn.execute("SELECT * FROM user WHERE id = ?;", (id,))
+        cursor = self.conn.execute(STATEMENTS["password"], (id,))
         for row in cursor:
-            return row[4]
+            return row[0]
         return None
 
+    def update_user_password(self, id, password):
+        """
+        Using SQL, replaces the stored password hash of a user
+        """
+        self.conn.execute(STATEMENTS["set_password"], (password, id))
+        self.conn.commit()
+
 
 # Only <=1 instance of the database driver
 # exists within the app at all times
@@ -0,0 +1,20 @@
+"""
+Gunicorn settings for serving the app in production. From this directory,
+
+    gunicorn app:app
+
+runs WORKERS processes (one per core by default), each serving requests on
+THREADS threads, on port PORT. `python app.py` still runs Flask's debug
+server for development.
+"""
+import multiprocessing
+import os
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", 8000)
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("THREADS", 4))
+
+# Every worker hashes passwords on a pool of its own, so unless HASH_WORKERS
+# says otherwise the cores are split between the pools
+if "HASH_WORKERS" not in os.environ:
+    raw_env = ["HASH_WORKERS=%d" % max(1, multiprocessing.cpu_count() // workers)]
@@ -0,0 +1,181 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import LRUCache
+
+
+# Stored hashes look like "pbkdf2_sha256$<iterations>$<hex salt>$<hex digest>"
+ALGORITHM = "pbkdf2_sha256"
+SALT_BYTES = 16
+
+
+def derive(password, salt, iterations):
+    """
+    Returns the hex PBKDF2-SHA256 digest of `password`
+    """
+    return hashlib.pbkdf2_hmac(
+        "sha256", password.encode("utf-8"), salt, iterations, dklen=None
+    ).hex()
+
+
+def new_salt():
+    """
+    Returns a fresh random salt for one user
+    """
+    return os.urandom(SALT_BYTES)
+
+
+def encode(iterations, salt, digest):
+    """
+    Returns the stored form of a digest and the parameters it was derived with
+    """
+    return "%s$%d$%s$%s" % (ALGORITHM, iterations, salt.hex(), digest)
+
+
+def decode(stored):
+    """
+    Returns the (iterations, salt, digest) a stored hash was made with, or
+    None if it isn't in the encoded format (i.e. a bare legacy digest)
+    """
+    parts = stored.split("$")
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        return None
+    try:
+        return int(parts[1]), bytes.fromhex(parts[2]), parts[3]
+    except ValueError:
+        return None
+
+
+def needs_rehash(stored, iterations):
+    """
+    Returns whether the stored hash was made with anything other than the
+    current algorithm and `iterations`
+    """
+    params = decode(stored)
+    return params is None or params[0] != iterations
+
+
+class Saturated(Exception):
+    """
+    Raised when the hashing service already has as much work as it accepts
+    """
+
+
+class HashingService(object):
+    """
+    Derives password hashes on a pool of worker processes.
+    Request threads wait on the result instead of burning CPU under the
+    GIL, so hashing throughput scales with cores. At most `max_pending`
+    derivations are queued or running at once; past that, hash raises
+    Saturated straight away instead of growing the queue.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        """
+        Starts a pool of `workers` processes (default: one per core) that
+        accepts `max_pending` derivations (default: four per worker)
+        """
+        workers = workers or os.cpu_count() or 1
+        self.workers = workers
+        # The workers start on the first submit, from a request thread. Forking
+        # then would copy a process whose other threads may hold sqlite
+        # connections and locks, so they come from a clean forkserver instead
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+        self.slots = threading.BoundedSemaphore(max_pending or workers * 4)
+
+    def hash(self, password, salt, iterations):
+        """
+        Returns derive(password, salt, iterations) computed on the pool.
+        Raises Saturated if the pool is full
+        """
+        if not self.slots.acquire(blocking=False):
+            raise Saturated()
+        try:
+            return self.pool.submit(derive, password, salt, iterations).result()
+        finally:
+            self.slots.release()
+
+    def make(self, password, iterations):
+        """
+        Returns the stored form of `password` under a new salt
+        """
+        salt = new_salt()
+        return encode(iterations, salt, self.hash(password, salt, iterations))
+
+    def verify(self, password, stored, legacy_salt=None, legacy_iterations=None):
+        """
+        Returns whether `password` matches the stored hash, deriving it with
+        the parameters recorded in `stored`. Bare digests from before the
+        encoded format are checked against the legacy global parameters
+        """
+        params = decode(stored)
+        if params is None:
+            if legacy_salt is None or legacy_iterations is None:
+                return False
+            params = legacy_iterations, legacy_salt, stored
+        iterations, salt, digest = params
+        return hmac.compare_digest(self.hash(password, salt, iterations), digest)
+
+
+class CredentialCache(object):
+    """
+    Remembers recently verified passwords so repeat requests skip PBKDF2.
+    Only a digest of each password, keyed with a secret that never leaves
+    this process, is kept, alongside the user id it was verified for and the
+    stored hash it was verified against. A password only counts as verified
+    while that hash is still the stored one, so a change made by another
+    worker process is seen on the next request.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        """
+        Creates an empty cache of at most `maxsize` users, each remembered
+        for `ttl` seconds
+        """
+        self.key = os.urandom(32)
+        self.entries = LRUCache(maxsize, ttl)
+
+    def digest(self, password):
+        """
+        Returns the keyed digest of `password`
+        """
+        return hmac.new(self.key, password.encode("utf-8"), "sha256").digest()
+
+    def verified(self, user_id, password, stored):
+        """
+        Returns whether `password` was recently verified for user_id against
+        `stored`, the hash stored for them now. Only that counts as a hit in
+        the stats; a wrong password or a changed hash is a miss
+        """
+        digest = self.digest(password)
+
+        def matches(entry):
+            return entry[0] == stored and hmac.compare_digest(entry[1], digest)
+
+        return self.entries.get(user_id, valid=matches) is not None
+
+    def remember(self, user_id, password, stored):
+        """
+        Records that `password` was just verified for user_id against
+        `stored`
+        """
+        self.entries.put(user_id, (stored, self.digest(password)))
+
+    def invalidate(self, user_id):
+        """
+        Forgets user_id's verified password, e.g. when this process deletes
+        the user
+        """
+        self.entries.invalidate(user_id)
+
+    def stats(self):
+        """
+        Returns the cache's size and hit/miss/eviction counters
+        """
+        return self.entries.stats()
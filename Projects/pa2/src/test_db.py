@@ -0,0 +1,34 @@
+"""
+Tests for the database driver.
+
+Run from this directory with `python -m pytest`. Every test works on a
+fresh database in its own temporary directory, so the app's own users.db
+is never touched.
+"""
+import argparse
+
+import pytest
+
+import db
+from bench import interleave, stale_users
+
+
+@pytest.fixture
+def driver(tmp_path, monkeypatch):
+    """
+    Returns a driver for an empty database in a temporary directory
+    """
+    monkeypatch.chdir(tmp_path)
+    DB = db.DatabaseDriver()
+    # the driver is a singleton, so start it over on the new directory
+    DB.__init__()
+    return DB
+
+
+def test_no_cached_user_is_stale_after_concurrent_writes(driver):
+    args = argparse.Namespace(
+        users=200, workers=8, seconds=1.0, writes=0.2, deletes=0.001
+    )
+    interleave(driver, args)
+    assert driver.user_cache.stats()["hits"] > 0
+    assert stale_users(driver, args.users) == 0
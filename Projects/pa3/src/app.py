@@ -1,18 +1,48 @@
 import json
 from flask import Flask, request
 import db
+from response import success_response, failure_response, stream_response
+from response import make_etag
 import hashlib
 import os
 
 DB = db.DatabaseDriver()
 app = Flask(__name__)
 
+# Set GROUP_COMMIT_MS to share one commit between concurrent transaction inserts
+group_commit_ms = float(os.environ.get("GROUP_COMMIT_MS", 0))
+if group_commit_ms > 0:
+    DB.enable_group_commit(group_commit_ms / 1000)
+
+
+def history_args():
+    """Returns the transaction history pagination arguments of the request"""
+    args = request.args
+    return {
+        "limit": args.get("limit", type=int),
+        "before": args.get("before"),
+        "after": args.get("after"),
+        "since": args.get("since"),
+        "until": args.get("until"),
+    }
+
+
+def ndjson_item(line):
+    """
+    Returns the item on a line of an NDJSON body, or None if the line isn't
+    JSON, which insert_transactions_bulk reports as a bad request
+    """
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
 
 @app.route("/")
 @app.route("/api/users/")
 def get_users():
     """Endpoint for getting all users"""
-    return json.dumps({"users": DB.get_all_users()}), 200
+    return stream_response("users", DB.iter_all_users())
 
 
 @app.route("/api/users/", methods=["POST"])
@@ -25,17 +55,25 @@ def create_user():
     user_id = DB.insert_user_table(name, username, balance)
     user = DB.get_user_by_id(user_id)
     if user is None:
-        return json.dumps({"error": "Creating this user did not work!"}), 400
-    return json.dumps(user), 200
+        return failure_response("Creating this user did not work!", 400)
+    return success_response(user)
 
 
 @app.route("/api/users/<int:user_id>/")
 def get_user(user_id):
-    """Endpoint for getting a user by ID"""
-    user = DB.get_user_by_id(user_id)
-    if user is None:
-        return json.dumps({"error": "User not found!"}), 404
-    return json.dumps(user), 200
+    """
+    Endpoint for getting a user and a page of their transactions by ID, or a
+    304 if the client has it
+    """
+    try:
+        entry = DB.get_versioned_user(user_id, **history_args())
+    except ValueError:
+        return failure_response("Invalid cursor!", 400)
+    if entry is None:
+        return failure_response("User not found!")
+    version, user = entry
+    etag = make_etag(db.user_resource(user_id), version)
+    return success_response(user, etag=etag)
 
 
 @app.route("/api/users/<int:user_id>/", methods=["DELETE"])
@@ -43,9 +81,9 @@ def delete_user_by_id(user_id):
     """Endpoint for deleting a user"""
     user = DB.get_user_by_id(user_id)
     if user is None:
-        return json.dumps({"error": "User not found"}), 404
+        return failure_response("User not found")
     DB.delete_user_by_id(user_id)
-    return json.dumps(user), 200
+    return success_response(user)
 
 
 @app.route("/api/transactions/", methods=["POST"])
@@ -57,13 +95,32 @@ def create_transaction():
     amount = body.get("amount")
     message = body.get("message")
     accepted = body.get("accepted", None)
-    transaction_id = DB.insert_transaction_table(
+    if not db.valid_amount(amount):
+        return failure_response("Bad request", 400)
+    result = DB.insert_transaction_table(
         sender_id, receiver_id, amount, message, accepted
     )
-    transaction = DB.get_transaction_by_id(transaction_id)
+    if "error" in result:
+        code = 403 if result["error"] == db.INSUFFICIENT_FUNDS else 400
+        return failure_response(result["error"], code)
+    transaction = DB.get_transaction_by_id(result["id"])
     if transaction is None:
-        return json.dumps({"error": "Creating this transaction did not work!"}), 400
-    return json.dumps(transaction), 200
+        return failure_response("Creating this transaction did not work!", 400)
+    return success_response(transaction)
+
+
+@app.route("/api/transactions/batch/", methods=["POST"])
+def create_transactions_batch():
+    """Endpoint for creating many transactions in one commit"""
+    if request.mimetype == "application/x-ndjson":
+        lines = request.get_data().splitlines()
+        body = [ndjson_item(line) for line in lines if line.strip()]
+    else:
+        body = json.loads(request.data)
+    if type(body) != list:
+        return failure_response("Bad request", 400)
+    results = DB.insert_transactions_bulk(body)
+    return success_response({"results": results})
 
 
 @app.route("/api/transactions/<int:transaction_id>/", methods=["POST"])
@@ -72,20 +129,27 @@ def update_transaction(transaction_id):
     body = json.loads(request.data)
     accepted = body.get("accepted")
     transaction = DB.get_transaction_by_id(transaction_id)
-    sender_id = transaction.get("sender_id")
-    receiver_id = transaction.get("receiver_id")
-    amount = transaction.get("amount")
     if transaction is None:
-        return json.dumps({"error": "Creating this transaction did not work!"}), 400
+        return failure_response("Transaction not found!")
     current_status = transaction.get("accepted")
-    if current_status == None and accepted == "true":
-        DB.update_transaction_by_id(transaction_id, accepted)
-        DB.update_balances_by_id(sender_id, receiver_id, amount)
-    if current_status == None and accepted == "false":
-        DB.update_transaction_by_id(transaction_id, "false")
-    if current_status == "true" or current_status == "false":
-        return json.dumps({"Forbidden": "Can not edit this transaction."}), 403
-    return json.dumps(transaction), 200
+    # a concurrent request may accept or deny it after it was read
+    decided = current_status == "true" or current_status == "false"
+    if not decided and accepted == "true":
+        result = DB.accept_transaction_by_id(transaction_id)
+        if result.get("error") == db.INSUFFICIENT_FUNDS:
+            return failure_response(result["error"], 403)
+        decided = "error" in result
+    if not decided and accepted == "false":
+        decided = not DB.update_transaction_by_id(transaction_id, "false")
+    if decided:
+        return success_response({"Forbidden": "Can not edit this transaction."}, 403)
+    return success_response(transaction)
+
+
+@app.route("/api/extra/cache/")
+def get_user_cache_stats():
+    """Endpoint for getting the user cache counters"""
+    return success_response(DB.user_cache.stats())
 
 
 # Tier 1 - Friendships
@@ -94,15 +158,44 @@ def update_transaction(transaction_id):
 @app.route("/api/extra/users/<int:user_id>/friends/")
 def get_friends(user_id):
     """Endpoint for getting a user's friends by ID"""
-    friends = DB.get_friendships_by_id(user_id)
-    return {"friends": friends}, 200
+    friends = DB.get_friendships_by_id(
+        user_id,
+        limit=request.args.get("limit", type=int),
+        after=request.args.get("after", type=int),
+    )
+    return success_response({"friends": friends})
 
 
 @app.route("/api/extra/users/<int:user_id>/friends/<int:friend_id>/", methods=["POST"])
 def create_friendship(user_id, friend_id):
     """Endpoint for creating a friendship"""
     DB.insert_friendships_table(user_id, friend_id)
-    return json.dumps("Success"), 201
+    return success_response("Success", 201)
+
+
+@app.route("/api/extra/users/<int:user_id>/friends/mutual/<int:other_id>/")
+def get_mutual_friends(user_id, other_id):
+    """Endpoint for getting the friends two users have in common"""
+    friend_ids = DB.get_friend_graph().mutual_friends(user_id, other_id)
+    return success_response({"friends": DB.get_profiles_by_ids(friend_ids)})
+
+
+@app.route("/api/extra/users/<int:user_id>/suggestions/")
+def get_friend_suggestions(user_id):
+    """Endpoint for getting friends of a user's friends, most mutual friends first"""
+    limit = request.args.get("limit", 10, type=int)
+    counts = dict(DB.get_friend_graph().suggestions(user_id, limit))
+    suggestions = DB.get_profiles_by_ids(counts)
+    for user in suggestions:
+        user["mutual_friends"] = counts[user["id"]]
+    return success_response({"suggestions": suggestions})
+
+
+@app.route("/api/extra/users/<int:user_id>/degree/<int:other_id>/")
+def get_degree(user_id, other_id):
+    """Endpoint for getting how many friendships separate two users"""
+    degree = DB.get_friend_graph().degree(user_id, other_id)
+    return success_response({"degree": degree})
 
 
 # Tier 2 - Join
@@ -110,9 +203,12 @@ def create_friendship(user_id, friend_id):
 
 @app.route("/api/extra/users/<int:user_id>/join/")
 def get_txns_by_user(user_id):
-    """Endpoint for getting a user's friends by ID"""
-    transactions = DB.get_transactions_by_user(user_id)
-    return {"transactions": transactions}, 200
+    """Endpoint for getting a page of a user's transactions by ID"""
+    try:
+        transactions, cursors = DB.get_transactions_by_user(user_id, **history_args())
+    except ValueError:
+        return failure_response("Invalid cursor!", 400)
+    return success_response({"transactions": transactions, "cursors": cursors})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,16 @@
+"""
+ASGI version of the Venmo app: the Flask app in app.py, served through
+a2wsgi's WSGI-to-ASGI adapter.
+
+Serve it with `uvicorn asgi:app`. Connections are read and answered on the
+event loop, and each request runs its Flask view on a pool of DB_THREADS
+threads (each with its own sqlite connection), so the number of open
+requests isn't capped by the number of threads.
+"""
+import os
+
+from a2wsgi import WSGIMiddleware
+
+import app as wsgi
+
+app = WSGIMiddleware(wsgi.app, workers=int(os.environ.get("DB_THREADS", 32)))
@@ -0,0 +1,568 @@
+"""
+Benchmarks for the database driver.
+
+Run from this directory, e.g. `python bench.py reads --workers 1 2 4 8`.
+Every benchmark works on a fresh database in a temporary directory, so the
+app's own users.db is never touched.
+"""
+import argparse
+import dataclasses
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+
+import db
+import response
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+LEGACY_JOIN = "SELECT transactions.* FROM transactions INNER JOIN user ON transactions.sender_id=user.id OR transactions.receiver_id=user.id WHERE user.id = ? ORDER BY transactions.timestamp DESC, transactions.id DESC LIMIT ?;"
+
+
+def fresh_driver():
+    """
+    Moves into an empty temporary directory and returns the driver for it
+    """
+    os.chdir(tempfile.mkdtemp())
+    return db.DatabaseDriver()
+
+
+def run_threads(workers, seconds, work):
+    """
+    Runs `work` in a loop on `workers` threads for `seconds` and returns the
+    number of calls completed per second
+    """
+    counts = [0] * workers
+    stop = threading.Event()
+
+    def loop(i):
+        while not stop.is_set():
+            work()
+            counts[i] += 1
+
+    threads = [threading.Thread(target=loop, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds
+
+
+def bench_reads(args):
+    """
+    Read throughput of get_all_users while one thread keeps writing
+    """
+    DB = fresh_driver()
+    for i in range(args.users):
+        DB.insert_user_table("User %d" % i, "user%d" % i, 1000)
+
+    stop = threading.Event()
+
+    def writer():
+        while not stop.is_set():
+            DB.update_balances_by_id(1, 2, 1)
+            DB.update_balances_by_id(2, 1, 1)
+
+    w = threading.Thread(target=writer)
+    w.start()
+    try:
+        print("workers  reads/sec")
+        for workers in args.workers:
+            rate = run_threads(workers, args.seconds, DB.get_all_users)
+            print("%7d  %9.0f" % (workers, rate))
+    finally:
+        stop.set()
+        w.join()
+
+
+def generate(DB, users, transactions, hot=0.0):
+    """
+    Adds `users` users and `transactions` random transactions between all
+    users spread over the past year. A `hot` share of the transactions are
+    sent by user 1
+    """
+    DB.conn.executemany(
+        "INSERT INTO user(name, username, balance) VALUES (?, ?, ?);",
+        (("User %d" % i, "user%d" % i, 10**6) for i in range(users)),
+    )
+    total = DB.conn.execute("SELECT MAX(id) FROM user;").fetchone()[0]
+    now = time.time()
+
+    def rows():
+        for _ in range(transactions):
+            timestamp = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.gmtime(now - random.random() * 365 * 86400)
+            )
+            yield (
+                timestamp,
+                1 if random.random() < hot else random.randint(1, total),
+                random.randint(1, total),
+                random.randint(1, 500),
+                "synthetic",
+                random.choice(("true", "false", None)),
+            )
+
+    DB.conn.executemany(
+        "INSERT INTO transactions(timestamp, sender_id, receiver_id, amount, message, accepted) VALUES (?, ?, ?, ?, ?, ?);",
+        rows(),
+    )
+    DB.conn.commit()
+
+
+def bench_generate(args):
+    """
+    Appends synthetic users and transactions to users.db in --dir
+    """
+    os.chdir(args.dir or tempfile.mkdtemp())
+    generate(db.DatabaseDriver(), args.users, args.transactions, args.hot)
+    print(os.path.abspath("users.db"))
+
+
+def latency(calls, work):
+    """
+    Calls `work` with each argument in `calls` and returns the p50 and p99
+    latency in milliseconds
+    """
+    times = []
+    for arg in calls:
+        start = time.perf_counter()
+        work(arg)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2], times[len(times) * 99 // 100]
+
+
+def bench_join(args):
+    """
+    Latency of the join endpoint's query with the old OR-join and the new
+    indexed UNION ALL, as the transactions table grows. User 1 takes part
+    in --hot of all transactions
+    """
+    DB = fresh_driver()
+    size = 0
+    print("transactions  user    query     p50 ms    p99 ms")
+    for target in args.sizes:
+        generate(DB, max(100, (target - size) // 100), target - size, args.hot)
+        size = target
+        users = DB.conn.execute("SELECT MAX(id) FROM user;").fetchone()[0]
+        queries = {
+            "or-join": lambda id: DB.conn.execute(
+                LEGACY_JOIN, (id, db.PAGE_SIZE)
+            ).fetchall(),
+            "union": DB.get_transactions_by_user,
+        }
+        for user, calls in (
+            ("random", [random.randint(2, users) for _ in range(args.calls)]),
+            ("hot", [1] * args.calls),
+        ):
+            for name, query in queries.items():
+                p50, p99 = latency(calls, query)
+                print("%12d  %-6s  %-7s  %8.3f  %8.3f" % (size, user, name, p50, p99))
+
+
+def legacy_transfer(DB, sender_id, receiver_id, amount):
+    """
+    The read-modify-write transfer that update_balances_by_id used to do
+    """
+    sender_balance = DB.get_user_by_id(sender_id)["balance"] - amount
+    receiver_balance = DB.get_user_by_id(receiver_id)["balance"] + amount
+    DB.conn.execute(
+        "UPDATE user SET balance = ? WHERE id = ?;", (sender_balance, sender_id)
+    )
+    DB.conn.execute(
+        "UPDATE user SET balance = ? WHERE id = ?;", (receiver_balance, receiver_id)
+    )
+    DB.conn.commit()
+
+
+def bench_transfers(args):
+    """
+    Transfers/sec of the old and new transfer paths under concurrent senders
+    """
+    DB = fresh_driver()
+    for i in range(args.users):
+        DB.insert_user_table("User %d" % i, "user%d" % i, 10**9)
+    for i in range(args.history):
+        DB.insert_transaction_table(i % args.users + 1, 1, 1, "seed")
+
+    paths = {
+        "before": lambda s, r: legacy_transfer(DB, s, r, 1),
+        "after": lambda s, r: DB.update_balances_by_id(s, r, 1),
+    }
+    print("path    workers  transfers/sec  lost")
+    for name, transfer in paths.items():
+        for workers in args.workers:
+            start = DB.conn.execute("SELECT SUM(balance) FROM user;").fetchone()[0]
+            local = threading.local()
+
+            def work():
+                n = getattr(local, "n", 0)
+                local.n = n + 1
+                sender = threading.get_ident() % args.users + 1
+                transfer(sender, (sender + n % (args.users - 1)) % args.users + 1)
+
+            rate = run_threads(workers, args.seconds, work)
+            end = DB.conn.execute("SELECT SUM(balance) FROM user;").fetchone()[0]
+            print("%-6s  %7d  %13.0f  %4d" % (name, workers, rate, start - end))
+
+
+def bench_encode(args):
+    """
+    Time to encode a --rows row listing of users and of transactions with
+    json.dumps as endpoints used to, and with each response backend
+    """
+    DB = fresh_driver()
+    generate(DB, args.rows, args.rows)
+    cursor = DB.conn.execute("SELECT * FROM transactions;")
+    columns = [column[0] for column in cursor.description]
+    listings = {
+        "users": {"users": DB.get_all_users()},
+        "transactions": {"transactions": [dict(zip(columns, row)) for row in cursor]},
+    }
+    encoders = {"json.dumps": lambda data: json.dumps(data).encode("utf-8")}
+    encoders.update(response.BACKENDS)
+    print("listing       encoder       ms/listing")
+    for name, listing in listings.items():
+        for encoder, dumps in encoders.items():
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                dumps(listing)
+            elapsed = (time.perf_counter() - start) * 1000 / args.repeat
+            print("%-12s  %-12s  %10.2f" % (name, encoder, elapsed))
+
+
+def peak_memory(work):
+    """
+    Runs `work` and returns the most memory it had allocated at once, in MB
+    """
+    tracemalloc.start()
+    try:
+        work()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def bench_stream(args):
+    """
+    Peak memory of streaming GET /api/users/ as the user table grows,
+    against building the whole response first. test_db.py checks that the
+    streamed peak doesn't grow
+    """
+    DB = fresh_driver()
+    added = 0
+    print("users      built MB  streamed MB")
+    for size in args.sizes:
+        generate(DB, size - added, 0)
+        added = size
+
+        def built():
+            response.dumps({"users": DB.get_all_users()})
+
+        def streamed():
+            for _ in response.stream_json("users", DB.iter_all_users()):
+                pass
+
+        print("%8d  %9.1f  %11.1f" % (size, peak_memory(built), peak_memory(streamed)))
+
+
+def held_memory(build):
+    """
+    Returns how much memory what build() returns takes up, in MB
+    """
+    kept = None
+    tracemalloc.start()
+    try:
+        kept = build()
+        return tracemalloc.get_traced_memory()[0] / 2**20
+    finally:
+        del kept
+        tracemalloc.stop()
+
+
+def bench_rows(args):
+    """
+    Time to stream a --rows row listing of transactions, and memory to hold
+    it, with each row representation: a dict built per row and encoded per
+    row as the driver used to, RowMap batches, namedtuples and __slots__
+    dataclasses
+    """
+    DB = fresh_driver()
+    generate(DB, 100, args.rows)
+    cursor = DB.conn.execute("SELECT * FROM transactions;")
+    columns = [column[0] for column in cursor.description]
+    Record = namedtuple("Record", columns)
+    Slots = dataclasses.make_dataclass("Slots", columns, slots=True)
+
+    def fetch(factory=None):
+        cursor = DB.conn.cursor()
+        cursor.row_factory = factory
+        cursor.execute("SELECT * FROM transactions;")
+        while True:
+            rows = cursor.fetchmany(db.FETCH_SIZE)
+            if not rows:
+                return
+            yield rows
+
+    def per_row():
+        for rows in fetch():
+            for row in rows:
+                yield {
+                    "id": row[0],
+                    "timestamp": row[1],
+                    "sender_id": row[2],
+                    "receiver_id": row[3],
+                    "amount": row[4],
+                    "message": row[5],
+                    "accepted": row[6],
+                }
+
+    def row_map():
+        for rows in fetch():
+            yield from db.TRANSACTION.many(rows)
+
+    def records():
+        for rows in fetch(lambda cursor, row: Record._make(row)):
+            yield from rows
+
+    def slots():
+        for rows in fetch(lambda cursor, row: Slots(*row)):
+            yield from rows
+
+    def encode_per_row(items):
+        return b",".join(response.dumps(item) for item in items)
+
+    def encode_stream(items):
+        return b"".join(response.stream_json("transactions", items))
+
+    representations = {
+        "dict per row": (per_row, encode_per_row),
+        "RowMap": (row_map, encode_stream),
+        "namedtuple": (
+            records,
+            lambda items: encode_stream(item._asdict() for item in items),
+        ),
+    }
+    if "orjson" in response.BACKENDS and response.dumps is response.BACKENDS["orjson"]:
+        representations["__slots__"] = (slots, encode_stream)
+
+    print("rows per listing: %d" % args.rows)
+    print("representation   stream ms  held MB")
+    for name, (items, encode) in representations.items():
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            encode(items())
+            times.append((time.perf_counter() - start) * 1000)
+        held = held_memory(lambda: list(items()))
+        print("%-15s  %9.1f  %7.1f" % (name, min(times), held))
+
+
+def interleave(DB, args):
+    """
+    Adds --users users with 10 transactions each, then runs threads that
+    interleave cached reads with every kind of write, and returns the
+    operations per second
+    """
+    generate(DB, args.users, args.users * 10)
+
+    def other():
+        return random.randint(1, args.users)
+
+    def pending():
+        row = DB.conn.execute(
+            "SELECT id FROM transactions WHERE accepted IS NULL ORDER BY random() LIMIT 1;"
+        ).fetchone()
+        return row and row[0]
+
+    writes = [
+        lambda id: DB.update_balances_by_id(id, other(), random.randint(1, 100)),
+        lambda id: DB.insert_transaction_table(id, other(), 5, "x", "true"),
+        lambda id: DB.insert_transaction_table(id, other(), 5, "x"),
+        lambda id: DB.accept_transaction_by_id(pending()),
+        lambda id: DB.update_transaction_by_id(pending(), "false"),
+        lambda id: DB.insert_transactions_bulk(
+            [
+                {"sender_id": id, "receiver_id": other(), "amount": 1, "message": "x"},
+                {"sender_id": other(), "receiver_id": id, "amount": 1, "message": "x"},
+            ]
+        ),
+    ]
+
+    def work():
+        id = other()
+        roll = random.random()
+        if roll < args.writes:
+            random.choice(writes)(id)
+        elif roll < args.writes + args.deletes:
+            DB.delete_user_by_id(id)
+        else:
+            DB.get_user_by_id(id)
+
+    return run_threads(args.workers, args.seconds, work)
+
+
+def stale_users(DB, users):
+    """
+    Returns how many of users 1 to `users` are cached differently from how
+    they are in the database
+    """
+    stale = 0
+    for id in range(1, users + 1):
+        cached = DB.user_cache.get(id, DB.user_cache.MISSING)
+        if cached is not DB.user_cache.MISSING:
+            stale += cached != DB.load_versioned_user(id)
+    return stale
+
+
+def bench_consistency(args):
+    """
+    Ops/sec and user cache hit rate while threads interleave cached reads
+    with every kind of write. test_db.py checks that no cached user is left
+    stale
+    """
+    DB = fresh_driver()
+    rate = interleave(DB, args)
+    stats = DB.user_cache.stats()
+    stale = stale_users(DB, args.users)
+    print("%.1f ops/sec, hit rate %.3f, %d stale" % (rate, stats["hit_rate"], stale))
+
+
+def bench_startup(args):
+    """
+    Worker spin-up on an existing database: the schema bootstrap each worker
+    used to run (the WAL pragma and every CREATE ... IF NOT EXISTS) against
+    migrate(), the first read on a new connection, IN-list lookups of every
+    size against one JSON array parameter, and a new process importing the app
+    """
+    DB = fresh_driver()
+    generate(DB, args.users, args.transactions)
+    runs = range(args.runs)
+
+    def legacy_bootstrap(_):
+        DB.local = threading.local()
+        DB.conn.execute("PRAGMA journal_mode = WAL;")
+        for name in db.MIGRATIONS:
+            getattr(DB, name)()
+        DB.conn.commit()
+
+    def bootstrap(_):
+        DB.local = threading.local()
+        DB.migrate()
+
+    def first_read(_):
+        DB.local = threading.local()
+        DB.load_versioned_user(1)
+
+    print("step                        p50 ms   p99 ms")
+    for name, work in (
+        ("legacy bootstrap", legacy_bootstrap),
+        ("migrate", bootstrap),
+        ("first read", first_read),
+        ("warm read", lambda _: DB.load_versioned_user(1)),
+    ):
+        print("%-26s %7.3f  %7.3f" % ((name,) + latency(runs, work)))
+
+    def legacy_balances(ids):
+        DB.conn.execute(
+            "SELECT id, balance FROM user WHERE id IN (%s);"
+            % ", ".join("?" * len(ids)),
+            ids,
+        ).fetchall()
+
+    sizes = [random.randint(1, 500) for _ in range(args.runs)]
+    lookups = [random.sample(range(1, args.users + 1), size) for size in sizes]
+    for name, work in (
+        ("IN lists, any size", legacy_balances),
+        ("json_each", DB.get_balances),
+    ):
+        DB.local = threading.local()
+        print("%-26s %7.3f  %7.3f" % ((name,) + latency(lookups, work)))
+
+    env = dict(os.environ, PYTHONPATH=HERE)
+    for name, code in (("python", "pass"), ("python, import app", "import app")):
+        times = []
+        for _ in range(args.processes):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], env=env, check=True)
+            times.append((time.perf_counter() - start) * 1000)
+        times.sort()
+        print("%-26s %7.1f" % (name + " process", times[len(times) // 2]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    reads = sub.add_parser("reads", help=bench_reads.__doc__.strip())
+    reads.add_argument("--users", type=int, default=1000)
+    reads.add_argument("--seconds", type=float, default=2.0)
+    reads.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    reads.set_defaults(func=bench_reads)
+
+    transfers = sub.add_parser("transfers", help=bench_transfers.__doc__.strip())
+    transfers.add_argument("--users", type=int, default=100)
+    transfers.add_argument("--history", type=int, default=5000)
+    transfers.add_argument("--seconds", type=float, default=2.0)
+    transfers.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    transfers.set_defaults(func=bench_transfers)
+
+    gen = sub.add_parser("generate", help=bench_generate.__doc__.strip())
+    gen.add_argument("--dir")
+    gen.add_argument("--users", type=int, default=1000)
+    gen.add_argument("--transactions", type=int, default=100000)
+    gen.add_argument("--hot", type=float, default=0.0)
+    gen.set_defaults(func=bench_generate)
+
+    join = sub.add_parser("join", help=bench_join.__doc__.strip())
+    join.add_argument("--sizes", type=int, nargs="+", default=[10**4, 10**5, 10**6])
+    join.add_argument("--calls", type=int, default=200)
+    join.add_argument("--hot", type=float, default=0.01)
+    join.set_defaults(func=bench_join)
+
+    encode = sub.add_parser("encode", help=bench_encode.__doc__.strip())
+    encode.add_argument("--rows", type=int, default=10000)
+    encode.add_argument("--repeat", type=int, default=20)
+    encode.set_defaults(func=bench_encode)
+
+    stream = sub.add_parser("stream", help=bench_stream.__doc__.strip())
+    stream.add_argument("--sizes", type=int, nargs="+", default=[10**4, 10**5, 10**6])
+    stream.set_defaults(func=bench_stream)
+
+    rows = sub.add_parser("rows", help=bench_rows.__doc__.strip())
+    rows.add_argument("--rows", type=int, default=100000)
+    rows.add_argument("--repeat", type=int, default=3)
+    rows.set_defaults(func=bench_rows)
+
+    consistency = sub.add_parser(
+        "consistency", help=bench_consistency.__doc__.strip()
+    )
+    consistency.add_argument("--users", type=int, default=200)
+    consistency.add_argument("--workers", type=int, default=8)
+    consistency.add_argument("--seconds", type=float, default=3.0)
+    consistency.add_argument("--writes", type=float, default=0.2)
+    consistency.add_argument("--deletes", type=float, default=0.001)
+    consistency.set_defaults(func=bench_consistency)
+
+    startup = sub.add_parser("startup", help=bench_startup.__doc__.strip())
+    startup.add_argument("--users", type=int, default=1000)
+    startup.add_argument("--transactions", type=int, default=100000)
+    startup.add_argument("--runs", type=int, default=200)
+    startup.add_argument("--processes", type=int, default=10)
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
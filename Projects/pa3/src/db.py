@@ -1,5 +1,142 @@
+import json
 import os
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from cache import LRUCache
+from graph import FriendGraph
+from rows import RowMap
+
+# Transaction history is served newest first, at most MAX_PAGE_SIZE at a time
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Listings are read from the database this many rows at a time
+FETCH_SIZE = 1000
+
+# At most this many users (with their first page of history) are cached
+USER_CACHE_SIZE = 10000
+
+# Columns of a user's public profile, and of the user themselves
+PROFILE = RowMap("id", "name", "username")
+USER = RowMap("id", "name", "username", "balance")
+
+# Columns of the transactions table. History rows are served without their
+# id, and inside a user without their timestamp as well
+TRANSACTION = RowMap(
+    "id", "timestamp", "sender_id", "receiver_id", "amount", "message", "accepted"
+)
+HISTORY = RowMap(
+    None, "timestamp", "sender_id", "receiver_id", "amount", "message", "accepted"
+)
+USER_HISTORY = RowMap(
+    None, None, "sender_id", "receiver_id", "amount", "message", "accepted"
+)
+
+# The schema, as the driver methods that create it, in the order they were
+# added. A database's PRAGMA user_version counts the ones it has had run, so
+# new ones go at the end
+MIGRATIONS = (
+    "create_user_table",
+    "create_transactions_table",
+    "create_friendships_table",
+    "create_versions_table",
+    "create_indexes",
+)
+
+# Every statement the driver runs, by name. sqlite3 caches prepared
+# statements per connection, keyed by their SQL, so each of these is only
+# prepared once per connection. Lists of ids are passed as one JSON array
+# parameter, so a lookup of any number of ids is still a single statement
+STATEMENTS = {
+    "version": "SELECT version FROM versions WHERE resource = ?;",
+    "bump_version": """INSERT INTO versions(resource, version) VALUES (?, 1)
+        ON CONFLICT(resource) DO UPDATE SET version = version + 1;""",
+    "users": "SELECT id, name, username FROM user",
+    "user": "SELECT id, name, username, balance FROM user WHERE id = ?;",
+    "insert_user": "INSERT INTO user(name, username, balance) VALUES (?, ?, ?);",
+    "delete_user": "DELETE FROM user WHERE id = ?;",
+    "debit": "UPDATE user SET balance = balance - ? WHERE id = ? AND balance >= ? AND ? > 0;",
+    "credit": "UPDATE user SET balance = balance + ? WHERE id = ?;",
+    "balances": "SELECT id, balance FROM user WHERE id IN (SELECT value FROM json_each(?));",
+    "profiles": "SELECT id, name, username FROM user WHERE id IN (SELECT value FROM json_each(?));",
+    "insert_transaction": "INSERT INTO transactions(sender_id, receiver_id, amount, message, accepted) VALUES (?, ?, ?, ?, ?);",
+    "last_insert_id": "SELECT last_insert_rowid();",
+    "transaction": "SELECT * FROM transactions WHERE id = ?;",
+    "transaction_users": "SELECT sender_id, receiver_id FROM transactions WHERE id = ?;",
+    "pending_transaction": "SELECT sender_id, receiver_id, amount FROM transactions WHERE id = ? AND accepted IS NULL;",
+    "set_accepted": "UPDATE transactions SET accepted = ? WHERE id = ? AND accepted IS NULL;",
+    "friendships_after": "SELECT id, user_id, friend_id FROM friendships WHERE id > ? ORDER BY id;",
+    "insert_friendship": "INSERT INTO friendships(user_id, friend_id) VALUES (?, ?);",
+    "friends": """SELECT user.id, user.name, user.username
+        FROM friendships INNER JOIN user ON user.id = friendships.friend_id
+        WHERE friendships.user_id = ? AND friendships.friend_id > ?
+        ORDER BY friendships.friend_id LIMIT ?;""",
+}
+
+# History pages are built from any of 4 optional filters, and so take up to
+# this many statements of their own
+HISTORY_STATEMENTS = 16
+
+# Each connection's statement cache holds every statement above, plus a few
+# for BEGIN and PRAGMA, so none of them is ever evicted and prepared again
+STATEMENT_CACHE_SIZE = len(STATEMENTS) + HISTORY_STATEMENTS + 8
+
+
+def user_resource(id):
+    """
+    Returns the name a user's version is kept under in the versions table.
+    It covers the user and every transaction they sent or received
+    """
+    return "user:%d" % id
+
+
+def valid_amount(amount):
+    """
+    Returns whether `amount` can be moved between users: a positive int
+    """
+    return type(amount) == int and amount > 0
+
+
+# Why a transaction wasn't inserted or accepted, in an {"error": ...} result
+BAD_REQUEST = "Bad request"
+INSUFFICIENT_FUNDS = "Insufficient funds!"
+ALREADY_DECIDED = "Can not edit this transaction."
+
+
+def invalid_transaction(t):
+    """
+    Returns whether `t` isn't a transaction that can be inserted: a dict
+    with int user ids, a valid amount and a message
+    """
+    return (
+        type(t) != dict
+        or type(t.get("sender_id")) != int
+        or type(t.get("receiver_id")) != int
+        or not valid_amount(t.get("amount"))
+        or type(t.get("message")) != str
+    )
+
+
+def make_cursor(timestamp, id):
+    """
+    Returns the pagination cursor for a transaction
+    """
+    return "%s,%d" % (timestamp, id)
+
+
+def parse_cursor(cursor):
+    """
+    Returns the (timestamp, id) key in a pagination cursor. Raises
+    ValueError if the cursor is malformed
+    """
+    timestamp, separator, id = cursor.rpartition(",")
+    if not separator or not timestamp:
+        raise ValueError("invalid cursor %r" % (cursor,))
+    return [timestamp, int(id)]
 
 
 # From: https://goo.gl/YzypOI
@@ -22,12 +159,56 @@ class DatabaseDriver(object):
 
     def __init__(self):
         """
-        Secure a connection with the database and stores it into the instance variable 'conn'
+        Sets up per-thread connections with the database and brings its
+        schema up to date
+        """
+        self.local = threading.local()
+        self.group_commit = None
+        self.user_cache = LRUCache(USER_CACHE_SIZE)
+        self.migrate()
+        self.friend_graph = FriendGraph()
+        self.get_friend_graph()
+
+    @property
+    def conn(self):
+        """
+        Returns the calling thread's connection with the database, opening
+        it on first use
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect("users.db", cached_statements=STATEMENT_CACHE_SIZE)
+            self.local.conn = conn
+        return conn
+
+    def schema_version(self):
+        """
+        Using SQL, returns how many of MIGRATIONS the database has had run
         """
-        self.conn = sqlite3.connect("users.db", check_same_thread=False)
-        self.create_user_table()
-        self.create_transactions_table()
-        self.create_friendships_table()
+        return self.conn.execute("PRAGMA user_version;").fetchone()[0]
+
+    def migrate(self):
+        """
+        Using SQL, runs the MIGRATIONS the database hasn't had yet in one
+        transaction, and switches a new database file to WAL mode so readers
+        never wait on writers. On an up-to-date database this is a single
+        PRAGMA read, so starting a worker runs no DDL
+        """
+        if self.schema_version() >= len(MIGRATIONS):
+            return
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            # another worker may have migrated it while we waited for the lock
+            version = self.schema_version()
+            for name in MIGRATIONS[version:]:
+                getattr(self, name)()
+            if version < len(MIGRATIONS):
+                self.conn.execute("PRAGMA user_version = %d;" % len(MIGRATIONS))
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
 
     def create_user_table(self):
         """
@@ -42,6 +223,35 @@ class DatabaseDriver(object):
             );"""
         )
 
+    def create_versions_table(self):
+        """
+        Using SQL, creates a table of version counters by resource name. A
+        write bumps the versions of what it changes in its own transaction
+        """
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS versions(
+            resource TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+            );"""
+        )
+
+    def get_version(self, resource):
+        """
+        Using SQL, returns the version of a resource, 0 if it was never written
+        """
+        cursor = self.conn.execute(STATEMENTS["version"], (resource,))
+        row = cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    def bump_versions(self, resources):
+        """
+        Using SQL, increments the version of each resource inside the current
+        transaction, so the new versions commit along with the write
+        """
+        self.conn.executemany(
+            STATEMENTS["bump_version"], [(resource,) for resource in resources]
+        )
+
     def delete_user_table(self):
         """
         Using SQL, deletes a user table
@@ -52,62 +262,156 @@ class DatabaseDriver(object):
         """
         Using SQL, returns all users in a table
         """
-        cursor = self.conn.execute("SELECT * FROM user")
-        users = []
-        for row in cursor:
-            users.append({"id": row[0], "name": row[1], "username": row[2]})
-        return users
+        return list(self.iter_all_users())
 
-    def get_user_by_id(self, id):
+    def iter_all_users(self):
         """
-        Using SQL, returns a task by id
+        Using SQL, yields every user in the table, fetching FETCH_SIZE rows
+        at a time
         """
-        transactions = []
-        cursor1 = self.conn.execute(
-            "SELECT * FROM transactions WHERE sender_id = ?;", (id,)
-        )
-        for row in cursor1:
-            transactions.append(
-                {
-                    "sender_id": row[2],
-                    "receiver_id": row[3],
-                    "amount": row[4],
-                    "message": row[5],
-                    "accepted": row[6],
-                }
+        cursor = self.conn.execute(STATEMENTS["users"])
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from PROFILE.many(rows)
+
+    def get_user_by_id(self, id, **page):
+        """
+        Returns a user and one page of their transactions by id. `page`
+        takes the arguments of history_filters. Users with their first page
+        are cached until they or their transactions are written to, and
+        checked against their version in the database before a cached one is
+        returned, so writes from other worker processes are seen
+        """
+        entry = self.get_versioned_user(id, **page)
+        return None if entry is None else entry[1]
+
+    def get_versioned_user(self, id, **page):
+        """
+        Returns (version, user) for a user and one page of their transactions
+        by id, or None if there is none. Cached like get_user_by_id
+        """
+        if any(value is not None for value in page.values()):
+            return self.load_versioned_user(id, **page)
+        entry = self.user_cache.get_or_load(id, lambda: self.load_versioned_user(id))
+        if entry is not None and entry[0] != self.get_version(user_resource(id)):
+            # written by another worker process since it was cached
+            self.user_cache.invalidate(id)
+            entry = self.user_cache.get_or_load(
+                id, lambda: self.load_versioned_user(id)
             )
-        cursor2 = self.conn.execute(
-            "SELECT * FROM transactions WHERE receiver_id = ?;", (id,)
-        )
-        for row in cursor2:
-            transactions.append(
-                {
-                    "sender_id": row[2],
-                    "receiver_id": row[3],
-                    "amount": row[4],
-                    "message": row[5],
-                    "accepted": row[6],
-                }
+        return None if entry is None else (entry[0], dict(entry[1]))
+
+    def load_versioned_user(self, id, **page):
+        """
+        Using SQL, returns (version, user) for a user and one page of their
+        transactions by id, all read in one transaction, or None if there is
+        none. Bypasses the cache
+        """
+        self.conn.execute("BEGIN;")
+        try:
+            user = self.load_user_by_id(id, **page)
+            version = self.get_version(user_resource(id))
+        finally:
+            self.conn.rollback()
+        return None if user is None else (version, user)
+
+    def load_user_by_id(self, id, **page):
+        """
+        Using SQL, returns a user and one page of their transactions by id,
+        bypassing the cache
+        """
+        cursor = self.conn.execute(STATEMENTS["user"], (id,))
+        user = USER.one(cursor.fetchone())
+        if user is None:
+            return None
+        rows, cursors = self.get_history(id, **page)
+        user["transactions"] = USER_HISTORY.many(rows)
+        user["cursors"] = cursors
+        return user
+
+    def get_history(self, user_id, **page):
+        """
+        Using SQL, returns one page of the transactions a user sent or
+        received as rows (id, timestamp, sender_id, receiver_id, amount,
+        message, accepted), newest first, and the cursors around it. `page`
+        takes the arguments of history_filters.
+
+        Each side of the UNION ALL joins the user to their transactions
+        through one index, and stops after a page of rows
+        """
+        conditions, params, order, limit = self.history_filters(**page)
+        branch = """SELECT * FROM (
+            SELECT transactions.id, timestamp, sender_id, receiver_id, amount, message, accepted
+            FROM user INNER JOIN transactions ON %s
+            WHERE user.id = ?%s
+            ORDER BY timestamp {0}, transactions.id {0} LIMIT ?)""".format(order)
+        cursor = self.conn.execute(
+            branch % ("transactions.sender_id = user.id", conditions)
+            + " UNION ALL "
+            + branch
+            % (
+                "transactions.receiver_id = user.id AND transactions.sender_id != user.id",
+                conditions,
             )
-        cursor3 = self.conn.execute("SELECT * FROM user WHERE id = ?;", (id,))
-        for row in cursor3:
-            return {
-                "id": row[0],
-                "name": row[1],
-                "username": row[2],
-                "balance": row[3],
-                "transactions": transactions,
-            }
-        return None
+            + " ORDER BY timestamp {0}, id {0} LIMIT ?;".format(order),
+            [user_id] + params + [limit, user_id] + params + [limit, limit],
+        )
+        return self.history_page(cursor.fetchall(), order, limit)
+
+    def history_filters(
+        self, limit=None, before=None, after=None, since=None, until=None
+    ):
+        """
+        Returns the extra WHERE conditions and their parameters, the sort
+        order and the row limit for one page of transaction history.
+
+        before/after: cursors of the page to continue from, going older/newer
+        since/until: inclusive timestamp bounds
+        """
+        if limit is None:
+            limit = PAGE_SIZE
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        conditions = ""
+        params = []
+        if before is not None:
+            conditions += " AND (transactions.timestamp, transactions.id) < (?, ?)"
+            params += parse_cursor(before)
+        if after is not None:
+            conditions += " AND (transactions.timestamp, transactions.id) > (?, ?)"
+            params += parse_cursor(after)
+        if since is not None:
+            conditions += " AND transactions.timestamp >= ?"
+            params.append(since)
+        if until is not None:
+            conditions += " AND transactions.timestamp <= ?"
+            params.append(until)
+        order = "ASC" if after is not None and before is None else "DESC"
+        return conditions, params, order, limit
+
+    def history_page(self, rows, order, limit):
+        """
+        Puts a page of transaction rows (id and timestamp first) newest first
+        and returns it with the before/after cursors of its neighbouring
+        pages. The cursor in the direction being paged is None once a short
+        page shows there is nothing more
+        """
+        if order == "ASC":
+            rows.reverse()
+        cursors = {"before": None, "after": None}
+        if rows:
+            cursors["before"] = make_cursor(rows[-1][1], rows[-1][0])
+            cursors["after"] = make_cursor(rows[0][1], rows[0][0])
+            if len(rows) < limit:
+                cursors["before" if order == "DESC" else "after"] = None
+        return rows, cursors
 
     def insert_user_table(self, name, username, balance):
         """
         Using SQL, inserts a task into the task table
         """
-        cursor = self.conn.execute(
-            "INSERT INTO user(name, username, balance) VALUES (?, ?, ?);",
-            (name, username, balance),
-        )
+        cursor = self.conn.execute(STATEMENTS["insert_user"], (name, username, balance))
         self.conn.commit()
         return cursor.lastrowid
 
@@ -115,29 +419,53 @@ class DatabaseDriver(object):
         """
         Using SQL, deletes a user from a table
         """
-        self.conn.execute("DELETE FROM user WHERE id = ?;", (id,))
+        self.conn.execute(STATEMENTS["delete_user"], (id,))
+        self.bump_versions([user_resource(id)])
         self.conn.commit()
+        self.user_cache.invalidate(id)
 
-    def update_balances_by_id(self, sender_id, receiver_id, amount):
+    def invalidate_users(self, ids):
         """
-        Using SQL, updates a user in the table
+        Drops the given users from the user cache. Writers call this after
+        committing, so a reader can't cache what was there before
         """
-        sender_user = self.get_user_by_id(sender_id)
-        sender_balance = sender_user["balance"] - amount
+        for id in ids:
+            self.user_cache.invalidate(id)
 
-        receiver_user = self.get_user_by_id(receiver_id)
-        receiver_balance = receiver_user["balance"] + amount
+    def update_balances_by_id(self, sender_id, receiver_id, amount):
+        """
+        Using SQL, moves amount from the sender to the receiver in a single
+        transaction. Returns False and changes nothing if the amount isn't
+        positive, the sender can't cover it or either user doesn't exist
+        """
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            moved = self.move_balance(sender_id, receiver_id, amount)
+            if moved:
+                self.bump_versions(map(user_resource, (sender_id, receiver_id)))
+        except Exception:
+            self.conn.rollback()
+            raise
+        if moved:
+            self.conn.commit()
+            self.invalidate_users((sender_id, receiver_id))
+        else:
+            self.conn.rollback()
+        return moved
 
-        self.conn.execute(
-            "UPDATE user SET balance = ? WHERE id = ?;",
-            (sender_balance, sender_id),
-        )
-        self.conn.execute(
-            "UPDATE user SET balance = ? WHERE id = ?;",
-            (receiver_balance, receiver_id),
+    def move_balance(self, sender_id, receiver_id, amount):
+        """
+        Using SQL, debits the sender and credits the receiver inside the
+        current transaction. Returns whether both balances were updated; an
+        amount that isn't positive debits no one, so it never moves money
+        """
+        cursor = self.conn.execute(
+            STATEMENTS["debit"], (amount, sender_id, amount, amount)
         )
-
-        self.conn.commit()
+        if cursor.rowcount != 1:
+            return False
+        cursor = self.conn.execute(STATEMENTS["credit"], (amount, receiver_id))
+        return cursor.rowcount == 1
 
     def create_transactions_table(self):
         """
@@ -167,44 +495,184 @@ class DatabaseDriver(object):
         self, sender_id, receiver_id, amount, message, accepted=None
     ):
         """
-        Using SQL, inserts a transaction into the transactions table
-        """
-        cursor = self.conn.execute(
-            "INSERT INTO transactions(sender_id, receiver_id, amount, message, accepted) VALUES (?, ?, ?, ?, ?);",
-            (sender_id, receiver_id, amount, message, accepted),
-        )
-        if accepted == "true":
-            self.update_balances_by_id(sender_id, receiver_id, amount)
+        Using SQL, inserts a transaction into the transactions table. An
+        accepted transaction moves the money in the same database transaction.
+        Returns a result like insert_transactions_bulk's, grouped or not:
+        {"id": ...}, or {"error": ...} if it is invalid or the sender can't
+        cover it
+        """
+        transaction = {
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "amount": amount,
+            "message": message,
+            "accepted": accepted,
+        }
+        if self.group_commit is not None:
+            return self.group_commit.submit(transaction)
+        if invalid_transaction(transaction):
+            return {"error": BAD_REQUEST}
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            cursor = self.conn.execute(
+                STATEMENTS["insert_transaction"],
+                (sender_id, receiver_id, amount, message, accepted),
+            )
+            if accepted == "true" and not self.move_balance(
+                sender_id, receiver_id, amount
+            ):
+                self.conn.rollback()
+                return {"error": INSUFFICIENT_FUNDS}
+            self.bump_versions(map(user_resource, (sender_id, receiver_id)))
+        except Exception:
+            self.conn.rollback()
+            raise
         self.conn.commit()
-        return cursor.lastrowid
+        self.invalidate_users((sender_id, receiver_id))
+        return {"id": cursor.lastrowid}
+
+    def insert_transactions_bulk(self, transactions):
+        """
+        Using SQL, inserts a list of transactions and moves the money for the
+        accepted ones in a single database transaction. Returns one result per
+        transaction, in order: {"id": ...} if it was inserted, otherwise
+        {"error": ...}
+        """
+        results = []
+        rows = []
+        deltas = {}
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            balances = self.get_balances(
+                {
+                    t.get(key)
+                    for t in transactions
+                    if type(t) == dict
+                    for key in ("sender_id", "receiver_id")
+                }
+            )
+            for t in transactions:
+                if invalid_transaction(t):
+                    results.append({"error": BAD_REQUEST})
+                    continue
+                sender_id = t["sender_id"]
+                receiver_id = t["receiver_id"]
+                amount = t["amount"]
+                message = t["message"]
+                accepted = t.get("accepted")
+                if accepted == "true":
+                    sender_balance = balances.get(sender_id)
+                    if (
+                        sender_balance is None
+                        or sender_balance < amount
+                        or balances.get(receiver_id) is None
+                    ):
+                        results.append({"error": INSUFFICIENT_FUNDS})
+                        continue
+                    balances[sender_id] -= amount
+                    balances[receiver_id] += amount
+                    deltas[sender_id] = deltas.get(sender_id, 0) - amount
+                    deltas[receiver_id] = deltas.get(receiver_id, 0) + amount
+                results.append({})
+                rows.append((sender_id, receiver_id, amount, message, accepted))
+            self.conn.executemany(STATEMENTS["insert_transaction"], rows)
+            self.conn.executemany(
+                STATEMENTS["credit"], [(delta, id) for id, delta in deltas.items()]
+            )
+            # rows are appended under the write lock, so their ids are consecutive
+            last_id = self.conn.execute(STATEMENTS["last_insert_id"]).fetchone()[0]
+            user_ids = {id for row in rows for id in row[:2]}
+            self.bump_versions(map(user_resource, user_ids))
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.invalidate_users(user_ids)
+        next_id = last_id - len(rows) + 1
+        for result in results:
+            if "error" not in result:
+                result["id"] = next_id
+                next_id += 1
+        return results
+
+    def get_balances(self, ids):
+        """
+        Using SQL, returns a dict of balance by user id for the given ids
+        """
+        cursor = self.conn.execute(STATEMENTS["balances"], (json.dumps(list(ids)),))
+        return dict(cursor)
+
+    def enable_group_commit(self, window):
+        """
+        Routes insert_transaction_table through a GroupCommit so that
+        concurrent inserts share one commit every `window` seconds
+        """
+        self.group_commit = GroupCommit(self, window)
 
     def get_transaction_by_id(self, id):
         """
         Using SQL, returns a transaction by id
         """
-        cursor = self.conn.execute("SELECT * FROM transactions WHERE id = ?;", (id,))
-        for row in cursor:
-            return {
-                "id": row[0],
-                "timestamp": row[1],
-                "sender_id": row[2],
-                "receiver_id": row[3],
-                "amount": row[4],
-                "message": row[5],
-                "accepted": row[6],
-            }
-        return None
+        cursor = self.conn.execute(STATEMENTS["transaction"], (id,))
+        return TRANSACTION.one(cursor.fetchone())
 
     def update_transaction_by_id(self, id, status):
         """
-        Using SQL, updates a transaction in the table
+        Using SQL, sets the status of a pending transaction. Returns False
+        and changes nothing if it was already accepted or denied
+        """
+        cursor = self.conn.execute(STATEMENTS["set_accepted"], (status, id))
+        if cursor.rowcount != 1:
+            self.conn.rollback()
+            return False
+        row = self.conn.execute(STATEMENTS["transaction_users"], (id,)).fetchone()
+        self.bump_versions(map(user_resource, row))
+        self.conn.commit()
+        self.invalidate_users(row)
+        return True
+
+    def accept_transaction_by_id(self, id):
+        """
+        Using SQL, accepts a pending transaction and moves its amount in a
+        single transaction. Returns {"id": id}, or changes nothing and returns
+        {"error": ALREADY_DECIDED} if it is no longer pending, or
+        {"error": INSUFFICIENT_FUNDS} if the sender can't cover it
+        """
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            row = self.conn.execute(STATEMENTS["pending_transaction"], (id,)).fetchone()
+            if row is None:
+                result = {"error": ALREADY_DECIDED}
+            elif not self.move_balance(*row):
+                result = {"error": INSUFFICIENT_FUNDS}
+            else:
+                self.conn.execute(STATEMENTS["set_accepted"], ("true", id))
+                self.bump_versions(map(user_resource, row[:2]))
+                result = {"id": id}
+        except Exception:
+            self.conn.rollback()
+            raise
+        if "error" in result:
+            self.conn.rollback()
+        else:
+            self.conn.commit()
+            self.invalidate_users(row[:2])
+        return result
+
+    def create_indexes(self):
+        """
+        Using SQL, creates the indexes for looking up a user's transactions
+        and friends, so those lookups don't scan the whole table
         """
         self.conn.execute(
-            "UPDATE transactions SET accepted = ? WHERE id = ?;",
-            (status, id),
+            "CREATE INDEX IF NOT EXISTS transactions_sender ON transactions(sender_id, timestamp);"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS transactions_receiver ON transactions(receiver_id, timestamp);"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS friendships_user ON friendships(user_id, friend_id);"
         )
-
-        self.conn.commit()
 
     # Tier 1 - Friendships
 
@@ -232,56 +700,106 @@ class DatabaseDriver(object):
         """
         Using SQL, inserts a friendship into the friendships table
         """
-        cursor = self.conn.execute(
-            "INSERT INTO friendships(user_id, friend_id) VALUES (?, ?);",
-            (user_id, friend_id),
-        )
+        self.conn.execute(STATEMENTS["insert_friendship"], (user_id, friend_id))
         self.conn.commit()
+        self.friend_graph.add(user_id, friend_id)
 
-    def get_friendships_by_id(self, user_id):
+    def get_friend_graph(self):
         """
-        Using SQL, returns a friendship by user id
+        Using SQL, adds the friendships inserted since the friend graph was
+        last brought up to date, by this or any other worker process, and
+        returns it. Friendships are never deleted and their ids only grow,
+        so those past the last id seen are all that is new
         """
         cursor = self.conn.execute(
-            "SELECT * FROM friendships WHERE user_id = ?;", (user_id,)
+            STATEMENTS["friendships_after"], (self.friend_graph.last_id,)
         )
-        friends = []
-        for row in cursor:
-            friends.append(row[2])
-        friends_detailed = []
-        for row2 in friends:
-            friend = self.get_user_by_id(row2)
-            friends_detailed.append(
-                {
-                    "id": friend["id"],
-                    "name": friend["name"],
-                    "username": friend["username"],
-                }
-            )
-        return friends_detailed
+        self.friend_graph.load(cursor)
+        return self.friend_graph
 
-    # Tier 2 - Join
-    def get_transactions_by_user(self, user_id):
+    def get_friendships_by_id(self, user_id, limit=None, after=None):
         """
-        Using SQL, returns transactions by user id
+        Using SQL, returns the profiles of a user's friends by user id,
+        ordered by friend id. Pass `limit`, and the last friend id seen as
+        `after`, to read them a page at a time
         """
         cursor = self.conn.execute(
-            "SELECT * FROM transactions INNER JOIN user ON transactions.sender_id=user.id OR transactions.receiver_id=user.id WHERE user.id = ?;",
-            (user_id,),
+            STATEMENTS["friends"],
+            (user_id, -1 if after is None else after, -1 if limit is None else limit),
         )
-        list = []
-        for row in cursor:
-            list.append(
-                {
-                    "sender_id": row[2],
-                    "receiver_id": row[3],
-                    "amount": row[4],
-                    "message": row[5],
-                    "accepted": row[6],
-                    "timestamp": row[1],
-                }
-            )
-        return list
+        return PROFILE.many(cursor.fetchall())
+
+    def get_profiles_by_ids(self, ids):
+        """
+        Using SQL, returns the id, name and username of each existing user
+        in `ids`, in the order of `ids`
+        """
+        ids = list(ids)
+        cursor = self.conn.execute(STATEMENTS["profiles"], (json.dumps(ids),))
+        profiles = {profile["id"]: profile for profile in PROFILE.many(cursor)}
+        return [profiles[id] for id in ids if id in profiles]
+
+    # Tier 2 - Join
+    def get_transactions_by_user(self, user_id, **page):
+        """
+        Using SQL, returns one page of transactions by user id and the
+        cursors of the pages around it. `page` takes the arguments of
+        history_filters
+        """
+        rows, cursors = self.get_history(user_id, **page)
+        return HISTORY.many(rows), cursors
+
+
+class GroupCommit(object):
+    """
+    Collects transactions submitted by concurrent requests and writes each
+    batch with insert_transactions_bulk on a background thread, so that one
+    commit (and one fsync) covers every request that arrived in the window
+    """
+
+    def __init__(self, driver, window):
+        """
+        Starts the background writer for `driver`
+        """
+        self.driver = driver
+        self.window = window
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, transaction):
+        """
+        Queues a transaction and waits for the commit that includes it.
+        Returns its insert_transactions_bulk result
+        """
+        future = Future()
+        self.queue.put((transaction, future))
+        return future.result()
+
+    def run(self):
+        """
+        Writes batches until the process exits
+        """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self.driver.insert_transactions_bulk(
+                    [transaction for transaction, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
 
 
 # Only <=1 instance of the database driver
@@ -0,0 +1,106 @@
+import heapq
+import threading
+
+
+class FriendGraph(object):
+    """
+    In-memory adjacency index of the friendships table.
+    Answers friend-graph questions by walking only the users involved, so
+    their cost doesn't depend on the size of the table.
+    """
+
+    def __init__(self):
+        """
+        Creates an empty graph. `friends` maps a user id to the ids they
+        friended, `friended_by` maps it to the ids that friended them, and
+        `last_id` is the highest friendship id loaded
+        """
+        self.lock = threading.Lock()
+        self.friends = {}
+        self.friended_by = {}
+        self.last_id = 0
+
+    def load(self, rows):
+        """
+        Adds every (id, user_id, friend_id) row in `rows`
+        """
+        for id, user_id, friend_id in rows:
+            self.add(user_id, friend_id)
+            with self.lock:
+                self.last_id = max(self.last_id, id)
+
+    def add(self, user_id, friend_id):
+        """
+        Adds the friendship from user_id to friend_id
+        """
+        with self.lock:
+            self.friends.setdefault(user_id, set()).add(friend_id)
+            self.friended_by.setdefault(friend_id, set()).add(user_id)
+
+    def mutual_friends(self, user_id, other_id):
+        """
+        Returns the sorted ids that both users have friended
+        """
+        with self.lock:
+            mutual = self.friends.get(user_id, set()) & self.friends.get(
+                other_id, set()
+            )
+        return sorted(mutual)
+
+    def suggestions(self, user_id, limit=10):
+        """
+        Returns up to `limit` (id, mutual friend count) pairs for the friends
+        of user_id's friends that user_id hasn't friended yet, most mutual
+        friends first
+        """
+        counts = {}
+        with self.lock:
+            friends = self.friends.get(user_id, set())
+            for friend_id in friends:
+                for id in self.friends.get(friend_id, ()):
+                    if id != user_id and id not in friends:
+                        counts[id] = counts.get(id, 0) + 1
+        return heapq.nsmallest(
+            limit, counts.items(), key=lambda item: (-item[1], item[0])
+        )
+
+    def degree(self, user_id, other_id, max_degree=6):
+        """
+        Returns the length of the shortest chain of friendships from user_id
+        to other_id, or None if there is none within max_degree. Searches
+        forward from user_id and backward from other_id a level at a time,
+        always growing the smaller frontier
+        """
+        if user_id == other_id:
+            return 0
+        with self.lock:
+            forward = {user_id: 0}
+            backward = {other_id: 0}
+            forward_frontier, backward_frontier = [user_id], [other_id]
+            for _ in range(max_degree):
+                if len(forward_frontier) <= len(backward_frontier):
+                    edges, frontier = self.friends, forward_frontier
+                    seen, other = forward, backward
+                else:
+                    edges, frontier = self.friended_by, backward_frontier
+                    seen, other = backward, forward
+                best = None
+                next_frontier = []
+                for id in frontier:
+                    for neighbour in edges.get(id, ()):
+                        if neighbour in other:
+                            length = seen[id] + 1 + other[neighbour]
+                            if best is None or length < best:
+                                best = length
+                        elif neighbour not in seen:
+                            seen[neighbour] = seen[id] + 1
+                            next_frontier.append(neighbour)
+                if best is not None:
+                    return best if best <= max_degree else None
+                if not next_frontier:
+                    return None
+                if seen is forward:
+                    forward_frontier = next_frontier
+                else:
+                    backward_frontier = next_frontier
+        return None
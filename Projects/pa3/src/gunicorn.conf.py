@@ -0,0 +1,20 @@
+"""
+Gunicorn settings for serving the app in production. From this directory,
+
+    gunicorn app:app
+
+runs WORKERS processes (one per core by default), each serving requests on
+THREADS threads, on port PORT. `python app.py` still runs Flask's debug
+server for development.
+
+The ASGI version of the app runs on the same settings, with uvicorn's
+worker class and DB_THREADS database threads per worker in place of THREADS:
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+"""
+import multiprocessing
+import os
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", 8000)
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("THREADS", 4))
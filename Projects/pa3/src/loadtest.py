@@ -0,0 +1,312 @@
+"""
+Load test for the Venmo app.
+
+Starts the app in each mode on a fresh database in a temporary directory,
+seeds it with users and transactions, then has every number of concurrent
+clients send requests for a while and reports requests/sec and p50/p99
+latency, e.g.
+
+    python loadtest.py --modes wsgi asgi --clients 100 250 500 1000
+
+wsgi serves app.py with Flask's threaded server and asgi serves asgi.py with
+uvicorn. The gunicorn modes serve them the way production does, through
+gunicorn.conf.py, once with each number of --workers, to show how
+throughput scales with worker processes:
+
+    python loadtest.py --modes gunicorn gunicorn-asgi --workers 1 2 4 8
+
+Pass --url to load an already running server instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG = os.path.join(HERE, "gunicorn.conf.py")
+
+# gunicorn takes the port, and its number of workers, from the environment
+SERVERS = {
+    "wsgi": [sys.executable, "-m", "flask", "--app", "app", "run", "--with-threads"],
+    "asgi": [sys.executable, "-m", "uvicorn", "asgi:app", "--log-level", "warning"],
+    "gunicorn": [sys.executable, "-m", "gunicorn", "-c", CONFIG, "app:app"],
+    "gunicorn-asgi": [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-c",
+        CONFIG,
+        "-k",
+        "uvicorn.workers.UvicornWorker",
+        "asgi:app",
+    ],
+}
+
+# Modes run once with each number of --workers
+MULTIPROCESS = ("gunicorn", "gunicorn-asgi")
+
+
+class Connection(object):
+    """
+    A keep-alive HTTP/1.1 connection that reconnects whenever the server
+    closes it
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        """
+        Sends a request and returns the response's (status, body)
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        head = (
+            "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n"
+            "Content-Length: %d\r\n\r\n" % (method, path, self.host, len(data))
+        )
+        self.writer.write(head.encode("latin-1") + data)
+        await self.writer.drain()
+        lines = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        lines = lines.split("\r\n")
+        version, status = lines[0].split(" ")[:2]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+        chunked = headers.get("transfer-encoding") == "chunked"
+        if "content-length" in headers:
+            payload = await self.reader.readexactly(int(headers["content-length"]))
+        elif chunked:
+            payload = await self.read_chunks()
+        else:
+            payload = await self.reader.read()
+        if (
+            headers.get("connection") == "close"
+            or version == "HTTP/1.0"
+            and headers.get("connection") != "keep-alive"
+            or "content-length" not in headers
+            and not chunked
+        ):
+            self.close()
+        return int(status), payload
+
+    async def read_chunks(self):
+        """
+        Returns a chunked response body
+        """
+        chunks = []
+        while True:
+            size = int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            chunk = await self.reader.readexactly(size + 2)
+            if size == 0:
+                return b"".join(chunks)
+            chunks.append(chunk[:-2])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def free_port():
+    """
+    Returns a TCP port nothing is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, workers=None):
+    """
+    Starts the app in `mode` on a fresh database, with `workers` worker
+    processes in the multi-process modes, and waits until it accepts
+    connections
+    """
+    env = dict(os.environ, PYTHONPATH=HERE, PORT=str(port))
+    command = SERVERS[mode]
+    if mode in MULTIPROCESS:
+        env["WORKERS"] = str(workers)
+    else:
+        command = command + ["--port", str(port)]
+    server = subprocess.Popen(
+        command,
+        cwd=tempfile.mkdtemp(),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit("%s server exited with %d" % (mode, server.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("%s server didn't start" % mode)
+
+
+async def seed(host, port, users, transactions):
+    """
+    Creates `users` users and `transactions` accepted transactions between
+    them
+    """
+    conn = Connection(host, port)
+    for i in range(users):
+        body = {"name": "User %d" % i, "username": "user%d" % i, "balance": 10**9}
+        await conn.request("POST", "/api/users/", body)
+    for _ in range(0, transactions, 1000):
+        batch = [
+            {
+                "sender_id": random.randint(1, users),
+                "receiver_id": random.randint(1, users),
+                "amount": 1,
+                "message": "seed",
+                "accepted": "true",
+            }
+            for _ in range(1000)
+        ]
+        await conn.request("POST", "/api/transactions/batch/", batch)
+    conn.close()
+
+
+async def client(host, port, args, deadline, latencies, errors):
+    """
+    Sends requests until `deadline`: mostly user and history reads, and a
+    `--writes` fraction of new transactions
+    """
+    conn = Connection(host, port)
+    while time.monotonic() < deadline:
+        user_id = random.randint(1, args.users)
+        roll = random.random()
+        if roll < args.writes:
+            method, path = "POST", "/api/transactions/"
+            body = {
+                "sender_id": user_id,
+                "receiver_id": random.randint(1, args.users),
+                "amount": 1,
+                "message": "load",
+                "accepted": "true",
+            }
+        elif roll < args.writes + (1 - args.writes) / 4:
+            method, path, body = "GET", "/api/extra/users/%d/join/" % user_id, None
+        else:
+            method, path, body = "GET", "/api/users/%d/" % user_id, None
+        start = time.perf_counter()
+        try:
+            status, _ = await conn.request(method, path, body)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            conn.close()
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors.append(status)
+    conn.close()
+
+
+async def run(host, port, clients, args):
+    """
+    Returns (requests/sec, p50, p99, errors) for `clients` concurrent clients
+    """
+    latencies, errors = [], []
+    start = time.monotonic()
+    deadline = start + args.seconds
+    await asyncio.gather(
+        *[
+            client(host, port, args, deadline, latencies, errors)
+            for _ in range(clients)
+        ]
+    )
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    if not latencies:
+        return 0.0, float("nan"), float("nan"), len(errors)
+    p50 = latencies[int(0.50 * (len(latencies) - 1))]
+    p99 = latencies[int(0.99 * (len(latencies) - 1))]
+    return len(latencies) / elapsed, p50, p99, len(errors)
+
+
+def raise_file_limit():
+    """
+    Raises the open file limit as far as allowed, since every client holds
+    a socket open
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--modes", nargs="+", default=["wsgi", "asgi"], choices=sorted(SERVERS)
+    )
+    parser.add_argument("--url", help="load this server instead of starting one")
+    parser.add_argument(
+        "--clients", type=int, nargs="+", default=[100, 250, 500, 1000]
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=100000)
+    parser.add_argument("--writes", type=float, default=0.1)
+    args = parser.parse_args()
+    raise_file_limit()
+
+    if args.url:
+        url = urlsplit(args.url)
+        targets = [(args.url, None, None)]
+    else:
+        targets = []
+        for mode in args.modes:
+            for workers in args.workers if mode in MULTIPROCESS else [None]:
+                name = mode if workers is None else "%s/%d" % (mode, workers)
+                targets.append((name, mode, workers))
+
+    print("server             clients       req/s   p50 ms   p99 ms  errors")
+    for name, mode, workers in targets:
+        # one server at a time, so they never compete for cores
+        if mode is None:
+            host, port, server = url.hostname, url.port or 80, None
+        else:
+            host, port = "127.0.0.1", free_port()
+            server = start_server(mode, port, workers)
+        try:
+            if server is not None:
+                asyncio.run(seed(host, port, args.users, args.transactions))
+            for clients in args.clients:
+                rate, p50, p99, errors = asyncio.run(run(host, port, clients, args))
+                print(
+                    "%-17s  %7d  %10.1f  %7.1f  %7.1f  %6d"
+                    % (name, clients, rate, p50 * 1000, p99 * 1000, errors)
+                )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Tests for the database driver.
+
+Run from this directory with `python -m pytest`. Every test works on a
+fresh database in its own temporary directory, so the app's own users.db
+is never touched.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+import pytest
+
+import db
+from bench import generate, interleave, stale_users
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Prints how far streaming GET /api/users/'s listing of the database in the
+# working directory raises the process's peak RSS, in KB
+STREAM_RSS = """
+import resource
+import db
+import response
+
+DB = db.DatabaseDriver()
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+for _ in response.stream_json("users", DB.iter_all_users()):
+    pass
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+"""
+
+
+@pytest.fixture
+def driver(tmp_path, monkeypatch):
+    """
+    Returns a driver for an empty database in a temporary directory
+    """
+    monkeypatch.chdir(tmp_path)
+    DB = db.DatabaseDriver()
+    # the driver is a singleton, so start it over on the new directory
+    DB.__init__()
+    return DB
+
+
+def capture_statements(DB, method, *args, **kwargs):
+    """
+    Calls a driver method and returns the SQL statements it ran
+    """
+    statements = []
+    DB.conn.set_trace_callback(statements.append)
+    try:
+        method(*args, **kwargs)
+    finally:
+        DB.conn.set_trace_callback(None)
+    return statements
+
+
+def table_scans(DB, sql):
+    """
+    Returns the steps of the query plan for `sql` that read through a whole
+    table or index. Scans of a subquery's rows or of a json_each argument
+    are bounded by the subquery or the argument, so they aren't returned
+    """
+    tables = {
+        row[0] for row in DB.conn.execute("SELECT name FROM sqlite_master;")
+    }
+    plan = [row[3] for row in DB.conn.execute("EXPLAIN QUERY PLAN " + sql)]
+    return [
+        step
+        for step in plan
+        if step.startswith("SCAN ") and step.split()[1] in tables
+    ]
+
+
+def test_per_user_statements_never_scan_a_table(driver):
+    for i in range(10):
+        driver.insert_user_table("User %d" % i, "user%d" % i, 100)
+        driver.insert_transaction_table(i + 1, 1, 1, "seed")
+        driver.insert_friendships_table(1, i + 1)
+    _, cursors = driver.get_transactions_by_user(1, limit=2)
+
+    lookups = [
+        (driver.load_versioned_user, 1),
+        (driver.get_transactions_by_user, 1),
+        (driver.get_transactions_by_user, 1, {"before": cursors["before"]}),
+        (driver.get_transactions_by_user, 1, {"after": cursors["after"]}),
+        (driver.get_transactions_by_user, 1, {"since": "2000-01-01"}),
+        (driver.get_transactions_by_user, 1, {"until": "2100-01-01"}),
+        (driver.get_friendships_by_id, 1),
+        (driver.get_friendships_by_id, 1, {"limit": 3, "after": 2}),
+        (driver.get_friend_graph,),
+        (driver.get_profiles_by_ids, [1, 2, 3]),
+        (driver.get_balances, [1, 2]),
+        (driver.get_transaction_by_id, 1),
+        (driver.update_balances_by_id, 1, 2, 1),
+        (driver.accept_transaction_by_id, 2),
+        (driver.update_transaction_by_id, 3, "false"),
+        (driver.delete_user_by_id, 10),
+    ]
+    scans = []
+    for method, *args in lookups:
+        kwargs = args.pop() if args and isinstance(args[-1], dict) else {}
+        for sql in capture_statements(driver, method, *args, **kwargs):
+            if sql.split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE"):
+                scans += [(method.__name__, step) for step in table_scans(driver, sql)]
+    assert scans == []
+
+
+def test_friends_list_takes_the_same_statements_for_any_number_of_friends(driver):
+    for i in range(502):
+        driver.insert_user_table("User %d" % i, "user%d" % i, 100)
+    counts = []
+    for user_id, friends in enumerate((1, 10, 500), start=1):
+        for friend_id in range(2, friends + 2):
+            driver.insert_friendships_table(user_id, friend_id)
+        statements = capture_statements(driver, driver.get_friendships_by_id, user_id)
+        counts.append(len(statements))
+    assert counts == [1, 1, 1]
+
+
+def test_no_cached_user_is_stale_after_concurrent_writes(driver):
+    args = argparse.Namespace(
+        users=200, workers=8, seconds=1.0, writes=0.2, deletes=0.001
+    )
+    interleave(driver, args)
+    assert driver.user_cache.stats()["hits"] > 0
+    assert stale_users(driver, args.users) == 0
+
+
+def stream_rss(directory):
+    """
+    Returns how far streaming the user listing of the database in
+    `directory` raises peak RSS, in MB. It runs in a new process, so
+    nothing this one has allocated hides the growth
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", STREAM_RSS],
+        cwd=directory,
+        env=dict(os.environ, PYTHONPATH=HERE),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return int(result.stdout) / 2**10
+
+
+def test_streaming_users_holds_the_same_memory_for_a_million_rows(driver, tmp_path):
+    generate(driver, 10**4, 0)
+    small = stream_rss(tmp_path)
+    generate(driver, 10**6 - 10**4, 0)
+    large = stream_rss(tmp_path)
+    # building the million-user listing first raises it by about 400 MB
+    assert large <= small + 16
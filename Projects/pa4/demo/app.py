@@ -5,6 +5,7 @@ from flask import Flask, request
 from db import Task
 from db import Subtask
 from db import Category
+from response import success_response, failure_response
 
 # define db filename
 db_filename = "todo.db"
@@ -21,15 +22,6 @@ with app.app_context():
     db.create_all()
 
 
-# generalized response formats
-def success_response(data, code=200):
-    return json.dumps(data), code
-
-
-def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
-
-
 # -- TASK ROUTES ------------------------------------------------------
 
 
@@ -1,12 +1,17 @@
 import json
 
 from db import db
-from db import user_type_table
-from flask import Flask, request
+from db import upgrade_schema
+from flask import Flask, request, stream_with_context
 from db import Course
 from db import Assignment
+from db import Enrollment
 from db import User
 from db import Submission
+from db import COURSE_LIST, bump_versions, course_resource, get_version
+from response import success_response, failure_response, stream_response
+from response import fresh, make_etag, not_modified_response
+from cache import LRUCache
 
 app = Flask(__name__)
 db_filename = "cms.db"
@@ -18,24 +23,62 @@ app.config["SQLALCHEMY_ECHO"] = True
 db.init_app(app)
 with app.app_context():
     db.create_all()
+    upgrade_schema()
 
+# (version, serialized course) by id, dropped whenever a write changes what
+# they contain. Submissions and grades aren't part of a serialized course
+COURSE_CACHE = LRUCache(10000)
 
-def success_response(data, code=200):
-    return json.dumps(data), code
 
+def load_course(course_id):
+    """
+    Returns (version, serialized course) for the course with id course_id, or
+    None if there is none. The read is retried until the version is the same
+    before and after it, so the two always match
+    """
+    resource = course_resource(course_id)
+    while True:
+        version = get_version(resource)
+        course = Course.eager_query().filter_by(id=course_id).first()
+        serialized = None if course is None else course.serialize()
+        if get_version(resource) == version:
+            return None if serialized is None else (version, serialized)
+        db.session.expire_all()
+
+
+def get_cached_course(course_id):
+    """
+    Returns (version, serialized course) for the course with id course_id
+    from the cache, or None if there is none. A cached course whose version
+    is no longer the database's was changed by another worker process, and
+    is loaded again
+    """
+    entry = COURSE_CACHE.get_or_load(course_id, lambda: load_course(course_id))
+    if entry is not None and entry[0] != get_version(course_resource(course_id)):
+        COURSE_CACHE.invalidate(course_id)
+        entry = COURSE_CACHE.get_or_load(course_id, lambda: load_course(course_id))
+    return entry
 
-def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+
+def course_changed(course_id):
+    """
+    Bumps the versions of a course and of the course listing in the session's
+    transaction; call before committing a write that changes the course
+    """
+    bump_versions(COURSE_LIST, course_resource(course_id))
 
 
 @app.route("/")
 @app.route("/api/courses/")
 def get_courses():
     """
-    Endpoint for getting all courses
+    Endpoint for getting all courses, or a 304 if the client has them
     """
-    courses = [course.serialize() for course in Course.query.all()]
-    return success_response({"courses": courses})
+    etag = make_etag(COURSE_LIST, get_version(COURSE_LIST))
+    if fresh(etag):
+        return not_modified_response(etag)
+    courses = stream_with_context(Course.iter_serialized())
+    return stream_response("courses", courses, etag=etag)
 
 
 @app.route("/api/courses/", methods=["POST"])
@@ -46,6 +89,7 @@ def create_course():
     body = json.loads(request.data)
     new_course = Course(code=body.get("code"), name=body.get("name"))
     db.session.add(new_course)
+    bump_versions(COURSE_LIST)
     db.session.commit()
     return success_response(new_course.serialize(), 201)
 
@@ -53,12 +97,14 @@ def create_course():
 @app.route("/api/courses/<int:course_id>/")
 def get_course(course_id):
     """
-    Endpoint for getting a course by id
+    Endpoint for getting a course by id, or a 304 if the client has it
     """
-    course = Course.query.filter_by(id=course_id).first()
-    if course is None:
+    entry = get_cached_course(course_id)
+    if entry is None:
         return failure_response("Course not found!")
-    return success_response(course.serialize())
+    version, course = entry
+    etag = make_etag(course_resource(course_id), version)
+    return success_response(course, etag=etag)
 
 
 @app.route("/api/courses/<int:course_id>/", methods=["DELETE"])
@@ -66,12 +112,15 @@ def delete_course(course_id):
     """
     Endpoint for deleting a course by id
     """
-    course = User.query.filter_by(id=course_id).first()
+    course = Course.query.filter_by(id=course_id).first()
     if course is None:
         return failure_response("Course not found!")
+    serialized = course.serialize()
     db.session.delete(course)
+    course_changed(course_id)
     db.session.commit()
-    return success_response(course.serialize())
+    COURSE_CACHE.invalidate(course_id)
+    return success_response(serialized)
 
 
 @app.route("/api/users/", methods=["POST"])
@@ -91,7 +140,7 @@ def get_user(user_id):
     """
     Endpoint for getting a user by id
     """
-    user = User.query.filter_by(id=user_id).first()
+    user = User.eager_query().filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found!")
     return success_response(user.serialize())
@@ -108,14 +157,19 @@ def assign_user(course_id):
     body = json.loads(request.data)
     user_id = body.get("user_id")
     user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return failure_response("User not found!")
     type = body.get("type")
 
-    course.users.append(user)
-
-    user_type_table.append({"user_id": user_id, "course_id": course_id, "type": type})
-    print(user_type_table)
+    enrollment = db.session.get(Enrollment, (course_id, user_id))
+    if enrollment is None:
+        db.session.add(Enrollment(course_id=course_id, user_id=user_id, type=type))
+    else:
+        enrollment.type = type
 
+    course_changed(course_id)
     db.session.commit()
+    COURSE_CACHE.invalidate(course_id)
     return success_response(course.serialize())
 
 
@@ -132,7 +186,9 @@ def create_assignment(course_id):
         title=body.get("title"), due_date=body.get("due_date"), course_id=course_id
     )
     db.session.add(new_assignment)
+    course_changed(course_id)
     db.session.commit()
+    COURSE_CACHE.invalidate(course_id)
     return success_response(new_assignment.serialize(), 201)
 
 
@@ -147,9 +203,10 @@ def drop_student(course_id):
     body = json.loads(request.data)
     user_id = body.get("user_id")
     user = User.query.filter_by(id=user_id).first()
-    course = Course.query.filter_by(id=course_id).first()
-    course.users.remove(user)
+    Enrollment.query.filter_by(course_id=course_id, user_id=user_id).delete()
+    course_changed(course_id)
     db.session.commit()
+    COURSE_CACHE.invalidate(course_id)
     return success_response(user.serialize())
 
 
@@ -164,7 +221,9 @@ def update_assignment(assignment_id):
         return failure_response("Assignment not found!")
     assignment.title = body.get("title", assignment.title)
     assignment.due_date = body.get("due_date", assignment.due_date)
+    course_changed(assignment.course_id)
     db.session.commit()
+    COURSE_CACHE.invalidate(assignment.course_id)
     return success_response(assignment.serialize())
 
 
@@ -206,5 +265,13 @@ def grade_submission(assignment_id):
     return success_response(assignment.serialize())
 
 
+@app.route("/api/cache/")
+def get_course_cache_stats():
+    """
+    Endpoint for getting the course cache counters
+    """
+    return success_response(COURSE_CACHE.stats())
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
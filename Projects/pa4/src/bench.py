@@ -0,0 +1,198 @@
+"""
+Benchmarks for the course models.
+
+Run from this directory, e.g. `python bench.py stream`. Every benchmark
+works on a fresh database in a temporary directory, so cms.db is never
+touched.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+from flask import Flask
+
+from db import db
+from db import Assignment
+from db import Course
+from db import Enrollment
+from db import User
+from response import stream_json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def fresh_app(directory=None):
+    """
+    Returns a Flask app bound to an empty database in `directory`, or in a
+    temporary directory
+    """
+    app = Flask(__name__)
+    path = os.path.join(directory or tempfile.mkdtemp(), "cms.db")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % path
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def add_courses(count, users_per_course=5, assignments_per_course=3):
+    """
+    Adds `count` courses, each with its own users and assignments
+    """
+    for i in range(count):
+        course = Course(code="CS %d" % i, name="Course %d" % i)
+        db.session.add(course)
+        db.session.flush()
+        for j in range(users_per_course):
+            user = User(name="User %d.%d" % (i, j), netid="u%d_%d" % (i, j))
+            db.session.add(user)
+            db.session.flush()
+            role = "instructor" if j == 0 else "student"
+            db.session.add(Enrollment(course_id=course.id, user_id=user.id, type=role))
+        for j in range(assignments_per_course):
+            db.session.add(Assignment(title="A%d" % j, due_date=0, course_id=course.id))
+    db.session.commit()
+
+
+def peak_memory(work):
+    """
+    Runs `work` and returns the most memory it had allocated at once, in MB
+    """
+    tracemalloc.start()
+    try:
+        work()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def bench_stream(args):
+    """
+    Peak memory of streaming the course catalogue as the number of courses
+    grows. test_db.py checks that it doesn't grow
+    """
+    app = fresh_app()
+    with app.app_context():
+        added = 0
+        print("courses  streamed MB")
+        for size in args.sizes:
+            add_courses(size - added)
+            added = size
+            db.session.expunge_all()
+
+            def streamed():
+                for _ in stream_json("courses", Course.iter_serialized()):
+                    pass
+
+            print("%7d  %11.1f" % (size, peak_memory(streamed)))
+
+
+def load_app():
+    """
+    Imports a copy of app.py from a temporary directory, so the app's
+    database is created there instead of next to this file
+    """
+    path = os.path.join(tempfile.mkdtemp(), "app.py")
+    shutil.copy(os.path.join(HERE, "app.py"), path)
+    spec = importlib.util.spec_from_file_location("app", path)
+    module = importlib.util.module_from_spec(spec)
+    # Flask finds the app's instance folder through sys.modules
+    sys.modules["app"] = module
+    spec.loader.exec_module(module)
+    with module.app.app_context():
+        db.engine.echo = False
+    return module
+
+
+def interleave(module, args):
+    """
+    Adds --courses courses to the app in `module`, then sends it --ops
+    requests that interleave cached course reads with enrollments, drops
+    and assignment edits
+    """
+    client = module.app.test_client()
+    with module.app.app_context():
+        add_courses(args.courses)
+        user_ids = [user.id for user in User.query.all()]
+        assignment_ids = [assignment.id for assignment in Assignment.query.all()]
+
+    def post(path, body):
+        client.post(path, data=json.dumps(body))
+
+    for _ in range(args.ops):
+        course_id = random.randint(1, args.courses)
+        user_id = random.choice(user_ids)
+        roll = random.random()
+        if roll >= args.writes:
+            client.get("/api/courses/%d/" % course_id)
+        elif roll < args.writes / 4:
+            role = random.choice(["student", "instructor"])
+            post("/api/courses/%d/add/" % course_id, {"user_id": user_id, "type": role})
+        elif roll < args.writes / 2:
+            post("/api/courses/%d/drop/" % course_id, {"user_id": user_id})
+        elif roll < args.writes * 3 / 4:
+            body = {"title": "New", "due_date": random.randint(0, 100)}
+            post("/api/courses/%d/assignment/" % course_id, body)
+        else:
+            assignment_id = random.choice(assignment_ids)
+            body = {"title": "Edit %d" % random.randint(0, 100)}
+            post("/api/assignments/%d/" % assignment_id, body)
+
+
+def stale_courses(module, courses):
+    """
+    Returns how many of courses 1 to `courses` the app in `module` has
+    cached differently from how they are in the database
+    """
+    cache = module.COURSE_CACHE
+    stale = 0
+    with module.app.app_context():
+        for course_id in range(1, courses + 1):
+            cached = cache.get(course_id, cache.MISSING)
+            if cached is not cache.MISSING:
+                stale += cached != module.load_course(course_id)
+    return stale
+
+
+def bench_consistency(args):
+    """
+    Course cache hit rate while cached reads are interleaved with
+    enrollments, drops and assignment edits. test_app.py checks that no
+    cached course is left stale
+    """
+    module = load_app()
+    interleave(module, args)
+    stats = module.COURSE_CACHE.stats()
+    stale = stale_courses(module, args.courses)
+    print("hit rate %.3f, %d stale" % (stats["hit_rate"], stale))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    stream = sub.add_parser("stream", help=bench_stream.__doc__.strip())
+    stream.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 5000])
+    stream.set_defaults(func=bench_stream)
+
+    consistency = sub.add_parser(
+        "consistency", help=bench_consistency.__doc__.strip()
+    )
+    consistency.add_argument("--courses", type=int, default=50)
+    consistency.add_argument("--ops", type=int, default=5000)
+    consistency.add_argument("--writes", type=float, default=0.2)
+    consistency.set_defaults(func=bench_consistency)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
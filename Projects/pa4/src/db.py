@@ -1,15 +1,111 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import selectinload
 
 db = SQLAlchemy()
 
+# Course listings are loaded this many courses at a time
+COURSE_CHUNK = 500
+
+# The course listing's version in the versions table, bumped by every write
+# that changes a serialized course
+COURSE_LIST = "courses"
+
 association_table = db.Table(
     "association",
     db.Model.metadata,
-    db.Column("course_id", db.Integer, db.ForeignKey("course.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("course_id", db.Integer, db.ForeignKey("course.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("type", db.String),
 )
 
-user_type_table = []
+
+def upgrade_schema():
+    """
+    Brings the association table of a database created before enrolments
+    had a role and a primary key up to date. SQLite can't add a primary key
+    to a table, so it is rebuilt: a new table is created, each enrolment is
+    copied into it once, and it takes the old table's name. Roles weren't
+    stored before, so enrolments without one become students
+    """
+    inspector = inspect(db.engine)
+    columns = [c["name"] for c in inspector.get_columns("association")]
+    key = inspector.get_pk_constraint("association")["constrained_columns"]
+    if "type" in columns and sorted(key) == ["course_id", "user_id"]:
+        return
+    role = "type" if "type" in columns else "NULL"
+    with db.engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                CREATE TABLE association_new (
+                    course_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    type VARCHAR,
+                    PRIMARY KEY (course_id, user_id),
+                    FOREIGN KEY(course_id) REFERENCES course (id),
+                    FOREIGN KEY(user_id) REFERENCES user (id)
+                );
+                """
+            )
+        )
+        conn.execute(
+            text(
+                """
+                INSERT INTO association_new (course_id, user_id, type)
+                SELECT course_id, user_id, COALESCE(MIN(%s), 'student')
+                FROM association
+                WHERE course_id IS NOT NULL AND user_id IS NOT NULL
+                GROUP BY course_id, user_id;
+                """
+                % role
+            )
+        )
+        conn.execute(text("DROP TABLE association;"))
+        conn.execute(text("ALTER TABLE association_new RENAME TO association;"))
+
+
+def course_resource(course_id):
+    """
+    Returns the name a course's version is kept under in the versions table
+    """
+    return "course:%d" % course_id
+
+
+class Version(db.Model):
+    """
+    Version counter of a resource, bumped in the same transaction as every
+    write that changes it
+    """
+
+    __tablename__ = "versions"
+    resource = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+
+def get_version(resource):
+    """
+    Returns the version of a resource, 0 if it was never written
+    """
+    version = db.session.query(Version.version).filter_by(resource=resource).scalar()
+    return version or 0
+
+
+def bump_versions(*resources):
+    """
+    Increments the version of each resource in the session's transaction, so
+    the new versions commit along with the write
+    """
+    for resource in resources:
+        db.session.execute(
+            insert(Version)
+            .values(resource=resource, version=1)
+            .on_conflict_do_update(
+                index_elements=["resource"], set_={"version": Version.version + 1}
+            )
+        )
 
 
 class Course(db.Model):
@@ -22,8 +118,11 @@ class Course(db.Model):
     code = db.Column(db.String, nullable=False)
     name = db.Column(db.String, nullable=False)
     assignments = db.relationship("Assignment", cascade="delete")
+    enrollments = db.relationship(
+        "Enrollment", back_populates="course", cascade="delete"
+    )
     users = db.relationship(
-        "User", secondary=association_table, back_populates="courses"
+        "User", secondary=association_table, back_populates="courses", viewonly=True
     )
 
     def __init__(self, **kwargs):
@@ -33,6 +132,26 @@ class Course(db.Model):
         self.code = kwargs.get("code", "")
         self.name = kwargs.get("name", "")
 
+    @classmethod
+    def eager_query(cls):
+        """
+        Returns a Course query that loads everything serialize reads up
+        front, in the same number of statements however many courses match
+        """
+        return cls.query.options(
+            selectinload(cls.assignments),
+            selectinload(cls.enrollments).joinedload(Enrollment.user),
+        )
+
+    @classmethod
+    def iter_serialized(cls):
+        """
+        Yields every course serialized, loading COURSE_CHUNK courses and
+        what they serialize at a time
+        """
+        for course in cls.eager_query().yield_per(COURSE_CHUNK):
+            yield course.serialize()
+
     def serialize(self):
         """
         Serialize a Task object
@@ -43,18 +162,36 @@ class Course(db.Model):
             "name": self.name,
             "assignments": [a.serialize() for a in self.assignments],
             "instructors": [
-                i.simple_serialize()
-                for i in self.users
-                if i.filter_user_type() == "instructor"
+                e.user.simple_serialize()
+                for e in self.enrollments
+                if e.type == "instructor"
             ],
             "students": [
-                s.simple_serialize()
-                for s in self.users
-                if s.filter_user_type() == "student"
+                e.user.simple_serialize()
+                for e in self.enrollments
+                if e.type == "student"
             ],
         }
 
 
+class Enrollment(db.Model):
+    """
+    Enrollment model: a user's role in a course
+    """
+
+    __table__ = association_table
+    course = db.relationship("Course", back_populates="enrollments")
+    user = db.relationship("User", back_populates="enrollments")
+
+    def __init__(self, **kwargs):
+        """
+        Initialize an enrollment object
+        """
+        self.course_id = kwargs.get("course_id")
+        self.user_id = kwargs.get("user_id")
+        self.type = kwargs.get("type")
+
+
 class Assignment(db.Model):
     """
     Assignment model
@@ -119,8 +256,11 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
     netid = db.Column(db.String, nullable=False)
+    enrollments = db.relationship(
+        "Enrollment", back_populates="user", cascade="delete"
+    )
     courses = db.relationship(
-        "Course", secondary=association_table, back_populates="users"
+        "Course", secondary=association_table, back_populates="users", viewonly=True
     )
 
     def __init__(self, **kwargs):
@@ -130,13 +270,18 @@ class User(db.Model):
         self.name = kwargs.get("name", "")
         self.netid = kwargs.get("netid", "")
 
-    def filter_user_type(self):
+    @classmethod
+    def eager_query(cls):
         """
-        Returns the user type
+        Returns a User query that loads everything serialize reads up front,
+        including the courses it serializes
         """
-        for x in user_type_table:
-            if x.get("user_id") == self.id:
-                return x.get("type")
+        return cls.query.options(
+            selectinload(cls.courses).selectinload(Course.assignments),
+            selectinload(cls.courses)
+            .selectinload(Course.enrollments)
+            .joinedload(Enrollment.user),
+        )
 
     def serialize(self):
         """
@@ -0,0 +1,124 @@
+"""
+JSON responses for the app's endpoints.
+
+Bodies are encoded with orjson when it's installed and with the standard
+library otherwise (or whichever JSON_BACKEND names), and are sent as
+application/json bytes either way. Responses given an ETag answer a request
+whose If-None-Match already names it with an empty 304 instead, without
+encoding anything.
+"""
+import json
+import os
+
+from flask import Response, request
+
+
+def stdlib_dumps(data):
+    """
+    Returns `data` encoded as compact JSON bytes by the standard library
+    """
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+BACKENDS = {"json": stdlib_dumps}
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+
+    def orjson_dumps(data):
+        """
+        Returns `data` encoded as JSON bytes by orjson
+        """
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    BACKENDS["orjson"] = orjson_dumps
+
+dumps = BACKENDS.get(
+    os.environ.get("JSON_BACKEND"), BACKENDS.get("orjson", stdlib_dumps)
+)
+
+
+def make_etag(resource, version):
+    """
+    Returns the ETag of a version of a resource
+    """
+    return "%s.%d" % (resource, version)
+
+
+def fresh(etag):
+    """
+    Returns whether the request's If-None-Match names `etag`, i.e. the client
+    already has that version of the resource
+    """
+    return request.if_none_match.contains_weak(etag)
+
+
+def not_modified_response(etag):
+    """
+    Returns an empty 304 response for `etag`
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def success_response(data, code=200, etag=None):
+    """
+    Returns a JSON response of `data` with status `code`, tagged with `etag`
+    if given. That becomes a 304 if the client already has `etag`
+    """
+    if etag is not None and fresh(etag):
+        return not_modified_response(etag)
+    response = Response(dumps(data), status=code, mimetype="application/json")
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def failure_response(message, code=404):
+    """
+    Returns a JSON error response with status `code`
+    """
+    return success_response({"error": message}, code)
+
+
+# Streamed listings are encoded and sent this many items at a time
+STREAM_CHUNK = 1000
+
+
+def stream_json(key, items):
+    """
+    Yields {key: [items...]} as JSON bytes a chunk of items at a time, so
+    the whole listing is never held in memory. Each chunk is encoded by one
+    dumps call
+    """
+    yield b"{" + dumps(key) + b":["
+    separator = b""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == STREAM_CHUNK:
+            yield separator + dumps(chunk)[1:-1]
+            separator = b","
+            chunk = []
+    if chunk:
+        yield separator + dumps(chunk)[1:-1]
+    yield b"]}"
+
+
+def stream_response(key, items, code=200, etag=None):
+    """
+    Returns a JSON response of {key: [items...]} that is encoded and sent
+    while `items` is being iterated, tagged like success_response
+    """
+    if etag is not None and fresh(etag):
+        return not_modified_response(etag)
+    response = Response(
+        stream_json(key, items), status=code, mimetype="application/json"
+    )
+    if etag is not None:
+        response.set_etag(etag)
+    return response
@@ -0,0 +1,20 @@
+"""
+Tests for the app's course cache.
+
+Run from this directory with `python -m pytest`. The app is imported from a
+copy in a temporary directory, so cms.db is never touched.
+"""
+import argparse
+
+from bench import interleave, load_app, stale_courses
+
+# Loaded while this file is collected, so app.py imports this app's db,
+# response and cache modules rather than another app's of the same name
+APP = load_app()
+
+
+def test_no_cached_course_is_stale_after_writes():
+    args = argparse.Namespace(courses=50, ops=1000, writes=0.2)
+    interleave(APP, args)
+    assert APP.COURSE_CACHE.stats()["hits"] > 0
+    assert stale_courses(APP, args.courses) == 0
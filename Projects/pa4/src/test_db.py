@@ -0,0 +1,91 @@
+"""
+Tests for the course models.
+
+Run from this directory with `python -m pytest`. Every test works on a
+fresh database in its own temporary directory, so cms.db is never touched.
+"""
+import pytest
+from sqlalchemy import event
+
+from bench import add_courses, fresh_app, peak_memory
+from db import db
+from db import COURSE_CHUNK
+from db import Course
+from db import Enrollment
+from db import User
+from response import stream_json
+
+
+@pytest.fixture
+def app(tmp_path):
+    """
+    Returns a Flask app bound to an empty database, inside its app context
+    """
+    app = fresh_app(str(tmp_path))
+    with app.app_context():
+        yield app
+
+
+def count_statements(work):
+    """
+    Runs `work` and returns the number of SQL statements it sent
+    """
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        work()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+    return len(statements)
+
+
+def test_serializing_takes_the_same_statements_as_the_catalogue_grows(app):
+    counts = {"catalogue": set(), "user": set()}
+    added = 0
+    for size in (1, 10, 100):
+        add_courses(size - added)
+        added = size
+        user = User(name="Student", netid="s%d" % size)
+        db.session.add(user)
+        db.session.flush()
+        for course in Course.query.all():
+            db.session.add(
+                Enrollment(course_id=course.id, user_id=user.id, type="student")
+            )
+        db.session.commit()
+        user_id = user.id
+        db.session.expunge_all()
+
+        counts["catalogue"].add(
+            count_statements(
+                lambda: [c.serialize() for c in Course.eager_query().all()]
+            )
+        )
+        db.session.expunge_all()
+        counts["user"].add(
+            count_statements(
+                lambda: User.eager_query().filter_by(id=user_id).first().serialize()
+            )
+        )
+        db.session.expunge_all()
+    assert [len(c) for c in counts.values()] == [1, 1]
+
+
+def test_streaming_the_catalogue_holds_the_same_memory_as_it_grows(app):
+    peaks = []
+    added = 0
+    for size in (COURSE_CHUNK, 3 * COURSE_CHUNK):
+        add_courses(size - added)
+        added = size
+        db.session.expunge_all()
+
+        def streamed():
+            for _ in stream_json("courses", Course.iter_serialized()):
+                pass
+
+        peaks.append(peak_memory(streamed))
+    assert peaks[1] <= 2 * peaks[0] + 1